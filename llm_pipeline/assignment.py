@@ -0,0 +1,93 @@
+import itertools
+from typing import Dict, Tuple
+
+import numpy as np
+
+# Groups with at most this many possible one-to-one assignments are solved exactly by
+# enumerating them (7 gold x 7 predicted entities = 5040); larger ones greedily
+MAX_ENUMERATED = 5040
+CHUNK_VALUES = 1 << 22
+
+_injections: Dict[Tuple[int, int], np.ndarray] = {}
+
+
+def _injective_maps(rows: int, cols: int) -> np.ndarray:
+    """Every assignment of the rows to distinct columns (rows <= cols), one per row of the result"""
+    if (rows, cols) not in _injections:
+        maps = np.array(list(itertools.permutations(range(cols), rows)), dtype=np.int64)
+        _injections[rows, cols] = maps.reshape(-1, rows)
+    return _injections[rows, cols]
+
+
+def _pair_offsets(group_start: np.ndarray, size: np.ndarray) -> np.ndarray:
+    """Positions of all pairs of the given groups, group after group"""
+    within = np.arange(size.sum()) - np.repeat(np.cumsum(size) - size, size)
+    return np.repeat(group_start, size) + within
+
+
+def one_to_one(score: np.ndarray, group_start: np.ndarray, gold_count: np.ndarray, pred_count: np.ndarray) -> np.ndarray:
+    """
+    Maximum-score one-to-one matching of gold to predicted entities within each group.
+
+    Group k's pairs are score[group_start[k]:group_start[k] + gold_count[k] * pred_count[k]]
+    in gold-major order (pair i is gold i // pred_count[k] with prediction i % pred_count[k]).
+    Groups with a single gold or predicted entity take their best pair, groups of up to
+    MAX_ENUMERATED assignments are solved exactly (vectorised over all groups of the same
+    shape), and larger ones greedily from the highest-scoring pair down.
+
+    Returns:
+        mask over the pairs, True for pairs in the matching
+    """
+    matched = np.zeros(len(score), dtype=bool)
+    smaller = np.minimum(gold_count, pred_count)
+    larger = np.maximum(gold_count, pred_count)
+    # Number of possible assignments, larger! / (larger - smaller)!, capped past MAX_ENUMERATED
+    assignments = np.ones(len(group_start), dtype=np.int64)
+    for i in range(int(smaller.max(initial=0))):
+        assignments = np.minimum(assignments * np.where(i < smaller, larger - i, 1), MAX_ENUMERATED + 1)
+    solvable = assignments <= MAX_ENUMERATED
+
+    # One entity on a side: its best pair (the first of equal ones)
+    single = np.flatnonzero(smaller == 1)
+    if len(single):
+        size = larger[single]
+        positions = _pair_offsets(group_start[single], size)
+        group = np.repeat(np.arange(len(single)), size)
+        order = np.lexsort((-score[positions], group))
+        matched[positions[order[np.cumsum(size) - size]]] = True
+
+    # Small groups: enumerate every assignment, for all groups of one shape at once
+    enumerated = np.flatnonzero(solvable & (smaller > 1))
+    if len(enumerated):
+        shapes = np.stack([gold_count[enumerated], pred_count[enumerated]], axis=1)
+        for gold_n, pred_n in np.unique(shapes, axis=0).tolist():
+            rows, cols = min(gold_n, pred_n), max(gold_n, pred_n)
+            maps = _injective_maps(rows, cols)
+            shape_groups = enumerated[(shapes[:, 0] == gold_n) & (shapes[:, 1] == pred_n)]
+            # Bound the (groups x assignments x rows) score gather to a few million values
+            chunk = max(1, CHUNK_VALUES // maps.size)
+            for offset in range(0, len(shape_groups), chunk):
+                groups = shape_groups[offset:offset + chunk]
+                matrices = score[group_start[groups, None] + np.arange(gold_n * pred_n)].reshape(-1, gold_n, pred_n)
+                if gold_n > pred_n:
+                    matrices = matrices.transpose(0, 2, 1)
+                best = maps[matrices[:, np.arange(rows), maps].sum(axis=2).argmax(axis=1)]
+                gold_local, pred_local = (np.arange(rows), best) if gold_n <= pred_n else (best, np.arange(rows))
+                matched[(group_start[groups, None] + gold_local * pred_n + pred_local).ravel()] = True
+
+    # Large groups: greedy over the scored pairs, best first
+    for k in np.flatnonzero(~solvable).tolist():
+        start, gold_n, pred_n = int(group_start[k]), int(gold_count[k]), int(pred_count[k])
+        scores = score[start:start + gold_n * pred_n]
+        candidates = np.flatnonzero(scores > 0)
+        used_gold, used_pred = set(), set()
+        for i in candidates[np.argsort(-scores[candidates], kind="stable")].tolist():
+            gold, pred = divmod(i, pred_n)
+            if gold in used_gold or pred in used_pred:
+                continue
+            used_gold.add(gold)
+            used_pred.add(pred)
+            matched[start + i] = True
+            if len(used_gold) == smaller[k]:
+                break
+    return matched
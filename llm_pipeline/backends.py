@@ -0,0 +1,46 @@
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List
+
+from models import ModelClient, Llama, Phi, OpenAIChat
+
+
+@dataclass
+class Backend:
+    """A registered model backend"""
+    name: str
+    factory: Callable[..., ModelClient]  # (endpoint, api_key, model_name=, parameters=) -> client
+    keyring_prefix: str                  # keyring entries "<prefix>_endpoint" / "<prefix>_api_key"
+    description: str = ""
+
+
+BACKENDS: Dict[str, Backend] = {}
+
+
+def register_backend(name: str, factory: Callable[..., ModelClient], keyring_prefix: str = None, description: str = ""):
+    """Make a backend selectable with --backend <name>"""
+    BACKENDS[name] = Backend(name, factory, keyring_prefix or name, description)
+
+
+def get_backend(name: str) -> Backend:
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown backend '{name}' (available: {', '.join(sorted(BACKENDS))})")
+    return BACKENDS[name]
+
+
+def infer_backend(model_name: str) -> str:
+    """Backend used when none is given: the original Phi-or-Llama choice by model name"""
+    return "phi" if "phi" in model_name.lower() else "llama"
+
+
+def create_client(backend: str, endpoint: str, api_key: str, model_name: str, parameters: Dict[str, Any] = None) -> ModelClient:
+    """One client for a single endpoint; parameters override the backend's sampling defaults"""
+    return get_backend(backend).factory(endpoint=endpoint, api_key=api_key, model_name=model_name, parameters=parameters)
+
+
+def backend_names() -> List[str]:
+    return sorted(BACKENDS)
+
+
+register_backend("llama", Llama, description="Azure ML managed online endpoint (input_data format)")
+register_backend("phi", Phi, description="Azure AI inference chat completions")
+register_backend("openai", OpenAIChat, description="OpenAI-compatible chat completions (vLLM, llama.cpp, Ollama)")
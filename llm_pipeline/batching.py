@@ -0,0 +1,76 @@
+from dataclasses import dataclass
+from typing import List, Dict, Any
+
+from tokens import estimate_tokens
+
+
+@dataclass
+class PlannedBatch:
+    offset: int                       # position of the batch's first instance in the plan
+    instances: List[Any]
+    input_tokens: int = 0             # estimated, numbered input lines only
+    output_tokens: int = 0            # estimated completion size
+
+    def to_record(self) -> Dict[str, Any]:
+        return {
+            "offset": self.offset,
+            "text_ids": [inst.text_id for inst in self.instances],
+            "size": len(self.instances),
+            "est_input_tokens": self.input_tokens,
+            "est_output_tokens": self.output_tokens,
+        }
+
+
+@dataclass
+class BatchPlanner:
+    """
+    Groups instances into batches.
+
+    Without a token budget this is the original fixed-size slicing in dataset order.
+    With one, instances are sorted by length and packed greedily so that each batch's
+    estimated input + output tokens stay within token_budget and its estimated output
+    within max_output_tokens (the client's completion limit), with at most
+    max_batch_size inputs per batch.
+    """
+    max_batch_size: int = 5
+    token_budget: int = None
+    max_output_tokens: int = None
+    # Each output object echoes the input and copies entity substrings out of it,
+    # plus JSON keys for the categories found
+    output_ratio: float = 2.0
+    output_overhead: int = 40
+
+    def input_tokens(self, text: str) -> int:
+        return estimate_tokens(text) + 2  # "N. " prefix and newline
+
+    def output_tokens(self, text: str) -> int:
+        return int(estimate_tokens(text) * self.output_ratio) + self.output_overhead
+
+    def plan(self, instances: List[Any]) -> List[PlannedBatch]:
+        if self.token_budget is None:
+            batches = [
+                PlannedBatch(i, instances[i:i + self.max_batch_size])
+                for i in range(0, len(instances), self.max_batch_size)
+            ]
+            for batch in batches:
+                batch.input_tokens = sum(self.input_tokens(inst.text) for inst in batch.instances)
+                batch.output_tokens = sum(self.output_tokens(inst.text) for inst in batch.instances)
+            return batches
+
+        ordered = sorted(instances, key=lambda inst: len(inst.text))
+        batches = []
+        current = PlannedBatch(0, [])
+        for inst in ordered:
+            in_tok = self.input_tokens(inst.text)
+            out_tok = self.output_tokens(inst.text)
+            over_budget = current.input_tokens + current.output_tokens + in_tok + out_tok > self.token_budget
+            over_output = self.max_output_tokens is not None and current.output_tokens + out_tok > self.max_output_tokens
+            if current.instances and (len(current.instances) >= self.max_batch_size or over_budget or over_output):
+                batches.append(current)
+                current = PlannedBatch(current.offset + len(current.instances), [])
+            current.instances.append(inst)
+            current.input_tokens += in_tok
+            current.output_tokens += out_tok
+        if current.instances:
+            batches.append(current)
+        return batches
@@ -0,0 +1,164 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Any, Optional
+
+
+def make_cache_key(fingerprint: Dict[str, Any]) -> str:
+    """Content address of a request: sha256 over its canonical JSON form"""
+    canonical = json.dumps(fingerprint, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    Content-addressed on-disk cache of LLM responses.
+
+    Each entry is stored as <cache_dir>/<key[:2]>/<key>.json. File mtimes double as
+    the LRU clock: a hit touches the file, and when the total size exceeds
+    max_bytes the least recently used entries are deleted.
+    """
+    def __init__(self, cache_dir: Path, max_bytes: int = 512 * 1024 * 1024):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._total_bytes = sum(p.stat().st_size for p in self.cache_dir.glob("*/*.json"))
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / f"{key}.json"
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        try:
+            os.utime(path)  # mark as recently used
+        except FileNotFoundError:
+            pass
+        return entry
+
+    def put(self, key: str, entry: Dict[str, Any]):
+        path = self._path(key)
+        path.parent.mkdir(exist_ok=True)
+        data = json.dumps(entry, ensure_ascii=False).encode("utf-8")
+
+        # Write to a temp file and rename so concurrent readers never see partial entries
+        tmp_path = path.with_suffix(f".{threading.get_ident()}.tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        with self._lock:
+            old_size = path.stat().st_size if path.exists() else 0
+            os.replace(tmp_path, path)
+            self._total_bytes += len(data) - old_size
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        """Delete least recently used entries until the cache fits in max_bytes (lock held)"""
+        entries = []
+        for p in self.cache_dir.glob("*/*.json"):
+            try:
+                st = p.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, p))
+        entries.sort()
+
+        self._total_bytes = sum(size for _, size, _ in entries)
+        for _, size, p in entries:
+            if self._total_bytes <= self.max_bytes:
+                break
+            try:
+                p.unlink()
+            except FileNotFoundError:
+                pass
+            self._total_bytes -= size
+
+
+class CachedClient:
+    """
+    Wraps a model client (any backend) so identical requests are answered from a ResponseCache.
+
+    The key covers model name, rendered messages and sampling parameters, as returned
+    by the client's request_fingerprint(). With bypass=True the cache is neither read
+    nor written, for intentionally stochastic repeats.
+    """
+    def __init__(self, client, cache: ResponseCache, bypass: bool = False):
+        self.client = client
+        self.cache = cache
+        self.bypass = bypass
+        self.hits = 0
+        self.misses = 0
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def _lookup(self, system_prompt: str, user_prompt: str, timing: Dict[str, Any] = None, stream: bool = False):
+        fingerprint = self.client.request_fingerprint(system_prompt, user_prompt)
+        if stream:
+            # Streamed entries hold the completion text rather than the raw response body
+            fingerprint = {**fingerprint, "stream": True}
+        key = make_cache_key(fingerprint)
+        if self.bypass:
+            return key, None
+        entry = self.cache.get(key)
+        if entry is None:
+            self.misses += 1
+            return key, None
+        self.hits += 1
+        # Nothing was sent: the latency and timings recorded with the entry belong to
+        # the original request and must not be counted again
+        if timing is not None:
+            timing["cache_hit"] = True
+        return key, (entry["response"], 0.0)
+
+    def _store(self, key: str, response, latency: float, timing: Dict[str, Any] = None):
+        if self.bypass:
+            return
+        self.cache.put(key, {
+            "model": self.client.model_name,
+            "response": response.decode("utf-8") if isinstance(response, bytes) else response,
+            "latency": latency,
+            "timing": timing or {},
+        })
+
+    def generate_completion(self, system_prompt: str, user_prompt: str, timing: Dict[str, Any] = None):
+        key, cached = self._lookup(system_prompt, user_prompt, timing)
+        if cached is not None:
+            return cached
+        response, latency = self.client.generate_completion(system_prompt, user_prompt, timing=timing)
+        self._store(key, response, latency, timing)
+        return response, latency
+
+    async def agenerate_completion(self, system_prompt: str, user_prompt: str, timing: Dict[str, Any] = None):
+        key, cached = self._lookup(system_prompt, user_prompt, timing)
+        if cached is not None:
+            return cached
+        response, latency = await self.client.agenerate_completion(system_prompt, user_prompt, timing=timing)
+        self._store(key, response, latency, timing)
+        return response, latency
+
+    async def astream_completion(self, system_prompt: str, user_prompt: str, timing: Dict[str, Any] = None):
+        key, cached = self._lookup(system_prompt, user_prompt, timing, stream=True)
+        if cached is not None:
+            yield cached[0]
+            return
+        start_time = time.time()
+        chunks = []
+        async for chunk in self.client.astream_completion(system_prompt, user_prompt, timing=timing):
+            chunks.append(chunk)
+            yield chunk
+        self._store(key, "".join(chunks), time.time() - start_time, timing)
+
+    async def aclose(self):
+        await self.client.aclose()
+
+    def stats(self) -> Dict[str, int]:
+        return {"cache_hits": self.hits, "cache_misses": self.misses, "cache_bypassed": self.bypass}
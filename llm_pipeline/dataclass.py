@@ -1,20 +1,160 @@
+import sys
+import threading
 from dataclasses import dataclass
-from typing import Dict
+from typing import Any, Dict, List, Optional, Tuple
 
-@dataclass
-class Entity:
-    label: str
-    clean_text: str
-    extra_fields: Dict
+# Entity labels interned to small integer ids for the life of the process
+_label_ids: Dict[str, int] = {}
+_label_names: List[str] = []
+_label_lock = threading.Lock()
+
+
+def label_id(label: str) -> int:
+    """The id of a label name, assigning the next one to a new name"""
+    try:
+        return _label_ids[label]
+    except KeyError:
+        with _label_lock:
+            # Another thread may have added it meanwhile; names go in before ids so
+            # label_name never sees an id it cannot resolve
+            if label not in _label_ids:
+                _label_names.append(sys.intern(label))
+                _label_ids[label] = len(_label_names) - 1
+            return _label_ids[label]
+
+
+def label_name(label_id: int) -> str:
+    return _label_names[label_id]
+
+
+def _flatten(fields: Optional[Dict], exclude: Tuple[str, ...] = ()) -> Optional[tuple]:
+    """Extra fields as a flat (key, value, key, value, ...) tuple, None when there are none"""
+    if not fields:
+        return None
+    flat = tuple(item for key, value in fields.items() if key not in exclude for item in (sys.intern(key), value))
+    return flat or None
+
+
+class _EntityRecord:
+    """
+    Slotted entity record: the label is kept as its interned id and the extra fields as
+    a flat tuple, turned into a dict only when extra_fields is first read.
+    """
+    __slots__ = ("label_id", "_extra")
+    _fields: Tuple[str, ...] = ()
+
+    @property
+    def label(self) -> str:
+        return _label_names[self.label_id]
+
+    @label.setter
+    def label(self, label: str):
+        self.label_id = label_id(label)
+
+    @property
+    def extra_fields(self) -> Dict:
+        if not isinstance(self._extra, dict):
+            flat = self._extra or ()
+            self._extra = dict(zip(flat[::2], flat[1::2]))
+        return self._extra
+
+    @extra_fields.setter
+    def extra_fields(self, fields: Dict):
+        self._extra = fields
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {name: getattr(self, name) for name in self._fields}
+
+    def __eq__(self, other):
+        if other.__class__ is not self.__class__:
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name) for name in self._fields)
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({', '.join(f'{name}={getattr(self, name)!r}' for name in self._fields)})"
+
+    def __reduce__(self):
+        # By label name: ids are only meaningful within one process
+        return self.__class__, tuple(getattr(self, name) for name in self._fields)
+
+
+class Entity(_EntityRecord):
+    __slots__ = ("clean_text",)
+    _fields = ("label", "clean_text", "extra_fields")
+
+    def __init__(self, label: str, clean_text: str, extra_fields: Optional[Dict] = None):
+        self.label_id = label_id(label)
+        self.clean_text = clean_text
+        self._extra = _flatten(extra_fields)
+
+
+class GoldEntity(_EntityRecord):
+    __slots__ = ("raw_text", "clean_text", "model_prediction", "correct")
+    _fields = ("label", "raw_text", "clean_text", "extra_fields", "model_prediction", "correct")
+
+    def __init__(self, label: str, raw_text: str, clean_text: str, extra_fields: Optional[Dict] = None,
+                 model_prediction: str = None, correct: bool = None):
+        self.label_id = label_id(label)
+        self.raw_text = raw_text
+        self.clean_text = clean_text
+        self._extra = _flatten(extra_fields)
+        self.model_prediction = model_prediction
+        self.correct = correct
+
+    @classmethod
+    def from_annotation(cls, ann: Dict[str, Any]) -> "GoldEntity":
+        """A dataset annotation's entity, every key but label/text/clean kept as an extra field"""
+        entity = cls.__new__(cls)
+        entity.label_id = label_id(ann["label"])
+        entity.raw_text = ann["text"]
+        entity.clean_text = ann.get("clean", entity.raw_text)
+        entity._extra = _flatten(ann, ("label", "text", "clean"))
+        entity.model_prediction = None
+        entity.correct = None
+        return entity
+
+    @staticmethod
+    def to_columns(entities: List["GoldEntity"]) -> Dict[str, list]:
+        """
+        Parsed entities as plain columns (compact to pickle, see from_columns): label
+        names plus each entity's index into them, texts, clean texts (None when equal to
+        the text) and flat extra fields. Predictions are not included.
+        """
+        label_ids = [e.label_id for e in entities]
+        used = sorted(set(label_ids))
+        index = {label: i for i, label in enumerate(used)}
+        return {
+            "labels": [_label_names[label] for label in used],
+            "label": [index[label] for label in label_ids],
+            "raw_text": [e.raw_text for e in entities],
+            "clean_text": [None if e.clean_text == e.raw_text else e.clean_text for e in entities],
+            "extra": [e._extra if not isinstance(e._extra, dict) else _flatten(e._extra) for e in entities],
+        }
+
+    @classmethod
+    def from_columns(cls, columns: Dict[str, list]) -> List["GoldEntity"]:
+        ids = [label_id(label) for label in columns["labels"]]
+        new = cls.__new__
+
+        def build(label, raw_text, clean_text, extra):
+            entity = new(cls)
+            entity.label_id = ids[label]
+            entity.raw_text = raw_text
+            entity.clean_text = raw_text if clean_text is None else clean_text
+            entity._extra = extra
+            entity.model_prediction = None
+            entity.correct = None
+            return entity
+
+        return list(map(build, columns["label"], columns["raw_text"], columns["clean_text"], columns["extra"]))
+
+
+def to_json(obj: Any) -> Dict[str, Any]:
+    """json.dump default= hook writing entity records as plain objects"""
+    if isinstance(obj, _EntityRecord):
+        return obj.to_dict()
+    raise TypeError(f"Object of type {obj.__class__.__name__} is not JSON serializable")
 
-@dataclass
-class GoldEntity:
-    label: str
-    raw_text: str
-    clean_text: str
-    extra_fields: Dict
-    model_prediction: str = None
-    correct: bool = None
 
 @dataclass
 class Category:
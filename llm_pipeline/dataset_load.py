@@ -1,11 +1,26 @@
+from collections.abc import Sequence
 from dataclasses import dataclass
+from itertools import accumulate
 from dataclass import GoldEntity, Entity
-from typing import List, Dict, Tuple
+from typing import List, Dict, Tuple, Iterator
+import numpy as np
 import pandas as pd
 from pathlib import Path
+import gc
+import hashlib
 import json
+import mmap
+import os
+import pickle
 from random import shuffle
 
+# Bytes read at a time when indexing or hashing a JSONL file
+INDEX_BLOCK_BYTES = 1 << 24
+
+# Version of the parsed representation; bump it when parse_gold_record or the entity
+# records change so that cached snapshots of datasets are rebuilt
+LOADER_VERSION = 1
+
 @dataclass
 class GoldInstance:
     text_id: int
@@ -31,56 +46,208 @@ class GoldInstance:
     def get_sentence(self):
         return self.text
 
-def load_ner_gold(file_path):
-    instances = []
+
+@dataclass
+class InstanceText:
+    """A dataset line's text without its annotations, enough to build and send batches"""
+    text_id: int
+    text: str
+
+def parse_gold_record(record: Dict, text_id: int) -> GoldInstance:
+    """The GoldInstance of one dataset line (decoded JSON)"""
+    text = record["text"]
+    annotations = record.get("annotations", [])
     
+    # Skip entities marked as invalid; every other annotation key is kept as an extra field
+    entities = [GoldEntity.from_annotation(ann) for ann in annotations if ann.get("is_valid", True) is not False]
+
+    return GoldInstance(
+        text_id=text_id,
+        text=text,
+        entities=entities
+    )
+
+def iter_ner_gold(file_path) -> Iterator[GoldInstance]:
+    """Gold instances of a JSONL dataset, parsed one line at a time"""
     with open(file_path, "r", encoding="utf-8") as f:
         for i, line in enumerate(f):
-            record = json.loads(line)
-            text = record["text"]
-            annotations = record.get("annotations", [])
-            
-            entities = []
-            for ann in annotations:
-                # Skip entity if marked as invalid
-                if ann.get("is_valid", True) is False:
-                    continue
-
-                label = ann["label"]
-                gold_text = ann["text"]
-                gold_clean = ann.get("clean", gold_text)
-                
-                # Capture extra fields
-                extra_fields = {k: v for k, v in ann.items() if k not in ["label", "text", "clean"]}
-                
-                entity = GoldEntity(
-                    label=label,
-                    raw_text=gold_text,
-                    clean_text=gold_clean,
-                    extra_fields=extra_fields,
-                    model_prediction=None,
-                    correct=None
-                )
-                entities.append(entity)
-            
-            instance = GoldInstance(
-                text_id=i,
-                text=text,
-                entities=entities
-            )
-            instances.append(instance)
-    
+            yield parse_gold_record(json.loads(line), i)
+
+def load_ner_gold(file_path):
+    return list(iter_ner_gold(file_path))
+
+def file_sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(INDEX_BLOCK_BYTES), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _snapshot(instances: List[GoldInstance]) -> Dict[str, list]:
+    """Parsed instances as plain columns (see GoldEntity.to_columns)"""
+    return {
+        "text": [instance.text for instance in instances],
+        "entity_count": [len(instance.entities) for instance in instances],
+        **GoldEntity.to_columns([e for instance in instances for e in instance.entities]),
+    }
+
+def _from_snapshot(snapshot: Dict[str, list]) -> List[GoldInstance]:
+    entities = GoldEntity.from_columns(snapshot)
+    ends = list(accumulate(snapshot["entity_count"]))
+    return [
+        GoldInstance(text_id=i, text=text, entities=entities[end - count:end])
+        for i, (text, count, end) in enumerate(zip(snapshot["text"], snapshot["entity_count"], ends))
+    ]
+
+def load_ner_gold_cached(file_path) -> List[GoldInstance]:
+    """
+    load_ner_gold through a binary snapshot of the parsed instances kept next to the
+    file ([file].cache): used while it was written from the same file content by the
+    same LOADER_VERSION, otherwise the file is parsed and the snapshot rewritten.
+    """
+    path = Path(file_path)
+    cache_path = path.with_name(path.name + ".cache")
+    key = {"loader_version": LOADER_VERSION, "sha256": file_sha256(path)}
+    try:
+        with open(cache_path, "rb") as f:
+            if pickle.load(f) == key:
+                # Only new objects are created here: skip the collector's passes over them
+                gc_enabled = gc.isenabled()
+                gc.disable()
+                try:
+                    return _from_snapshot(pickle.load(f))
+                finally:
+                    if gc_enabled:
+                        gc.enable()
+    except FileNotFoundError:
+        pass
+    except (OSError, EOFError, ImportError, pickle.UnpicklingError, AttributeError, TypeError, ValueError, KeyError) as e:
+        print(f"[Warning] Ignoring unreadable dataset cache {cache_path}: {e}")
+
+    instances = load_ner_gold(path)
+    # Runs sharing the dataset may write at once; each writes a whole file and renames it
+    temporary = cache_path.with_name(f"{cache_path.name}.{os.getpid()}.tmp")
+    try:
+        with open(temporary, "wb") as f:
+            pickle.dump(key, f, protocol=pickle.HIGHEST_PROTOCOL)
+            pickle.dump(_snapshot(instances), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary, cache_path)
+    except OSError as e:
+        print(f"[Warning] Could not write dataset cache {cache_path}: {e}")
     return instances
 
+def line_offsets(path: Path) -> np.ndarray:
+    """
+    Start of every line of a file, followed by its size, from the index cached next to
+    it ([file].idx) when that was built for the file's current size and mtime.
+    """
+    path = Path(path)
+    stat = path.stat()
+    index_path = path.with_name(path.name + ".idx")
+    try:
+        index = np.load(index_path)
+        if index[0] == stat.st_size and index[1] == stat.st_mtime_ns:
+            return index[2:]
+    except (OSError, ValueError, IndexError):
+        pass
+
+    newlines = []
+    with open(path, "rb") as f:
+        while True:
+            block_start = f.tell()
+            block = f.read(INDEX_BLOCK_BYTES)
+            if not block:
+                break
+            newlines.append(np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == ord("\n")) + block_start)
+    starts = np.concatenate([[0], *(positions + 1 for positions in newlines)]).astype(np.int64)
+    if starts[-1] == stat.st_size:
+        starts = starts[:-1]  # the file ends with a newline
+    offsets = np.append(starts, stat.st_size)
+
+    # Another process may be writing the same index; each writes a whole file and renames it
+    temporary = index_path.with_name(f"{index_path.name}.{os.getpid()}.tmp")
+    try:
+        with open(temporary, "wb") as f:
+            np.save(f, np.concatenate([[stat.st_size, stat.st_mtime_ns], offsets]).astype(np.int64))
+        os.replace(temporary, index_path)
+    except OSError as e:
+        print(f"[Warning] Could not cache the line index of {path}: {e}")
+    return offsets
+
+class JSONLInstances(Sequence):
+    """
+    Gold instances of a JSONL dataset, memory-mapped and decoded only when accessed.
+    Processes mapping the same file share it through the page cache; slicing or
+    indexing touches just the lines asked for. Instances are decoded afresh on every
+    access, so changes made to them are not kept.
+    """
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.offsets = line_offsets(self.path)
+        with open(self.path, "rb") as f:
+            # An empty file cannot be mapped
+            self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self.offsets[-1] else b""
+
+    def _decode(self, i: int) -> GoldInstance:
+        return parse_gold_record(json.loads(self._data[self.offsets[i]:self.offsets[i + 1]]), i)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self._decode(i) for i in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(f"instance {idx} out of range ({len(self)} instances)")
+        return self._decode(idx)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self._decode(i)
+
+    def texts(self) -> Iterator[InstanceText]:
+        """Every line's text, skipping the construction of its gold entities"""
+        for i in range(len(self)):
+            yield InstanceText(i, json.loads(self._data[self.offsets[i]:self.offsets[i + 1]])["text"])
+
+    def close(self):
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+
 class Dataset:
-    def __init__(self, jsonl_path: Path):
+    def __init__(self, jsonl_path: Path, lazy: bool = False, cache: bool = True):
+        """
+        lazy: memory-map the file and decode instances on access (see JSONLInstances)
+            instead of parsing it all up front.
+        cache: load parsed instances from (and save them to) a snapshot next to the
+            file (see load_ner_gold_cached).
+        """
         self.jsonl_path = jsonl_path
-        self.instances: List[GoldInstance] = []
+        self.lazy = lazy
+        self.cache = cache
+        self.instances: Sequence[GoldInstance] = []
 
     def load(self):
-        self.instances = load_ner_gold(self.jsonl_path)
+        if self.lazy:
+            self.instances = JSONLInstances(self.jsonl_path)
+        elif self.cache:
+            self.instances = load_ner_gold_cached(self.jsonl_path)
+        else:
+            self.instances = load_ner_gold(self.jsonl_path)
+
+    def texts(self) -> Iterator:
+        """The instances' text_id and text, without decoding lazy instances' entities"""
+        if self.lazy:
+            return self.instances.texts()
+        return iter(self.instances)
 
     def get_instances(self) -> List[GoldInstance]:
+        if self.lazy:
+            instances = list(self.instances)
+            shuffle(instances)
+            return instances
         shuffle(self.instances)
         return self.instances
 
@@ -0,0 +1,102 @@
+import asyncio
+import concurrent.futures
+import threading
+from typing import Any, Dict, Iterable, List, Tuple
+
+from cache import make_cache_key
+
+
+def dedupe_instances(instances: Iterable[Any]) -> Tuple[List[Any], Dict[int, List[int]]]:
+    """
+    Keep the first instance of every distinct text.
+
+    Returns:
+        (unique instances in original order, representative text_id → text_ids of its duplicates)
+    """
+    first_by_text = {}
+    unique = []
+    duplicates = {}
+    for inst in instances:
+        representative = first_by_text.get(inst.text)
+        if representative is None:
+            first_by_text[inst.text] = inst
+            unique.append(inst)
+        else:
+            duplicates.setdefault(representative.text_id, []).append(inst.text_id)
+    return unique, duplicates
+
+
+class _OwnerCancelled(Exception):
+    """The caller that sent a shared request was cancelled before it completed"""
+
+
+# Requests currently in flight anywhere in the process: cache key → Future of (response, latency, timing)
+_inflight: Dict[str, concurrent.futures.Future] = {}
+_inflight_lock = threading.Lock()
+
+
+class CoalescingClient:
+    """
+    Collapses identical concurrent requests into one model call, across every run in
+    the process (including runs on other threads / event loops).
+
+    Requests are identical when their fingerprints (model, rendered messages, parameters)
+    match. The first caller sends the request; later callers wait for its result.
+    With bypass=True (intentional stochastic repeats) every request is sent.
+    """
+    def __init__(self, client, bypass: bool = False):
+        self.client = client
+        self.bypass = bypass
+        self.coalesced = 0
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    async def agenerate_completion(self, system_prompt: str, user_prompt: str, timing: Dict[str, Any] = None):
+        if self.bypass:
+            return await self.client.agenerate_completion(system_prompt, user_prompt, timing=timing)
+
+        key = make_cache_key(self.client.request_fingerprint(system_prompt, user_prompt))
+        with _inflight_lock:
+            shared = _inflight.get(key)
+            if shared is None:
+                owned = _inflight[key] = concurrent.futures.Future()
+
+        if shared is not None:
+            try:
+                response, latency, shared_timing = await asyncio.wrap_future(shared)
+            except _OwnerCancelled:
+                return await self.client.agenerate_completion(system_prompt, user_prompt, timing=timing)
+            self.coalesced += 1
+            if timing is not None:
+                timing.update(shared_timing)
+                timing["coalesced"] = True
+            return response, latency
+
+        request_timing = {}
+        try:
+            response, latency = await self.client.agenerate_completion(system_prompt, user_prompt, timing=request_timing)
+            owned.set_result((response, latency, request_timing))
+            return response, latency
+        except Exception as e:
+            owned.set_exception(e)
+            raise
+        except BaseException:
+            owned.set_exception(_OwnerCancelled())
+            raise
+        finally:
+            with _inflight_lock:
+                del _inflight[key]
+            if timing is not None:
+                timing.update(request_timing)
+
+    async def astream_completion(self, system_prompt: str, user_prompt: str, timing: Dict[str, Any] = None):
+        """Streams are passed through; coalescing applies to whole responses"""
+        async for chunk in self.client.astream_completion(system_prompt, user_prompt, timing=timing):
+            yield chunk
+
+    async def aclose(self):
+        await self.client.aclose()
+
+    def stats(self) -> Dict[str, int]:
+        return {"coalesced_requests": self.coalesced}
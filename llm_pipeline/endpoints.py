@@ -0,0 +1,213 @@
+import json
+import statistics
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Tuple
+
+from models import APIError
+from ratelimit import RateLimiter, get_rate_limiter, request_tokens
+
+
+@dataclass
+class Endpoint:
+    """One deployment of the model, with the routing state kept for it"""
+    url: str
+    api_key: str
+    name: str = None
+    outstanding: int = 0
+    ewma_latency: float = None
+    requests: int = 0
+    errors: int = 0
+    consecutive_errors: int = 0
+    ejections: int = 0
+    ejected_until: float = 0.0
+    limiter: RateLimiter = None
+
+    def to_record(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "requests": self.requests,
+            "errors": self.errors,
+            "ewma_latency_sec": self.ewma_latency,
+            "ejections": self.ejections,
+        }
+
+
+def load_endpoint_list(path: Path) -> List[Tuple[str, str]]:
+    """Read [{"endpoint": ..., "api_key": ...}, ...] from a JSON file"""
+    with open(path, "r", encoding="utf-8") as f:
+        entries = json.load(f)
+    return [(e["endpoint"], e["api_key"]) for e in entries]
+
+
+class EndpointPool:
+    """
+    Routes requests across replicas of the same model.
+
+    strategy "least_outstanding" picks the endpoint with the fewest requests in flight,
+    "ewma" the one with the lowest expected wait (EWMA latency × (outstanding + 1)).
+    An endpoint is ejected for eject_sec after eject_after consecutive errors, or when
+    its EWMA latency exceeds slow_factor × the median of its peers. If every endpoint
+    is ejected, the one due back soonest is used.
+
+    Each endpoint has its own rate limiter (requests_per_min / tokens_per_min, shared
+    per URL in the process), paused when that endpoint answers 429; paused endpoints
+    are passed over while another one is available.
+    """
+    def __init__(self, endpoints: List[Tuple[str, str]], strategy: str = "least_outstanding", ewma_alpha: float = 0.3,
+                 eject_after: int = 3, eject_sec: float = 30.0, slow_factor: float = 3.0, min_samples: int = 5,
+                 requests_per_min: float = None, tokens_per_min: float = None):
+        if strategy not in ("least_outstanding", "ewma"):
+            raise ValueError(f"Unknown balancing strategy: {strategy}")
+        self.endpoints = [
+            Endpoint(url, key, name=f"endpoint_{i}", limiter=get_rate_limiter(url, requests_per_min, tokens_per_min))
+            for i, (url, key) in enumerate(endpoints)
+        ]
+        self.strategy = strategy
+        self.ewma_alpha = ewma_alpha
+        self.eject_after = eject_after
+        self.eject_sec = eject_sec
+        self.slow_factor = slow_factor
+        self.min_samples = min_samples
+        self._lock = threading.Lock()
+
+    def _cost(self, endpoint: Endpoint) -> float:
+        if self.strategy == "ewma":
+            # Unmeasured endpoints are tried first
+            return (endpoint.ewma_latency or 0.0) * (endpoint.outstanding + 1)
+        return endpoint.outstanding
+
+    def acquire(self) -> Endpoint:
+        """Pick an endpoint and count the request as outstanding on it"""
+        with self._lock:
+            now = time.monotonic()
+            healthy = [e for e in self.endpoints if e.ejected_until <= now]
+            if healthy:
+                # Throttled endpoints only when all are, the one resuming soonest first
+                endpoint = min(healthy, key=lambda e: (e.limiter.paused_for(), self._cost(e), e.requests))
+            else:
+                endpoint = min(self.endpoints, key=lambda e: e.ejected_until)
+            endpoint.outstanding += 1
+            endpoint.requests += 1
+            return endpoint
+
+    def release(self, endpoint: Endpoint, latency: float = None, error: bool = False):
+        """Record the outcome of a request sent to endpoint"""
+        with self._lock:
+            endpoint.outstanding -= 1
+            if error:
+                endpoint.errors += 1
+                endpoint.consecutive_errors += 1
+                if endpoint.consecutive_errors >= self.eject_after:
+                    self._eject(endpoint)
+                return
+
+            endpoint.consecutive_errors = 0
+            if latency is not None:
+                if endpoint.ewma_latency is None:
+                    endpoint.ewma_latency = latency
+                else:
+                    endpoint.ewma_latency = self.ewma_alpha * latency + (1 - self.ewma_alpha) * endpoint.ewma_latency
+                self._check_slow(endpoint)
+
+    def _check_slow(self, endpoint: Endpoint):
+        peers = [e.ewma_latency for e in self.endpoints
+                 if e is not endpoint and e.ewma_latency is not None and e.requests >= self.min_samples]
+        if not peers or endpoint.requests < self.min_samples:
+            return
+        if endpoint.ewma_latency > self.slow_factor * statistics.median(peers):
+            self._eject(endpoint)
+
+    def _eject(self, endpoint: Endpoint):
+        if endpoint.ejected_until > time.monotonic() or len(self.endpoints) == 1:
+            return
+        endpoint.ejected_until = time.monotonic() + self.eject_sec
+        endpoint.ejections += 1
+        endpoint.consecutive_errors = 0
+        print(f"[Warning] Ejecting {endpoint.name} for {self.eject_sec:.0f}s")
+
+    def stats(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [e.to_record() for e in self.endpoints]
+
+
+def is_endpoint_fault(error: BaseException) -> bool:
+    """Errors that say something about the endpoint's health (not cancellations or bad requests)"""
+    if isinstance(error, APIError):
+        return error.status >= 500 or error.status in (408, 429)
+    return isinstance(error, Exception)
+
+
+class BalancedClient:
+    """
+    Model client that spreads requests over an EndpointPool, holding one underlying
+    client (any registered backend) per endpoint. Each request first waits for its
+    endpoint's rate limiter; errors carry that limiter so a 429 pauses only that replica. Everything else (model name, parameters, request
+    fingerprint) comes from the first client, so cache keys do not depend on routing.
+    """
+    def __init__(self, pool: EndpointPool, client_factory: Callable[[str, str], Any]):
+        self.pool = pool
+        self.clients = {id(e): client_factory(e.url, e.api_key) for e in pool.endpoints}
+        self.client = self.clients[id(pool.endpoints[0])]
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def _failed(self, endpoint: Endpoint, error: BaseException):
+        if isinstance(error, APIError):
+            error.limiter = endpoint.limiter
+        self.pool.release(endpoint, error=is_endpoint_fault(error))
+
+    def generate_completion(self, system_prompt: str, user_prompt: str, timing: Dict[str, Any] = None):
+        endpoint = self.pool.acquire()
+        client = self.clients[id(endpoint)]
+        try:
+            endpoint.limiter.acquire(request_tokens(client, system_prompt, user_prompt))
+            response, latency = client.generate_completion(system_prompt, user_prompt, timing=timing)
+        except Exception as e:
+            self._failed(endpoint, e)
+            raise
+        self.pool.release(endpoint, latency)
+        if timing is not None:
+            timing["endpoint"] = endpoint.name
+        return response, latency
+
+    async def agenerate_completion(self, system_prompt: str, user_prompt: str, timing: Dict[str, Any] = None):
+        endpoint = self.pool.acquire()
+        client = self.clients[id(endpoint)]
+        try:
+            await endpoint.limiter.aacquire(request_tokens(client, system_prompt, user_prompt))
+            response, latency = await client.agenerate_completion(system_prompt, user_prompt, timing=timing)
+        except BaseException as e:
+            # Clients only pass a cancellation on once the request is over (see
+            # models.run_in_thread), so the endpoint is never released while it is busy
+            self._failed(endpoint, e)
+            raise
+        self.pool.release(endpoint, latency)
+        if timing is not None:
+            timing["endpoint"] = endpoint.name
+        return response, latency
+
+    async def astream_completion(self, system_prompt: str, user_prompt: str, timing: Dict[str, Any] = None):
+        endpoint = self.pool.acquire()
+        client = self.clients[id(endpoint)]
+        try:
+            await endpoint.limiter.aacquire(request_tokens(client, system_prompt, user_prompt))
+            start_time = time.time()
+            async for chunk in client.astream_completion(system_prompt, user_prompt, timing=timing):
+                yield chunk
+        except BaseException as e:
+            self._failed(endpoint, e)
+            raise
+        self.pool.release(endpoint, time.time() - start_time)
+        if timing is not None:
+            timing["endpoint"] = endpoint.name
+
+    async def aclose(self):
+        for client in self.clients.values():
+            await client.aclose()
+
+    def stats(self) -> Dict[str, Any]:
+        return {"endpoints": self.pool.stats()}
@@ -1,247 +1,436 @@
-from collections import defaultdict
-from typing import List, Dict, Tuple, Any, Union
+import argparse
+import csv
+import itertools
+import json
+from pathlib import Path
+from typing import List, Dict, Tuple, Any, Union, Iterable, Iterator, Mapping, Optional
+import numpy as np
 import pandas as pd
 
-class Evaluator:
+from assignment import one_to_one
+from dataclass import Entity, GoldEntity, label_id, label_name
+from similarity import edit_similarity, normalise_text
 
-    def __init__(self, dataset, labels_to_consider: List[str] = None):
-        self.dataset = dataset
-        self.labels_to_consider = set(labels_to_consider) if labels_to_consider else None
+BUCKETS = ("0-29", "30-69", "70-99", "100")
 
-    def _extract_label_text(self, e: Union[Dict[str, Any], Any]) -> Tuple[str, str]:
-        label = e["label"] if isinstance(e, dict) else e.label
-        if isinstance(e, dict):
-            text = e.get("raw_text") or e.get("text") or e.get("clean_text", "")
-        else:
-            text = getattr(e, "raw_text", None) or getattr(e, "text", None) or getattr(e, "clean_text", "")
-        return label, text
-
-    def _compute_partial_overlap(self, gold_text: str, pred_text: str) -> float:
-        set_gold = set(gold_text) if gold_text else set()
-        set_pred = set(pred_text) if pred_text else set()
-        if not set_gold:
-            return 0.0
-        intersection = len(set_gold.intersection(set_pred))
-        return intersection / len(set_gold)
-
-    def _compute_exact_metrics(
-        self,
-        gold_entities: List[Dict[str, Any]],
-        pred_entities: List[Dict[str, Any]]
-    ) -> Tuple[float, float, float]:
-        gold_set = {(self._extract_label_text(e)) for e in gold_entities}
-        pred_set = {(self._extract_label_text(e)) for e in pred_entities}
-        tp = len(gold_set & pred_set)
-        fp = len(pred_set - gold_set)
-        fn = len(gold_set - pred_set)
-        precision = tp / (tp + fp) if (tp + fp) > 0 else 0.0
-        recall = tp / (tp + fn) if (tp + fn) > 0 else 0.0
-        f1 = (2 * precision * recall) / (precision + recall) if (precision + recall) > 0 else 0.0
-        return precision, recall, f1
-
-    def _compute_partial_metrics(
-        self,
-        gold_entities: List[Dict[str, Any]],
-        pred_entities: List[Dict[str, Any]]
-    ) -> Tuple[float, float, float]:
-
-        gold_set = {(self._extract_label_text(e)) for e in gold_entities}
-        pred_set = {(self._extract_label_text(e)) for e in pred_entities}
-
-        precision_scores = []
-        for p_label, p_text in pred_set:
-            best_overlap = 0.0
-            for g_label, g_text in gold_set:
-                if g_label == p_label:
-                    overlap = self._compute_partial_overlap(g_text, p_text)
-                    if overlap > best_overlap:
-                        best_overlap = overlap
-            precision_scores.append(best_overlap)
-        precision = sum(precision_scores) / len(precision_scores) if precision_scores else 0.0
-
-        recall_scores = []
-        for g_label, g_text in gold_set:
-            best_overlap = 0.0
-            for p_label, p_text in pred_set:
-                if p_label == g_label:
-                    overlap = self._compute_partial_overlap(g_text, p_text)
-                    if overlap > best_overlap:
-                        best_overlap = overlap
-            recall_scores.append(best_overlap)
-        recall = sum(recall_scores) / len(recall_scores) if recall_scores else 0.0
-
-        f1 = (2 * precision * recall) / (precision + recall) if (precision + recall) > 0 else 0.0
-        return precision, recall, f1
+# Pair scorers: "overlap" is the partial_* metric; the others are reported as <scorer>_precision/_recall/_f1
+SCORERS = ("overlap", "edit", "normalised_exact")
 
-    def evaluate(
-        self,
-        predictions: Dict[Union[str, int], List[Dict[str, Any]]],
-    ) -> Dict[str, Any]:
+# How soft scores pair entities: one-to-one ("assignment") or each entity's best pair ("best")
+MATCHINGS = ("assignment", "best")
 
-        micro_tp = 0
-        micro_fp = 0
-        micro_fn = 0
-        per_label_counts = defaultdict(lambda: {
-            "tp": 0, "fp": 0, "fn": 0,
-            "partial_tp": 0.0, "partial_fp": 0.0, "partial_fn": 0.0
-        })
-        per_instance_results = []
-
-        precision_bucket_counts = {"0-29": 0, "30-69": 0, "70-99": 0, "100": 0}
-        recall_bucket_counts = {"0-29": 0, "30-69": 0, "70-99": 0, "100": 0}
-
-        for instance in self.dataset.instances:
-            gold_entities = instance.entities
-            pred_entities = predictions.get(str(instance.text_id), predictions.get(instance.text_id, []))
-
-            if self.labels_to_consider:
-                gold_entities = [e for e in gold_entities if self._extract_label_text(e)[0] in self.labels_to_consider]
-                pred_entities = [e for e in pred_entities if self._extract_label_text(e)[0] in self.labels_to_consider]
-
-            # Exact metrics for micro counts
-            exact_precision, exact_recall, exact_f1 = self._compute_exact_metrics(gold_entities, pred_entities)
-
-            # Partial metrics for reporting
-            partial_precision, partial_recall, partial_f1 = self._compute_partial_metrics(gold_entities, pred_entities)
-
-            # Update micro counts with exact matching only
-            gold_set = {(self._extract_label_text(e)) for e in gold_entities}
-            pred_set = {(self._extract_label_text(e)) for e in pred_entities}
-
-            tp = len(gold_set & pred_set)
-            fp = len(pred_set - gold_set)
-            fn = len(gold_set - pred_set)
-
-            micro_tp += tp
-            micro_fp += fp
-            micro_fn += fn
-
-            # Calculate per-label exact and partial TP/FP/FN
-            all_labels = {label for label, _ in gold_set.union(pred_set)}
-            for label in all_labels:
-                gold_label_entities = [(l, t) for (l, t) in gold_set if l == label]
-                pred_label_entities = [(l, t) for (l, t) in pred_set if l == label]
-
-                # Exact TP/FP/FN
-                gold_label_set = set(t for _, t in gold_label_entities)
-                pred_label_set = set(t for _, t in pred_label_entities)
-                label_tp = len(gold_label_set & pred_label_set)
-                label_fp = len(pred_label_set - gold_label_set)
-                label_fn = len(gold_label_set - pred_label_set)
-
-                # Partial TP: sum of best partial overlaps per predicted entity
-                partial_tp_sum = 0.0
-                for p_label, p_text in pred_label_entities:
-                    best_overlap = 0.0
-                    for g_label, g_text in gold_label_entities:
-                        overlap = self._compute_partial_overlap(g_text, p_text)
-                        if overlap > best_overlap:
-                            best_overlap = overlap
-                    partial_tp_sum += best_overlap
-
-                # Partial FP: predicted entities that have zero overlap
-                partial_fp_sum = 0.0
-                for p_label, p_text in pred_label_entities:
-                    best_overlap = 0.0
-                    for g_label, g_text in gold_label_entities:
-                        overlap = self._compute_partial_overlap(g_text, p_text)
-                        if overlap > best_overlap:
-                            best_overlap = overlap
-                    if best_overlap == 0.0:
-                        partial_fp_sum += 1.0  # fully wrong prediction counts as FP
-
-                # Partial FN: gold entities that were not well matched by any predicted entity
-                partial_fn_sum = 0.0
-                for g_label, g_text in gold_label_entities:
-                    best_overlap = 0.0
-                    for p_label, p_text in pred_label_entities:
-                        overlap = self._compute_partial_overlap(g_text, p_text)
-                        if overlap > best_overlap:
-                            best_overlap = overlap
-                    if best_overlap == 0.0:
-                        partial_fn_sum += 1.0  # fully missed gold entity counts as FN
-
-                per_label_counts[label]["tp"] += label_tp
-                per_label_counts[label]["fp"] += label_fp
-                per_label_counts[label]["fn"] += label_fn
-                per_label_counts[label]["partial_tp"] += partial_tp_sum
-                per_label_counts[label]["partial_fp"] += partial_fp_sum
-                per_label_counts[label]["partial_fn"] += partial_fn_sum
-
-            # Buckets based on exact precision/recall
-            if exact_precision == 1.0:
-                precision_bucket_counts["100"] += 1
-            elif exact_precision >= 0.7:
-                precision_bucket_counts["70-99"] += 1
-            elif exact_precision >= 0.3:
-                precision_bucket_counts["30-69"] += 1
-            else:
-                precision_bucket_counts["0-29"] += 1
-
-            if exact_recall == 1.0:
-                recall_bucket_counts["100"] += 1
-            elif exact_recall >= 0.7:
-                recall_bucket_counts["70-99"] += 1
-            elif exact_recall >= 0.3:
-                recall_bucket_counts["30-69"] += 1
+# Prediction records read ahead while looking for a gold instance's record
+RECORD_WINDOW = 1000
+
+# Entity labels scored by Main.run and replay
+EVAL_LABELS = [
+    "name", "email", "date", "phone_number",
+    "organisation", "salutation", "relationship",
+    "country", "airport_code", "id", "plate"
+]
+
+
+def _f1(precision: np.ndarray, recall: np.ndarray) -> np.ndarray:
+    total = precision + recall
+    return np.divide(2 * precision * recall, total, out=np.zeros(len(total)), where=total > 0)
+
+
+class Evaluator:
+
+    def __init__(self, dataset, labels_to_consider: List[str] = None,
+                 scorers: Tuple[str, ...] = ("edit", "normalised_exact"), edit_threshold: float = 0.5,
+                 matching: str = "assignment"):
+        """
+        scorers: similarity measures reported next to exact and partial (character-overlap)
+            matching: "edit" (1 - normalised edit distance) and/or "normalised_exact"
+            (exact up to case and whitespace).
+        edit_threshold: edit similarity below which a pair counts as no match.
+        matching: "assignment" scores each gold and predicted entity by at most one
+            counterpart (the highest-scoring one-to-one matching); "best" lets every
+            entity take its best pair, so one prediction can cover several gold entities.
+        """
+        unknown = set(scorers) - set(SCORERS)
+        if unknown:
+            raise ValueError(f"Unknown scorer(s) {sorted(unknown)}; available: {', '.join(SCORERS)}")
+        if matching not in MATCHINGS:
+            raise ValueError(f"Unknown matching '{matching}'; available: {', '.join(MATCHINGS)}")
+        self.dataset = dataset
+        self.labels_to_consider = {label_id(label) for label in labels_to_consider} if labels_to_consider else None
+        self.scorers = [scorer for scorer in scorers if scorer != "overlap"]
+        self.edit_threshold = edit_threshold
+        self.matching = matching
+
+    def _extract_label_text(self, e: Union[Dict[str, Any], Any]) -> Tuple[int, str]:
+        """(interned label id, text) of an entity record or dict"""
+        if isinstance(e, Entity):
+            return e.label_id, e.clean_text
+        if isinstance(e, GoldEntity):
+            return e.label_id, e.raw_text or e.clean_text
+        if isinstance(e, dict):
+            return label_id(e["label"]), e.get("raw_text") or e.get("text") or e.get("clean_text", "")
+        return label_id(e.label), getattr(e, "raw_text", None) or getattr(e, "text", None) or getattr(e, "clean_text", "")
+
+    def _entity_rows(self, scored: List[Tuple[Any, List[Any]]], labels: Dict[int, int]):
+        """
+        Flatten the distinct (label, text) gold and predicted entities of each
+        (instance, predicted entities) into (instance index, label id, text id) arrays,
+        interning texts. Labels are numbered through labels (interned label id → row),
+        new ones in order of first appearance.
+        """
+        texts: Dict[str, int] = {}
+        gold = ([], [], [])
+        pred = ([], [], [])
+        extract = self._extract_label_text
+        consider = self.labels_to_consider
+        for i, (instance, pred_entities) in enumerate(scored):
+            for (instance_ids, label_ids, text_ids), entities in ((gold, instance.entities), (pred, pred_entities)):
+                seen = set()
+                for e in entities:
+                    key = extract(e)
+                    if key in seen or (consider and key[0] not in consider):
+                        continue
+                    seen.add(key)
+                    instance_ids.append(i)
+                    label_ids.append(labels.setdefault(key[0], len(labels)))
+                    text_ids.append(texts.setdefault(key[1], len(texts)))
+        gold = tuple(np.array(column, dtype=np.int64) for column in gold)
+        pred = tuple(np.array(column, dtype=np.int64) for column in pred)
+        return gold, pred, list(texts)
+
+    @staticmethod
+    def _char_masks(texts: List[str]) -> np.ndarray:
+        """The set of characters of each text as a bitmask (a row of uint64 words per text)"""
+        texts = [str(t) if t else "" for t in texts]
+        lengths = np.fromiter(map(len, texts), dtype=np.int64, count=len(texts))
+        codepoints = np.frombuffer("".join(texts).encode("utf-32-le", "surrogatepass"), dtype=np.uint32)
+        vocab, char_ids = np.unique(codepoints, return_inverse=True)
+        masks = np.zeros((len(texts), max(1, -(-len(vocab) // 64))), dtype=np.uint64)
+        owner = np.repeat(np.arange(len(texts)), lengths)
+        bits = np.left_shift(np.uint64(1), (char_ids % 64).astype(np.uint64))
+        np.bitwise_or.at(masks, (owner, char_ids // 64), bits)
+        return masks
+
+    def _overlap_scores(self, texts: List[str], gold_text: np.ndarray, pred_text: np.ndarray) -> np.ndarray:
+        """Share of the gold text's distinct characters that appear in the prediction"""
+        masks = self._char_masks(texts)
+        char_counts = np.bitwise_count(masks).sum(axis=1, dtype=np.int64)
+        shared = np.bitwise_count(masks[gold_text] & masks[pred_text]).sum(axis=1, dtype=np.int64)
+        gold_chars = char_counts[gold_text]
+        return np.divide(shared, gold_chars, out=np.zeros(len(shared)), where=gold_chars > 0)
+
+    def _edit_scores(self, texts: List[str], gold_text: np.ndarray, pred_text: np.ndarray) -> np.ndarray:
+        """Normalised edit similarity, computed once per distinct (gold text, predicted text)"""
+        num_texts = max(1, len(texts))
+        pairs, inverse = np.unique(gold_text * num_texts + pred_text, return_inverse=True)
+        scores = np.array([
+            edit_similarity(texts[pair // num_texts], texts[pair % num_texts], self.edit_threshold)
+            for pair in pairs.tolist()
+        ], dtype=np.float64)
+        return scores[inverse]
+
+    def _normalised_exact_scores(self, texts: List[str], gold_text: np.ndarray, pred_text: np.ndarray) -> np.ndarray:
+        """1.0 where the texts are equal ignoring case and whitespace"""
+        keys: Dict[str, int] = {}
+        normalised = np.array([keys.setdefault(normalise_text(text), len(keys)) for text in texts], dtype=np.int64)
+        return (normalised[gold_text] == normalised[pred_text]).astype(np.float64)
+
+    @staticmethod
+    def _same_label_pairs(gold_key: np.ndarray, pred_key: np.ndarray):
+        """
+        Indices (gold row, pred row) of every gold/pred pair that shares an (instance, label)
+        key, grouped by key and gold-major within a group, plus each group's first pair and
+        its gold and pred counts.
+        """
+        gold_order = np.argsort(gold_key, kind="stable")
+        pred_order = np.argsort(pred_key, kind="stable")
+        gold_sorted = gold_key[gold_order]
+        pred_sorted = pred_key[pred_order]
+        common = np.intersect1d(gold_sorted, pred_sorted)
+        gold_start = np.searchsorted(gold_sorted, common, "left")
+        gold_count = np.searchsorted(gold_sorted, common, "right") - gold_start
+        pred_start = np.searchsorted(pred_sorted, common, "left")
+        pred_count = np.searchsorted(pred_sorted, common, "right") - pred_start
+
+        pair_count = gold_count * pred_count
+        group = np.repeat(np.arange(len(common)), pair_count)
+        within = np.arange(pair_count.sum()) - np.repeat(np.cumsum(pair_count) - pair_count, pair_count)
+        gold_index = gold_order[gold_start[group] + within // pred_count[group]]
+        pred_index = pred_order[pred_start[group] + within % pred_count[group]]
+        return gold_index, pred_index, np.cumsum(pair_count) - pair_count, gold_count, pred_count
+
+    @staticmethod
+    def _prf(tp: np.ndarray, fp: np.ndarray, fn: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        precision = np.divide(tp, tp + fp, out=np.zeros(len(tp)), where=(tp + fp) > 0)
+        recall = np.divide(tp, tp + fn, out=np.zeros(len(tp)), where=(tp + fn) > 0)
+        return precision, recall, _f1(precision, recall)
+
+    @staticmethod
+    def _buckets(scores: np.ndarray) -> Dict[str, int]:
+        """Instance counts per exact precision/recall bucket"""
+        bucket = np.select([scores == 1.0, scores >= 0.7, scores >= 0.3], [3, 2, 1], 0)
+        counts = np.bincount(bucket, minlength=len(BUCKETS))
+        return {name: int(count) for name, count in zip(BUCKETS, counts)}
+
+    @staticmethod
+    def _paired(instances: Iterable[Any], predictions: Union[Mapping, Iterable[Tuple[Any, List[Any]]]]):
+        """
+        (instance, predicted entities) for each gold instance. predictions is a mapping
+        text_id → entities, or (text_id, entities) records in the gold instances' order;
+        instances without a record get no predictions.
+
+        Records are looked up among the next RECORD_WINDOW not yet matched, so local
+        reordering is tolerated. Records left unmatched (too far out of order, or with
+        no gold instance) raise ValueError once the instances are exhausted.
+        """
+        if isinstance(predictions, Mapping):
+            for instance in instances:
+                yield instance, predictions.get(str(instance.text_id), predictions.get(instance.text_id, []))
+            return
+        records = iter(predictions)
+        ahead: Dict[str, List[Any]] = {}
+        for instance in instances:
+            key = str(instance.text_id)
+            while key not in ahead and len(ahead) < RECORD_WINDOW:
+                record = next(records, None)
+                if record is None:
+                    break
+                ahead[str(record[0])] = record[1]
+            yield instance, ahead.pop(key, [])
+        unmatched = list(itertools.islice(itertools.chain(ahead, (str(record[0]) for record in records)), 5))
+        if unmatched:
+            raise ValueError(
+                f"Prediction records out of gold order (beyond {RECORD_WINDOW} records) or without a gold "
+                f"instance, e.g. text_id {', '.join(unmatched)}"
+            )
+
+    def _score(self, scored: List[Tuple[Any, List[Any]]], labels: Dict[int, int]):
+        """
+        Score a list of (instance, predicted entities).
+
+        Returns:
+            (per-instance metric columns, per-label sums over these instances: exact
+             tp/fp/fn and each scorer's <prefix>_tp/_fp/_fn, indexed by label id)
+        """
+        (gold_inst, gold_label, gold_text), (pred_inst, pred_label, pred_text), texts = self._entity_rows(scored, labels)
+        num_instances = len(scored)
+        num_labels = len(labels)
+
+        gold_index, pred_index, group_start, gold_count, pred_count = self._same_label_pairs(gold_inst * num_labels + gold_label, pred_inst * num_labels + pred_label)
+        pair_gold_text = gold_text[gold_index]
+        pair_pred_text = pred_text[pred_index]
+        exact = gold_index[pair_gold_text == pair_pred_text]
+        num_gold = np.bincount(gold_inst, minlength=num_instances)
+        num_pred = np.bincount(pred_inst, minlength=num_instances)
+
+        def matched_scores(pair_score: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+            """Score of each predicted and each gold entity under the matching (0.0 if unmatched)"""
+            pred_best = np.zeros(len(pred_inst))
+            gold_best = np.zeros(len(gold_inst))
+            if self.matching == "assignment":
+                matched = one_to_one(pair_score, group_start, gold_count, pred_count)
+                pred_best[pred_index[matched]] = pair_score[matched]
+                gold_best[gold_index[matched]] = pair_score[matched]
             else:
-                recall_bucket_counts["0-29"] += 1
-
-            per_instance_results.append({
-                "text_id": instance.text_id,
-                "precision": exact_precision,
-                "recall": exact_recall,
-                "f1": exact_f1,
-                "partial_precision": partial_precision,
-                "partial_recall": partial_recall,
-                "partial_f1": partial_f1
+                np.maximum.at(pred_best, pred_index, pair_score)
+                np.maximum.at(gold_best, gold_index, pair_score)
+            return pred_best, gold_best
+
+        # Per instance: exact counts, then each scorer's mean score of the predictions /
+        # gold entities (precision / recall)
+        tp = np.bincount(gold_inst[exact], minlength=num_instances)
+        exact_precision, exact_recall, exact_f1 = self._prf(tp, num_pred - tp, num_gold - tp)
+        instance_columns = {"precision": exact_precision, "recall": exact_recall, "f1": exact_f1}
+
+        # Per label: exact TP/FP/FN; a scorer's TP = summed scores of the predictions,
+        # FP / FN = predictions / gold entities scored 0
+        label_tp = np.bincount(gold_label[exact], minlength=num_labels)
+        label_sums = {
+            "tp": label_tp,
+            "fp": np.bincount(pred_label, minlength=num_labels) - label_tp,
+            "fn": np.bincount(gold_label, minlength=num_labels) - label_tp,
+        }
+
+        # Soft metrics per scorer: partial_* from character overlap, then the extra scorers
+        for scorer in ["overlap"] + self.scorers:
+            pair_score = getattr(self, f"_{scorer}_scores")(texts, pair_gold_text, pair_pred_text)
+            pred_best, gold_best = matched_scores(pair_score)
+            precision = np.divide(np.bincount(pred_inst, weights=pred_best, minlength=num_instances), num_pred,
+                                  out=np.zeros(num_instances), where=num_pred > 0)
+            recall = np.divide(np.bincount(gold_inst, weights=gold_best, minlength=num_instances), num_gold,
+                               out=np.zeros(num_instances), where=num_gold > 0)
+            prefix = "partial" if scorer == "overlap" else scorer
+            instance_columns.update({
+                f"{prefix}_precision": precision, f"{prefix}_recall": recall, f"{prefix}_f1": _f1(precision, recall)
             })
+            label_sums.update({
+                f"{prefix}_tp": np.bincount(pred_label, weights=pred_best, minlength=num_labels),
+                f"{prefix}_fp": np.bincount(pred_label, weights=pred_best == 0.0, minlength=num_labels),
+                f"{prefix}_fn": np.bincount(gold_label, weights=gold_best == 0.0, minlength=num_labels),
+            })
+        return instance_columns, label_sums
 
+    def _totals(self, labels: Dict[int, int], label_sums: Dict[str, np.ndarray],
+                precision_buckets: Dict[str, int], recall_buckets: Dict[str, int]) -> Dict[str, Any]:
+        """Micro and per-label metrics from the per-label sums"""
         # Micro metrics from exact counts only
+        micro_tp = int(label_sums["tp"].sum())
+        micro_fp = int(label_sums["fp"].sum())
+        micro_fn = int(label_sums["fn"].sum())
         micro_precision = micro_tp / (micro_tp + micro_fp) if (micro_tp + micro_fp) > 0 else 0.0
         micro_recall = micro_tp / (micro_tp + micro_fn) if (micro_tp + micro_fn) > 0 else 0.0
         micro_f1 = (2 * micro_precision * micro_recall) / (micro_precision + micro_recall) if (micro_precision + micro_recall) > 0 else 0.0
 
-        per_label_results = []
-        for label, counts in per_label_counts.items():
-            tp = counts["tp"]
-            fp = counts["fp"]
-            fn = counts["fn"]
-            precision = tp / (tp + fp) if (tp + fp) > 0 else 0.0
-            recall = tp / (tp + fn) if (tp + fn) > 0 else 0.0
-            f1 = (2 * precision * recall) / (precision + recall) if (precision + recall) > 0 else 0.0
-
-            partial_tp = counts["partial_tp"]
-            partial_fp = counts["partial_fp"]
-            partial_fn = counts["partial_fn"]
-            partial_precision = partial_tp / (partial_tp + partial_fp) if (partial_tp + partial_fp) > 0 else 0.0
-            partial_recall = partial_tp / (partial_tp + partial_fn) if (partial_tp + partial_fn) > 0 else 0.0
-            partial_f1 = (2 * partial_precision * partial_recall) / (partial_precision + partial_recall) if (partial_precision + partial_recall) > 0 else 0.0
-
-            per_label_results.append({
-                "label": label,
-                "precision": precision,
-                "recall": recall,
-                "f1": f1,
-                "partial_precision": partial_precision,
-                "partial_recall": partial_recall,
-                "partial_f1": partial_f1,
-                "tp": tp,
-                "fp": fp,
-                "fn": fn
-            })
-
+        # Per label: exact TP/FP/FN and the soft metrics of every scorer
+        label_precision, label_recall, label_f1 = self._prf(label_sums["tp"], label_sums["fp"], label_sums["fn"])
+        label_columns = {"precision": label_precision, "recall": label_recall, "f1": label_f1}
+        for scorer in ["overlap"] + self.scorers:
+            prefix = "partial" if scorer == "overlap" else scorer
+            precision, recall, f1 = self._prf(label_sums[f"{prefix}_tp"], label_sums[f"{prefix}_fp"], label_sums[f"{prefix}_fn"])
+            label_columns.update({f"{prefix}_precision": precision, f"{prefix}_recall": recall, f"{prefix}_f1": f1})
+        label_columns.update({"tp": label_sums["tp"], "fp": label_sums["fp"], "fn": label_sums["fn"]})
+
+        label_values = [column.tolist() for column in label_columns.values()]
+        per_label_results = [
+            {"label": label, **dict(zip(label_columns, row))}
+            for label, row in zip(map(label_name, labels), zip(*label_values))
+        ]
         return {
             "micro_precision": micro_precision,
             "micro_recall": micro_recall,
             "micro_f1": micro_f1,
-            "per_instance": per_instance_results,
             "per_label": per_label_results,
-            "per_instance_precision_buckets": precision_bucket_counts,
-            "per_instance_recall_buckets": recall_bucket_counts
+            "per_instance_precision_buckets": precision_buckets,
+            "per_instance_recall_buckets": recall_buckets
         }
 
+    def evaluate(
+        self,
+        predictions: Dict[Union[str, int], List[Dict[str, Any]]],
+    ) -> Dict[str, Any]:
+        """
+        Exact, partial (character-overlap) and extra scorers' metrics per instance, per
+        label and overall.
+
+        Each instance's gold and predicted entities are compared as sets of (label, text).
+        A gold/pred pair of the same label overlaps by the share of the gold text's
+        distinct characters that appear in the prediction; the extra scorers score the
+        same pairs by edit similarity or case/whitespace-insensitive equality. Each
+        scorer's precision/recall average the predictions'/gold entities' scores under
+        the matching: with "assignment", the one-to-one pairing of the label's entities
+        with the highest total score (see assignment.one_to_one); with "best", each
+        entity's best pair.
+        """
+        scored = list(self._paired(self.dataset.instances, predictions))
+        labels: Dict[int, int] = {}
+        instance_columns, label_sums = self._score(scored, labels)
+
+        instance_values = [column.tolist() for column in instance_columns.values()]
+        per_instance_results = [
+            {"text_id": instance.text_id, **dict(zip(instance_columns, row))}
+            for (instance, _), row in zip(scored, zip(*instance_values))
+        ]
+        results = self._totals(labels, label_sums, self._buckets(instance_columns["precision"]),
+                               self._buckets(instance_columns["recall"]))
+        return {**results, "per_instance": per_instance_results}
+
+    def evaluate_stream(
+        self,
+        instances: Iterable[Any],
+        predictions: Union[Mapping, Iterable[Tuple[Any, List[Any]]]],
+        per_instance_path: Path,
+        extra_columns: Optional[Dict[str, Mapping]] = None,
+        chunk_size: int = 10000,
+    ) -> Dict[str, Any]:
+        """
+        evaluate() in bounded memory: gold instances (e.g. dataset_load.iter_ner_gold) and
+        predictions (a mapping, or (text_id, entities) records in gold order, e.g.
+        iter_prediction_records) are consumed chunk_size instances at a time, per-label
+        sums and bucket counts accumulated, and per-instance rows appended to
+        per_instance_path as each chunk is scored.
+
+        extra_columns: column name → (text_id → value) mappings added to the per-instance rows.
+
+        Returns:
+            evaluate()'s results without "per_instance"
+        """
+        extra_columns = extra_columns or {}
+        labels: Dict[int, int] = {}
+        # Scoring no instances gives the columns and empty per-label sums
+        columns, totals = self._score([], labels)
+        precision_buckets = dict.fromkeys(BUCKETS, 0)
+        recall_buckets = dict.fromkeys(BUCKETS, 0)
+        paired = self._paired(instances, predictions)
+        with open(per_instance_path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(["text_id", *columns, *extra_columns])
+            while True:
+                scored = list(itertools.islice(paired, chunk_size))
+                if not scored:
+                    break
+                instance_columns, label_sums = self._score(scored, labels)
+                for name, sums in label_sums.items():
+                    # Labels first seen in this chunk extend the accumulators
+                    totals[name] = np.pad(totals[name], (0, len(sums) - len(totals[name]))) + sums
+                for name, count in self._buckets(instance_columns["precision"]).items():
+                    precision_buckets[name] += count
+                for name, count in self._buckets(instance_columns["recall"]).items():
+                    recall_buckets[name] += count
+
+                text_ids = [instance.text_id for instance, _ in scored]
+                columns = [text_ids, *(column.tolist() for column in instance_columns.values()),
+                           *([values.get(text_id) for text_id in text_ids] for values in extra_columns.values())]
+                writer.writerows(zip(*columns))
+        return self._totals(labels, totals, precision_buckets, recall_buckets)
+
     def results_to_dataframe(self, results: Dict[str, Any]):
         df_instance = pd.DataFrame(results["per_instance"])
         df_label = pd.DataFrame(results["per_label"])
         return df_instance, df_label
+
+
+def iter_prediction_records(path: Path) -> Iterator[Tuple[Any, List[Any]]]:
+    """(text_id, entities) records of a JSONL predictions file ({"text_id", "entities"} per line), one line at a time"""
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                yield record["text_id"], record.get("entities", [])
+
+
+def load_predictions(path: Path) -> Union[Mapping, Iterator[Tuple[Any, List[Any]]]]:
+    """
+    Predictions for evaluate_stream: JSONL records (in gold order) are streamed; a
+    raw_predictions.json object (text_id → entities, in batch order) is loaded whole.
+    """
+    path = Path(path)
+    if path.suffix == ".jsonl":
+        return iter_prediction_records(path)
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Score predictions against a gold dataset in bounded memory")
+    parser.add_argument("--dataset_path", type=str, required=True, help="Gold JSONL dataset")
+    parser.add_argument("--predictions", type=str, required=True, help="JSONL of {text_id, entities} in dataset order, or a raw_predictions.json")
+    parser.add_argument("--output_dir", type=str, required=True, help="Where per_instance.csv, per_label.csv and metrics.json are written")
+    parser.add_argument("--chunk_size", type=int, default=10000, help="Instances scored at a time")
+    parser.add_argument("--matching", type=str, default="assignment", choices=MATCHINGS, help="How soft scores pair entities")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    from dataset_load import iter_ner_gold
+
+    args = parse_args()
+    output_dir = Path(args.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    evaluator = Evaluator(None, labels_to_consider=EVAL_LABELS, matching=args.matching)
+    results = evaluator.evaluate_stream(
+        iter_ner_gold(args.dataset_path), load_predictions(Path(args.predictions)),
+        output_dir / "per_instance.csv", chunk_size=args.chunk_size
+    )
+    pd.DataFrame(results.pop("per_label")).to_csv(output_dir / "per_label.csv", index=False)
+    with open(output_dir / "metrics.json", "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"Micro F1: {results['micro_f1']}")
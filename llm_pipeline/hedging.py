@@ -0,0 +1,176 @@
+import asyncio
+import math
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Dict
+
+from models import Extractor
+from tokens import estimate_tokens
+
+
+def parses_as_json(response) -> bool:
+    """Default validity check for a hedged response: the extractor finds JSON in it"""
+    try:
+        Extractor.parse_response(response)
+        return True
+    except Exception:
+        return False
+
+
+class HedgePolicy:
+    """
+    When to send a duplicate request: once the first has been outstanding longer than
+    the given percentile of the last `window` observed latencies. Until min_samples
+    latencies are known, initial_delay is used instead (no hedging when it is None).
+    """
+    def __init__(self, percentile: float = 0.95, min_samples: int = 10, window: int = 200, max_hedges: int = 1,
+                 initial_delay: float = None):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.max_hedges = max_hedges
+        self.initial_delay = initial_delay
+        self.latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def observe(self, latency: float):
+        with self._lock:
+            self.latencies.append(latency)
+
+    def delay(self) -> float:
+        """Seconds to wait before hedging, or None while there is too little history"""
+        with self._lock:
+            if len(self.latencies) < self.min_samples:
+                return self.initial_delay
+            ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, math.ceil(self.percentile * len(ordered)) - 1)]
+
+
+_shared_policies: Dict[str, HedgePolicy] = {}
+_shared_lock = threading.Lock()
+
+
+def get_hedge_policy(name: str, **settings) -> HedgePolicy:
+    """
+    Process-wide policy per model, so latency history carries over between runs;
+    settings apply on first creation
+    """
+    with _shared_lock:
+        if name not in _shared_policies:
+            _shared_policies[name] = HedgePolicy(**settings)
+        return _shared_policies[name]
+
+
+class HedgedClient:
+    """
+    Wraps a model client with request hedging.
+
+    If a batch has not returned after HedgePolicy.delay(), up to max_hedges duplicates
+    are sent (an EndpointPool underneath routes them to the least busy replica). The
+    first response that passes `validate` wins and the others are cancelled. Failed or
+    invalid responses do not win unless nothing better arrives.
+
+    Only clients whose requests stop when cancelled (ModelClient.cancellable) are
+    hedged; for others a cancelled duplicate would keep its connection and rate-limit
+    budget until it finished.
+
+    Wasted tokens are estimated as the prompt tokens of every losing request plus its
+    completion tokens; a cancelled request counts a full completion the size of the
+    winner's, since the server may already have generated it.
+    """
+    def __init__(self, client, policy: HedgePolicy = None, validate: Callable[[Any], bool] = parses_as_json):
+        self.client = client
+        self.policy = policy or HedgePolicy()
+        self.validate = validate
+        self.hedges_sent = 0
+        self.hedge_wins = 0
+        self.wasted_tokens = 0
+        self.enabled = self.policy.max_hedges >= 1 and getattr(client, "cancellable", False)
+        if self.policy.max_hedges >= 1 and not self.enabled:
+            print("[Warning] Hedging disabled: this backend cannot cancel a request in flight")
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    async def _attempt(self, system_prompt: str, user_prompt: str, timing: Dict[str, Any]):
+        result = await self.client.agenerate_completion(system_prompt, user_prompt, timing=timing)
+        self.policy.observe(result[1])
+        return result
+
+    async def agenerate_completion(self, system_prompt: str, user_prompt: str, timing: Dict[str, Any] = None):
+        delay = self.policy.delay()
+        if delay is None or not self.enabled:
+            return await self._attempt(system_prompt, user_prompt, timing)
+
+        prompt_tokens = estimate_tokens(system_prompt) + estimate_tokens(user_prompt)
+        timings = [{}]
+        started = [time.time()]
+        tasks = [asyncio.ensure_future(self._attempt(system_prompt, user_prompt, timings[0]))]
+        pending = set(tasks)
+        fallback = None  # first completed-but-invalid result (or error), used if nothing valid arrives
+        winner = None
+
+        try:
+            while pending and winner is None:
+                can_hedge = len(tasks) <= self.policy.max_hedges
+                timeout = max(0.0, started[-1] + delay - time.time()) if can_hedge else None
+                done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+                if not done:
+                    timings.append({})
+                    started.append(time.time())
+                    tasks.append(asyncio.ensure_future(self._attempt(system_prompt, user_prompt, timings[-1])))
+                    pending.add(tasks[-1])
+                    self.hedges_sent += 1
+                    continue
+
+                for task in done:
+                    if task.exception() is None and self.validate(task.result()[0]):
+                        winner = task
+                        break
+                    if fallback is None or (fallback.exception() is not None and task.exception() is None):
+                        fallback = task
+        finally:
+            for task in pending:
+                task.cancel()
+
+        if winner is None:
+            winner = fallback
+        winner_index = tasks.index(winner)
+        if winner_index > 0:
+            self.hedge_wins += 1
+
+        # Account for the duplicated work
+        if len(tasks) > 1 and winner.exception() is None:
+            response = winner.result()[0]
+            completion_tokens = estimate_tokens(response.decode("utf-8", "ignore") if isinstance(response, bytes) else response)
+            for task in tasks:
+                if task is winner:
+                    continue
+                if task.done() and not task.cancelled() and task.exception() is None:
+                    loser = task.result()[0]
+                    loser_tokens = estimate_tokens(loser.decode("utf-8", "ignore") if isinstance(loser, bytes) else loser)
+                else:
+                    loser_tokens = completion_tokens
+                self.wasted_tokens += prompt_tokens + loser_tokens
+
+        if timing is not None:
+            timing.update(timings[winner_index])
+            timing["hedges"] = len(tasks) - 1
+            timing["hedge_won"] = winner_index > 0
+        return winner.result()
+
+    async def astream_completion(self, system_prompt: str, user_prompt: str, timing: Dict[str, Any] = None):
+        """Streams are not hedged; they already deliver output as it is produced"""
+        async for chunk in self.client.astream_completion(system_prompt, user_prompt, timing=timing):
+            yield chunk
+
+    async def aclose(self):
+        await self.client.aclose()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "hedges_sent": self.hedges_sent,
+            "hedge_wins": self.hedge_wins,
+            "hedge_wasted_tokens": self.wasted_tokens,
+        }
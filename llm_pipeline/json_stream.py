@@ -0,0 +1,238 @@
+import json
+import re
+from typing import Any, Dict, List
+
+# Characters that can change the scanner state; everything else is skipped in bulk
+_SPECIAL = re.compile(r'[\[\]{}"\\<]')
+_OPENERS = {"[": "]", "{": "}"}
+_CONTAINER_START = re.compile(r"[\[{]")
+_decoder = json.JSONDecoder()
+
+
+class IncrementalJSONParser:
+    """
+    Incremental, string-escape-aware JSON scanner for streamed LLM output.
+
+    Text is fed in arbitrary chunks. Prose outside JSON is ignored, and each
+    per-input record (an object directly inside the outermost array, or an outermost
+    object itself) is returned from feed() as soon as its closing brace arrives.
+    Only the record currently being received is kept in memory.
+
+    <think> ... </think> sections (Phi reasoning output) are skipped, since their
+    prose often contains braces.
+
+    With keep_values=True the text of the outermost container is kept as well:
+    each one that closes and parses is appended to values, and truncated() repairs
+    one that never closed.
+    """
+    def __init__(self, keep_values: bool = False):
+        self.keep_values = keep_values
+        self.values: List[Any] = []
+        self._outer: List[str] = []     # earlier chunks' text of the outermost container (keep_values only)
+        self._outer_len = 0
+        self._outer_start = 0           # where the outermost container starts in the current chunk
+        self._cut = None                # (container length, open stack) after the last complete record
+        self._stack: List[str] = []
+        self._in_string = False
+        self._escape = False
+        self._in_think = False
+        self._record: List[str] = []    # earlier chunks' text of the record being received
+        self._record_start = 0          # where the record starts in the current chunk
+        self._record_depth = None       # stack depth at which the current record opened
+        self._tail = ""                 # last few chars, to find </think> split across chunks
+        self._carry = ""                # possible start of a <think> tag held back from the last chunk
+        self.records_emitted = 0
+
+    def feed(self, chunk: str) -> List[Dict[str, Any]]:
+        """Consume a chunk and return the records completed by it"""
+        completed = []
+        text = self._carry + chunk
+        self._carry = ""
+        # Open containers are only ever continued from the start of the chunk (a held
+        # back <think> tag can only precede one), so their text is sliced, not copied
+        self._record_start = 0
+        self._outer_start = 0
+        pos = 0
+
+        while pos < len(text):
+            if self._in_think:
+                end = (self._tail + text[pos:]).find("</think>")
+                if end == -1:
+                    self._tail = (self._tail + text[pos:])[-8:]
+                    break
+                pos = pos + end - len(self._tail) + len("</think>")
+                self._tail = ""
+                self._in_think = False
+                continue
+
+            if self._escape:
+                self._escape = False
+                pos += 1
+                continue
+
+            match = _SPECIAL.search(text, pos)
+            if match is None:
+                break
+            i = match.start()
+            ch = text[i]
+            pos = i + 1
+
+            if self._in_string:
+                if ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                continue
+
+            if ch == "<":
+                if not self._stack and len(text) - i < len("<think>") and "<think>".startswith(text[i:]):
+                    self._carry = text[i:]
+                    break
+                if not self._stack and text.startswith("<think>", i):
+                    self._in_think = True
+                    self._tail = ""
+                    pos = i + len("<think>")
+                continue
+
+            if not self._stack and ch not in _OPENERS:
+                continue  # prose outside any JSON container
+
+            if ch == '"':
+                self._in_string = True
+            elif ch in _OPENERS:
+                if not self._stack:
+                    self._outer = []
+                    self._outer_len = 0
+                    self._outer_start = i
+                self._stack.append(_OPENERS[ch])
+                if ch == "{" and self._record_depth is None and self._stack[:-1] in ([], ["]"]):
+                    self._record_depth = len(self._stack)
+                    self._record = []
+                    self._record_start = i
+            elif self._stack[-1] == ch:
+                self._stack.pop()
+                if self.keep_values:
+                    self._close(text, pos)
+            else:
+                # Mismatched bracket: the text so far was not JSON, start over
+                self._reset()
+                continue
+
+            if self._record_depth is not None and len(self._stack) < self._record_depth:
+                record = self._finish_record(text, pos)
+                if record is not None:
+                    completed.append(record)
+
+        if self._record_depth is not None:
+            self._record.append(text[self._record_start:])
+        if self.keep_values and self._stack:
+            self._outer.append(text[self._outer_start:])
+            self._outer_len += len(text) - self._outer_start
+        return completed
+
+    def _close(self, text: str, end: int):
+        """Bookkeeping for the outermost container after a bracket closed at text[end - 1]"""
+        if not self._stack:
+            raw = "".join(self._outer) + text[self._outer_start:end]
+            self._outer = []
+            self._outer_len = 0
+            self._cut = None
+            try:
+                self.values.append(json.loads(raw))
+            except json.JSONDecodeError:
+                pass
+        elif self._stack in (["]"], ["}"], ["}", "]"]):
+            # A whole record just closed: an element of the outermost array, a member
+            # of the outermost object, or an element of an array inside it
+            self._cut = (self._outer_len + end - self._outer_start, list(self._stack))
+
+    def truncated(self) -> Any:
+        """
+        The unterminated outermost container (a response cut off mid-output) with
+        its incomplete last record dropped and the open brackets closed, or None.
+        """
+        if not self.keep_values or not self._stack or self._cut is None:
+            return None
+        length, stack = self._cut
+        raw = "".join(self._outer)[:length] + "".join(reversed(stack))
+        try:
+            return json.loads(raw)
+        except json.JSONDecodeError:
+            return None
+
+    def _finish_record(self, text: str, end: int):
+        raw = "".join(self._record) + text[self._record_start:end]
+        self._record = []
+        self._record_depth = None
+        try:
+            value = json.loads(raw)
+        except json.JSONDecodeError:
+            return None
+        if not isinstance(value, dict):
+            return None
+        self.records_emitted += 1
+        return value
+
+    def _reset(self):
+        self._outer = []
+        self._outer_len = 0
+        self._cut = None
+        self._stack = []
+        self._in_string = False
+        self._escape = False
+        self._record = []
+        self._record_depth = None
+
+
+def _is_result(value: Any) -> bool:
+    """Whether a parsed container can hold the extraction: an object or a list of objects"""
+    return isinstance(value, dict) or (isinstance(value, list) and all(isinstance(v, dict) for v in value))
+
+
+def locate_json(text: str) -> Any:
+    """
+    Find the JSON array or object in an LLM response in linear time.
+
+    The first outermost container that parses to an object or a list of objects wins
+    (so bracketed prose such as "Step [1]:" is skipped), with the content of the first
+    code fence scanned before the rest of the text. A response that was cut off
+    mid-output yields its completed records (see IncrementalJSONParser.truncated);
+    failing that, the first container of any kind is returned.
+    Raises ValueError when there is no JSON to be found.
+    """
+    fence = text.find("```")
+    candidates = []
+    if fence != -1:
+        body_start = text.find("\n", fence)
+        body_end = text.find("```", body_start) if body_start != -1 else -1
+        if body_end != -1:
+            # An unterminated fence (a truncated response) is covered by the full-text scan
+            candidates.append(text[body_start:body_end])
+    candidates.append(text)
+
+    repaired = None
+    other = None
+    for candidate in candidates:
+        # Usually the first bracket opens well-formed JSON, which the C decoder reads directly
+        start = _CONTAINER_START.search(candidate)
+        if start is not None and "<think>" not in candidate[:start.start()]:
+            try:
+                value = _decoder.raw_decode(candidate, start.start())[0]
+                if _is_result(value):
+                    return value
+            except json.JSONDecodeError:
+                pass
+        parser = IncrementalJSONParser(keep_values=True)
+        parser.feed(candidate)
+        for value in parser.values:
+            if _is_result(value):
+                return value
+        if other is None and parser.values:
+            other = parser.values[0]
+        if repaired is None:
+            repaired = parser.truncated()
+    if repaired is not None:
+        return repaired
+    if other is not None:
+        return other
+    raise ValueError("No JSON array or object found")
@@ -0,0 +1,65 @@
+import math
+from typing import Any, Dict, Iterable, List, Optional
+
+PERCENTILES = (50, 90, 95, 99)
+
+
+def summarise(values: Iterable[Optional[float]]) -> Dict[str, Optional[float]]:
+    """
+    Distribution of a set of durations: count, mean, nearest-rank p50/p90/p95/p99 and max.
+    None values (e.g. no time-to-first-byte for SDK backends) are ignored.
+    """
+    ordered = sorted(v for v in values if v is not None)
+    if not ordered:
+        return {"count": 0, "mean": None, **{f"p{p}": None for p in PERCENTILES}, "max": None}
+    summary = {"count": len(ordered), "mean": sum(ordered) / len(ordered)}
+    for p in PERCENTILES:
+        summary[f"p{p}"] = ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+    summary["max"] = ordered[-1]
+    return summary
+
+
+def batch_record(offset: int, size: int, latency: Optional[float], wall_sec: float, timings: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    One batch's latency breakdown over the requests sent for it (the first one plus
+    any recovery requests).
+
+    wall_sec covers everything done for the batch (retries, recovery, parsing) once it
+    was dispatched; latency_sec is the model time of its successful requests. ttfb_sec
+    is the first request's time to its first streamed chunk, or to the response headers.
+    server_sec is time spent waiting on the endpoint (headers + body) and client_sec the
+    rest of the wall time (connection setup, backoff, queueing in the client, parsing).
+    Backends without a timing breakdown (Phi's SDK) only report latency and wall time.
+    """
+    first = timings[0] if timings else {}
+    ttfb = first.get("first_chunk_sec")
+    if ttfb is None and "server_sec" in first:
+        ttfb = first.get("connect_sec", 0.0) + first["server_sec"]
+    measured = [t for t in timings if "server_sec" in t]
+    server = sum(t["server_sec"] + t.get("read_sec", 0.0) for t in measured) if measured else None
+    return {
+        "offset": offset,
+        "size": size,
+        "requests": len(timings),
+        "wall_sec": wall_sec,
+        "latency_sec": latency,
+        "ttfb_sec": ttfb,
+        "connect_sec": sum(t.get("connect_sec", 0.0) for t in measured) if measured else None,
+        "server_sec": server,
+        "client_sec": wall_sec - server if server is not None else None,
+        "est_completion_tokens": sum(t.get("est_completion_tokens", 0) for t in timings),
+        "cache_hit": bool(timings) and all(t.get("cache_hit") for t in timings),
+        "endpoint": first.get("endpoint"),
+    }
+
+
+def attribute_by_length(instances: List[Any], latency: Optional[float], weight) -> Dict[int, float]:
+    """
+    Split a batch's latency over its instances in proportion to weight(text), an
+    estimate of the tokens each input contributes (prompt + completion).
+    """
+    if latency is None or not instances:
+        return {}
+    weights = [weight(inst.text) for inst in instances]
+    total = sum(weights) or len(weights)
+    return {inst.text_id: latency * w / total for inst, w in zip(instances, weights)}
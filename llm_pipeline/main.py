@@ -1,16 +1,32 @@
 import argparse
+import asyncio
 import keyring
 import json
 import time
+import pandas as pd
 from pathlib import Path
 from typing import List, Dict, Any
 
 # Imports
-from models import Llama, Phi, Extractor
-from evaluation import Evaluator
-from dataset_load import Dataset
-from dataclass import Entity
+from models import Extractor
+from backends import backend_names, create_client, get_backend, infer_backend
+from json_stream import IncrementalJSONParser
+from batching import BatchPlanner
+from endpoints import BalancedClient, EndpointPool, load_endpoint_list
+from hedging import HedgedClient, HedgePolicy, get_hedge_policy
+from dedup import CoalescingClient, dedupe_instances
+from recovery import BatchRecovery, RecoveryBudget, align_outputs
+from cache import ResponseCache, CachedClient
+from latency import attribute_by_length, batch_record, summarise
+from tokens import estimate_tokens
+from ratelimit import RetryingClient, RetryPolicy, get_rate_limiter
+from evaluation import Evaluator, EVAL_LABELS
+from results_store import ResultsStore, run_key
+from dataset_load import Dataset, iter_ner_gold
+from dataclass import to_json
 from prompt_template import prompt_map
+from schema import JSON_MODE_INSTRUCTION, extraction_schema
+from protocol import PROTOCOLS, compact_instruction, compact_schema
 
 class Main:
     def __init__(self, args=None):
@@ -27,24 +43,67 @@ class Main:
         parser.add_argument("--output_dir", type=str, default="./outputs")
         parser.add_argument("--prompt_tag", type=str, default="p1", help="Prompt version tag (e.g. p1, p2, p3, p4, p5)")
         parser.add_argument("--run_tag", type=str, default="run1", help="Run tag to allow repeated runs")
+        parser.add_argument("--backend", type=str, default=None, choices=backend_names(), help="Model backend (default: phi if the model name contains 'phi', else llama)")
+        parser.add_argument("--backend_params", type=str, default=None, help='JSON object overriding the backend\'s sampling parameters, e.g. \'{"temperature": 0}\'')
+        parser.add_argument("--json_mode", type=str, default="off", choices=["off", "object", "schema"], help="Ask the backend for JSON output, or output constrained to the prompt's entity schema (ignored by backends without support)")
+        parser.add_argument("--output_protocol", type=str, default="echo", choices=PROTOCOLS, help='"echo": one object per input repeating it in "input"; "compact": objects keyed by line number with short category codes and no echo')
+        parser.add_argument("--endpoint", type=str, default=None, help="Override the keyring endpoint (e.g. a local stub_server.py)")
+        parser.add_argument("--api_key", type=str, default=None, help="Override the keyring API key")
+        parser.add_argument("--endpoint_pool", type=str, default=None, help='JSON file listing replicas: [{"endpoint": ..., "api_key": ...}]')
+        parser.add_argument("--balance", type=str, default="least_outstanding", choices=["least_outstanding", "ewma"], help="Routing across --endpoint_pool replicas")
+        parser.add_argument("--concurrency", type=int, default=1, help="Maximum number of batches in flight (1 = serial)")
+        parser.add_argument("--cache_dir", type=str, default="./llm_cache", help="On-disk LLM response cache")
+        parser.add_argument("--cache_max_mb", type=int, default=512, help="Cache size limit before LRU eviction")
+        parser.add_argument("--no_cache", action="store_true", help="Bypass the response cache (for intentional stochastic repeats)")
+        parser.add_argument("--requests_per_min", type=float, default=None, help="Client-side request rate limit per endpoint (shared per endpoint in this process)")
+        parser.add_argument("--tokens_per_min", type=float, default=None, help="Client-side token rate limit per endpoint (prompt + max completion tokens)")
+        parser.add_argument("--model_requests_per_min", type=float, default=None, help="Optional request rate cap across all endpoints of the model")
+        parser.add_argument("--model_tokens_per_min", type=float, default=None, help="Optional token rate cap across all endpoints of the model")
+        parser.add_argument("--max_retries", type=int, default=5, help="Retries per batch on throttling/transient errors")
+        parser.add_argument("--hedge_percentile", type=float, default=None, help="Send a duplicate request once a batch is slower than this latency percentile (e.g. 0.95)")
+        parser.add_argument("--max_hedges", type=int, default=1, help="Duplicates allowed per batch when hedging")
+        parser.add_argument("--hedge_after_sec", type=float, default=None, help="Hedge delay used until enough latencies are known for --hedge_percentile")
+        parser.add_argument("--stream", action="store_true", help="Stream completions and parse each output object as it arrives")
+        parser.add_argument("--recovery_budget", type=int, default=20, help="Extra requests per run for re-submitting inputs whose output was missing or unparseable (0 disables)")
+        parser.add_argument("--batch_size", type=int, default=5, help="Inputs per batch (upper bound when --batch_tokens is set)")
+        parser.add_argument("--results_db", type=str, default=None, help="SQLite results store to record this run in (see results_store.py)")
+        parser.add_argument("--lazy_dataset", action="store_true", help="Memory-map the dataset instead of parsing it up front; batches are built from the texts alone (add --stream_eval to also score without holding every instance)")
+        parser.add_argument("--stream_eval", action="store_true", help="Score the dataset in chunks, re-read from disk, writing per_instance.csv as it goes (bounded memory for very large datasets)")
+        parser.add_argument("--batch_tokens", type=int, default=None, help="Pack length-sorted inputs into batches of about this many estimated input+output tokens")
 
         return parser.parse_args(args)
 
-    def create_model_client(self):
+    def create_model_client(self, schema: Dict[str, Any]):
         model_name = self.args.model.lower()
-        if "phi" in model_name:
-            print(f"Creating Phi client for model: {model_name}")
-            return Phi(
-                endpoint=keyring.get_password("azureml", "phi_endpoint"),
-                api_key=keyring.get_password("azureml", "phi_api_key"),
-                model_name=model_name
-            )
+        backend = get_backend(self.args.backend or infer_backend(model_name))
+        parameters = json.loads(self.args.backend_params) if self.args.backend_params else None
+        if self.args.endpoint_pool:
+            endpoints = load_endpoint_list(Path(self.args.endpoint_pool))
         else:
-            print(f"Creating Llama client for model: {model_name}")
-            return Llama(
-                endpoint=keyring.get_password("azureml", "llama_endpoint"),
-                api_key=keyring.get_password("azureml", "llama_api_key")
-            )
+            endpoints = [(
+                self.args.endpoint or keyring.get_password("azureml", f"{backend.keyring_prefix}_endpoint"),
+                self.args.api_key or keyring.get_password("azureml", f"{backend.keyring_prefix}_api_key")
+            )]
+        if any(endpoint is None for endpoint, _ in endpoints):
+            raise ValueError(f"No endpoint configured for backend '{backend.name}' (use --endpoint or the keyring)")
+
+        print(f"Creating {backend.name} client for model: {model_name} ({len(endpoints)} endpoint(s))")
+        def factory(endpoint, api_key):
+            client = create_client(backend.name, endpoint, api_key, model_name, parameters)
+            if getattr(client, "pool", None) is not None:
+                # One connection per request in flight, hedged duplicates included
+                hedges = self.args.max_hedges if self.args.hedge_percentile else 0
+                client.pool.grow(max(1, self.args.concurrency) * (1 + hedges))
+            if self.args.json_mode != "off":
+                client.enable_json_mode(self.args.json_mode, schema)
+            return client
+
+        pool = EndpointPool(endpoints, strategy=self.args.balance,
+                            requests_per_min=self.args.requests_per_min, tokens_per_min=self.args.tokens_per_min)
+        client = BalancedClient(pool, factory)
+        if self.args.json_mode != "off" and client.json_mode is None:
+            print(f"[Warning] Backend '{backend.name}' has no JSON mode; sending unconstrained requests")
+        return client
 
     def run(self):
         # Setup output directory
@@ -56,12 +115,10 @@ class Main:
         debug_dir.mkdir(exist_ok=True)
 
         # Load dataset
-        dataset = Dataset(jsonl_path=Path(self.args.dataset_path))
+        dataset = Dataset(jsonl_path=Path(self.args.dataset_path), lazy=self.args.lazy_dataset)
         dataset.load()
         print(f"\nLoaded dataset with {len(dataset.instances)} instances.")
 
-        # Model + extractor
-        llm_client = self.create_model_client()
         prompt_tag = self.args.prompt_tag.lower()
         if prompt_tag in prompt_map:
             system_prompt = prompt_map[prompt_tag]
@@ -69,85 +126,306 @@ class Main:
             print(f"[Warning] Prompt tag '{prompt_tag}' not found, using default prompt.")
             system_prompt = prompt_map["default"]
 
-        extractor = Extractor()
+        # Model + extractor
+        template = system_prompt
+        if self.args.output_protocol == "compact":
+            system_prompt += compact_instruction(template)
+            model_client = self.create_model_client(compact_schema(template))
+        else:
+            model_client = self.create_model_client(extraction_schema(template))
+            if model_client.json_mode is not None:
+                system_prompt += JSON_MODE_INSTRUCTION
+        retrying_client = RetryingClient(
+            model_client,
+            limiter=get_rate_limiter(self.args.model.lower(), self.args.model_requests_per_min, self.args.model_tokens_per_min),
+            policy=RetryPolicy(max_retries=self.args.max_retries)
+        )
+        if self.args.hedge_percentile:
+            hedge_policy = get_hedge_policy(
+                self.args.model.lower(),
+                percentile=self.args.hedge_percentile,
+                max_hedges=self.args.max_hedges,
+                initial_delay=self.args.hedge_after_sec
+            )
+        else:
+            hedge_policy = HedgePolicy(max_hedges=0)
+        hedged_client = HedgedClient(retrying_client, hedge_policy)
+        coalescing_client = CoalescingClient(hedged_client, bypass=self.args.no_cache)
+        llm_client = CachedClient(
+            coalescing_client,
+            ResponseCache(Path(self.args.cache_dir), max_bytes=self.args.cache_max_mb * 1024 * 1024),
+            bypass=self.args.no_cache
+        )
 
-        all_predictions = {}
-        latencies = []
-        batch_size = 5 
+        extractor = Extractor(self.args.output_protocol, template)
 
-        for i in range(0, len(dataset.instances), batch_size):
-            batch = dataset.instances[i:i + batch_size]
-            input_texts = [inst.text for inst in batch]
-            text_ids = [inst.text_id for inst in batch]
+        parameters = llm_client.parameters
+        planner = BatchPlanner(
+            max_batch_size=self.args.batch_size,
+            token_budget=self.args.batch_tokens,
+            max_output_tokens=parameters.get("max_new_tokens") or parameters.get("max_tokens"),
+            # Compact output copies only the entity substrings, under one-letter keys
+            **({"output_ratio": 1.0, "output_overhead": 15} if self.args.output_protocol == "compact" else {})
+        )
+        # Identical texts are sent once and their predictions copied to every text_id.
+        # Batches only need texts, so a lazy dataset's entities are not decoded here
+        unique_instances, duplicates = dedupe_instances(dataset.texts())
+        plan = planner.plan(unique_instances)
+        with open(output_path / "batch_plan.json", "w") as f:
+            json.dump([batch.to_record() for batch in plan], f, indent=2)
+        batches = [(batch.offset, batch.instances) for batch in plan]
 
-            try:
-                user_prompt = "\n".join(f"{j+1}. {t}" for j, t in enumerate(input_texts))
+        recovery_budget = RecoveryBudget(self.args.recovery_budget)
+        wall_start = time.time()
+        batch_results = asyncio.run(self._dispatch_batches(
+            llm_client, extractor, system_prompt, batches, debug_dir, recovery_budget
+        ))
+        wall_time = time.time() - wall_start
 
-                response_str, latency = llm_client.generate_completion(
-                    system_prompt=system_prompt,
-                    user_prompt=user_prompt
-                )
+        # Merge in batch-offset order so outputs do not depend on completion order
+        all_predictions = {}
+        latencies = []
+        connect_sec = 0.0
+        server_sec = 0.0
+        failed_batches = []
+        recovered = 0
+        lost_text_ids = []
+        batch_instances = dict(batches)
+        batch_records = []
+        instance_latency = {}
+        cached_ids = set()
+        for i in sorted(batch_results):
+            predictions, latency, timings, recovery, batch_wall = batch_results[i]
+            all_predictions.update(predictions)
+            record = batch_record(i, len(batch_instances[i]), latency, batch_wall, timings)
+            batch_records.append(record)
+            recovered += recovery.recovered
+            lost_text_ids.extend(recovery.lost)
+            if latency is None:
+                failed_batches.append(i)
+            elif record["cache_hit"]:
+                # Answered from the cache: no latency was measured for it in this run
+                cached_ids.update(inst.text_id for inst in batch_instances[i])
+            else:
                 latencies.append(latency)
-
-                with open(debug_dir / f"response_batch_{i}.json", "w") as f:
-                    json.dump({
-                        "text_ids": text_ids,
-                        "texts": input_texts,
-                        "response": response_str.decode('utf-8') if isinstance(response_str, bytes) else response_str,
-                        "latency": latency,
-                        "timestamp": time.time()
-                    }, f, indent=2)
-
-                parsed = extractor.parse_response(response_str)
-                entity_map = extractor.parse_entities_from_extracted(parsed)
-
-                entity_items = list(entity_map.items())
-                if len(entity_items) != len(batch):
-                    print(f"[Warning] Mismatch: {len(entity_items)} outputs vs {len(batch)} inputs")
-
-                for inst, (pred_input, entities) in zip(batch, entity_items):
-                    all_predictions[inst.text_id] = entities
-
-            except Exception as e:
-                print(f"[Error] Batch starting at {i} failed: {e}")
-                for inst in batch:
-                    all_predictions[inst.text_id] = []
+                instance_latency.update(attribute_by_length(
+                    batch_instances[i], latency, lambda text: planner.input_tokens(text) + planner.output_tokens(text)
+                ))
+            connect_sec += sum(timing.get("connect_sec", 0.0) for timing in timings)
+            server_sec += sum(timing.get("server_sec", 0.0) for timing in timings)
+        cached_instances = len(cached_ids)
+        for representative_id, duplicate_ids in duplicates.items():
+            if representative_id in cached_ids:
+                cached_instances += len(duplicate_ids)
+            for text_id in duplicate_ids:
+                all_predictions[text_id] = all_predictions.get(representative_id, [])
+                if representative_id in instance_latency:
+                    instance_latency[text_id] = instance_latency[representative_id]
 
         # Save predictions
         with open(output_path / "raw_predictions.json", "w") as f:
-            json.dump(all_predictions, f, indent=2)
-
-        # Evaluate
-        evaluator = Evaluator(
-            dataset,
-            labels_to_consider=[
-                "name", "email", "date", "phone_number",
-                "organisation", "salutation", "relationship",
-                "country", "airport_code", "id", "plate"
-            ]
-        )
-        results = evaluator.evaluate(all_predictions)
-        df_instance, df_label = evaluator.results_to_dataframe(results)
+            json.dump(all_predictions, f, indent=2, default=to_json)
+
+        # Evaluate, with each instance's estimated share of its batch's latency, by input length
+        evaluator = Evaluator(dataset, labels_to_consider=EVAL_LABELS)
+        if self.args.stream_eval:
+            results = evaluator.evaluate_stream(
+                iter_ner_gold(self.args.dataset_path), all_predictions, output_path / "per_instance.csv",
+                extra_columns={"est_latency_sec": instance_latency}
+            )
+            df_instance = None
+            df_label = pd.DataFrame(results["per_label"])
+        else:
+            results = evaluator.evaluate(all_predictions)
+            df_instance, df_label = evaluator.results_to_dataframe(results)
+            df_instance["est_latency_sec"] = df_instance["text_id"].map(instance_latency)
+            df_instance.to_csv(output_path / "per_instance.csv", index=False)
 
-        df_instance.to_csv(output_path / "per_instance.csv", index=False)
+        pd.DataFrame(batch_records).to_csv(output_path / "batch_latency.csv", index=False)
+        sent_records = [r for r in batch_records if not r["cache_hit"]]
+        measured_instances = len(dataset.instances) - cached_instances
         df_label.to_csv(output_path / "per_label.csv", index=False)
 
+        metrics = {
+            "model": self.args.model,
+            "micro_precision": results["micro_precision"],
+            "micro_recall": results["micro_recall"],
+            "micro_f1": results["micro_f1"],
+            # Over the instances whose batches were sent (None when all came from the cache)
+            "avg_latency_sec": sum(latencies) / measured_instances if latencies else (0.0 if measured_instances else None),
+            "wall_time_sec": wall_time,
+            "connect_sec_total": connect_sec,
+            "server_sec_total": server_sec,
+            "latency": {
+                "batch_latency_sec": summarise(latencies),
+                "batch_wall_sec": summarise(r["wall_sec"] for r in sent_records),
+                "ttfb_sec": summarise(r["ttfb_sec"] for r in sent_records),
+                "server_sec": summarise(r["server_sec"] for r in sent_records),
+                "client_sec": summarise(r["client_sec"] for r in sent_records),
+                "instance_latency_sec": summarise(instance_latency.values()),
+            },
+            "concurrency": self.args.concurrency,
+            "json_mode": model_client.json_mode or "off",
+            "output_protocol": self.args.output_protocol,
+            "num_batches": len(batches),
+            "est_completion_tokens_total": sum(r["est_completion_tokens"] for r in batch_records),
+            **llm_client.stats(),
+            **retrying_client.stats(),
+            **hedged_client.stats(),
+            **coalescing_client.stats(),
+            "unique_texts": len(unique_instances),
+            "duplicate_texts": len(dataset.instances) - len(unique_instances),
+            **model_client.stats(),
+            "failed_batches": failed_batches,
+            "recovery_requests": recovery_budget.used,
+            "recovered_instances": recovered,
+            "lost_instances": len(lost_text_ids),
+            "lost_text_ids": sorted(lost_text_ids),
+            "per_instance_precision_buckets": results["per_instance_precision_buckets"],
+            "per_instance_recall_buckets": results["per_instance_recall_buckets"]
+        }
         with open(output_path / "metrics.json", "w", encoding="utf-8") as f:
-            json.dump({
-                "micro_precision": results["micro_precision"],
-                "micro_recall": results["micro_recall"],
-                "micro_f1": results["micro_f1"],
-                "avg_latency_sec": sum(latencies) / len(dataset.instances) if latencies else 0.0,
-                "per_instance_precision_buckets": results["per_instance_precision_buckets"],
-                "per_instance_recall_buckets": results["per_instance_recall_buckets"]
-            }, f, indent=2)
+            json.dump(metrics, f, indent=2)
+
+        if self.args.results_db:
+            store = ResultsStore(Path(self.args.results_db))
+            try:
+                store.record_run(
+                    run_key(Path(self.args.dataset_path), self.args.prompt_tag, self.args.run_tag, self.args.model),
+                    output_path, metrics,
+                    pd.read_csv(output_path / "per_instance.csv", chunksize=10000) if df_instance is None else df_instance,
+                    df_label, pd.DataFrame(batch_records)
+                )
+            finally:
+                store.close()
 
         print("\n---- RESULTS ----")
         print(f"Prompt Tag: {self.args.prompt_tag} | Run Tag: {self.args.run_tag}")
         print("Micro F1:", results["micro_f1"])
+        if failed_batches:
+            print(f"[Warning] {len(failed_batches)} batch(es) got no response: {failed_batches}")
+        if recovered or lost_text_ids:
+            print(f"Recovered {recovered} input(s) with {recovery_budget.used} extra request(s); "
+                  f"{len(lost_text_ids)} lost and scored as empty")
         print(f"Saved outputs to: {output_path}")
         print(f"Raw responses: {debug_dir}")
 
+    async def _dispatch_batches(self, llm_client, extractor, system_prompt, batches, debug_dir, recovery_budget):
+        """
+        Send batches concurrently, with at most --concurrency requests in flight.
+
+        Returns:
+            Dict[int, Tuple[Dict[int, list], float, dict, BatchRecovery, float]] —
+            batch offset → (text_id → entities, latency, request timings, recovery outcome, wall time)
+        """
+        semaphore = asyncio.Semaphore(max(1, self.args.concurrency))
+
+        async def run_one(i, batch):
+            async with semaphore:
+                return i, await self._process_batch(llm_client, extractor, system_prompt, i, batch, debug_dir, recovery_budget)
+
+        try:
+            results = await asyncio.gather(*(run_one(i, batch) for i, batch in batches))
+        finally:
+            await llm_client.aclose()
+        return dict(results)
+
+    async def _process_batch(self, llm_client, extractor, system_prompt, i, batch, debug_dir, recovery_budget):
+        """
+        Query the model for one batch and map predictions back to text_ids.
+        Inputs left without output are re-submitted (see recovery.BatchRecovery).
+
+        Returns:
+            (text_id → entities, summed latency of the successful requests or None, timing of each request sent,
+             BatchRecovery, wall time spent on the batch)
+        """
+        start_time = time.time()
+        latencies = []
+        timings = []
+
+        async def query(instances):
+            attempt = len(timings)
+            request_timing = {}
+            timings.append(request_timing)
+            input_texts = [inst.text for inst in instances]
+            user_prompt = "\n".join(f"{j+1}. {t}" for j, t in enumerate(input_texts))
+
+            if self.args.stream:
+                response_str, latency, entity_map = await self._stream_batch(
+                    llm_client, extractor, system_prompt, user_prompt, request_timing
+                )
+            else:
+                response_str, latency = await llm_client.agenerate_completion(
+                    system_prompt=system_prompt,
+                    user_prompt=user_prompt,
+                    timing=request_timing
+                )
+                entity_map = None
+            latencies.append(latency)
+            response_text = response_str.decode('utf-8') if isinstance(response_str, bytes) else response_str
+            request_timing["est_completion_tokens"] = estimate_tokens(response_text)
+
+            suffix = f"_retry{attempt}" if attempt else ""
+            with open(debug_dir / f"response_batch_{i}{suffix}.json", "w") as f:
+                json.dump({
+                    "text_ids": [inst.text_id for inst in instances],
+                    "texts": input_texts,
+                    "response": response_text,
+                    "latency": latency,
+                    "timing": request_timing,
+                    "timestamp": time.time()
+                }, f, indent=2)
+
+            if entity_map is None:
+                entity_map = extractor.entity_map(extractor.parse_response(response_str))
+            return entity_map
+
+        recovery = BatchRecovery(query, recovery_budget)
+        error = None
+        try:
+            predictions, missing = align_outputs(batch, await query(batch))
+            response_failed = not predictions
+            if missing:
+                print(f"[Warning] Batch starting at {i}: no output for {len(missing)} of {len(batch)} inputs")
+        except Exception as e:
+            print(f"[Error] Batch starting at {i} failed: {e}")
+            predictions, missing, response_failed, error = {}, list(batch), True, e
+
+        if missing:
+            predictions.update(await recovery.recover(missing, response_failed, error))
+        for inst in batch:
+            predictions.setdefault(inst.text_id, [])
+
+        latency = sum(latencies) if latencies else None
+        return predictions, latency, timings, recovery, time.time() - start_time
+
+    async def _stream_batch(self, llm_client, extractor, system_prompt, user_prompt, timing):
+        """
+        Stream one batch, turning each output object into predictions as soon as it is complete.
+
+        Returns:
+            (full response text, latency, input text or line number → entities)
+        """
+        parser = IncrementalJSONParser()
+        chunks = []
+        entity_map = {}
+
+        start_time = time.time()
+        async for chunk in llm_client.astream_completion(system_prompt, user_prompt, timing=timing):
+            if not chunks:
+                timing["first_chunk_sec"] = time.time() - start_time
+            chunks.append(chunk)
+            for record in parser.feed(chunk):
+                timing.setdefault("first_prediction_sec", time.time() - start_time)
+                entity_map.update(extractor.entity_map(record))
+        latency = time.time() - start_time
+
+        response_str = "".join(chunks)
+        if not parser.records_emitted:
+            # Nothing recognisable as per-input objects; let the regular parser try (and raise)
+            entity_map = extractor.entity_map(extractor.parse_response(response_str))
+        return response_str, latency, entity_map
+
 
 if __name__ == "__main__":
     Main().run()
@@ -1,90 +1,416 @@
+import asyncio
 import json
 import time
-import re
-import urllib.request
 import os
 import ssl
+import threading
 from pathlib import Path
-from typing import Dict, Any, List, Union
+from typing import Dict, Any, List, Optional, Union, Iterator, AsyncIterator
 from azure.ai.inference import ChatCompletionsClient
+from azure.ai.inference.aio import ChatCompletionsClient as AsyncChatCompletionsClient
 from azure.core.credentials import AzureKeyCredential
-from azure.ai.inference.models import SystemMessage, UserMessage
+from azure.core.exceptions import HttpResponseError
+from azure.ai.inference.models import SystemMessage, UserMessage, JsonSchemaFormat
+from dataclass import Entity
+from transport import ConnectionPool, RequestHandle, RequestTiming, get_shared_pool
+from schema import RESULTS_KEY, entity_fields
+from protocol import category_codes, parse_compact
+from json_stream import locate_json
 
-class Llama:
+async def iterate_in_thread(iterator_fn, *args):
     """
-    Class for interacting with Llama 3.1 8b Instruct API
+    Drive a blocking iterator in a worker thread and yield its items asynchronously.
+    Closing the async generator stops the worker at its next item.
     """
-    def __init__(self, endpoint: str, api_key: str):
-        self.endpoint = endpoint
-        self.api_key = api_key
-        self._setup_ssl()
-        
-    def _setup_ssl(self, allowed: bool = True):
-        """Bypass SSL verification if needed (for testing only)"""
-        if allowed and not os.environ.get('PYTHONHTTPSVERIFY', '') and getattr(ssl, '_create_unverified_context', None):
-            ssl._create_default_https_context = ssl._create_unverified_context
-    
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    stop = threading.Event()
+    done = object()
+
+    def worker():
+        try:
+            for item in iterator_fn(*args):
+                loop.call_soon_threadsafe(queue.put_nowait, (item, None))
+                if stop.is_set():
+                    break
+        except Exception as e:
+            loop.call_soon_threadsafe(queue.put_nowait, (None, e))
+        finally:
+            loop.call_soon_threadsafe(queue.put_nowait, (done, None))
+
+    loop.run_in_executor(None, worker)
+    try:
+        while True:
+            item, error = await queue.get()
+            if error is not None:
+                raise error
+            if item is done:
+                break
+            yield item
+    finally:
+        stop.set()
+
+async def run_in_thread(fn, *args, abort=None):
+    """
+    Run blocking fn(*args) in a worker thread. If the caller is cancelled, abort() (when
+    given) is called to stop fn early, and the cancellation is passed on only once fn
+    has returned, so wrappers counting requests in flight see when the work ends.
+    """
+    task = asyncio.ensure_future(asyncio.to_thread(fn, *args))
+    try:
+        return await asyncio.shield(task)
+    except asyncio.CancelledError:
+        if abort is not None:
+            abort()
+        try:
+            await task
+        except Exception:
+            pass
+        raise
+
+class APIError(Exception):
+    """Non-success HTTP response from a model endpoint"""
+    def __init__(self, status: int, message: str, headers: Dict[str, str] = None):
+        super().__init__(message)
+        self.status = status
+        self.headers = headers or {}
+        self.limiter = None  # rate limiter of the endpoint that answered, set by BalancedClient
+
+def sse_event_text(event: Dict[str, Any]) -> str:
+    """Text delta of one server-sent event (OpenAI/vLLM, TGI or score-script style)"""
+    if event.get("choices"):
+        choice = event["choices"][0]
+        return (choice.get("delta") or {}).get("content") or choice.get("text") or ""
+    if isinstance(event.get("token"), dict):
+        return event["token"].get("text", "")
+    return event.get("output", "")
+
+class ModelClient:
+    """
+    Common interface of every model backend.
+
+    Subclasses provide request_fingerprint, generate_completion and stream_completion
+    (or their async variants); the wrappers in cache/ratelimit/hedging/dedup/endpoints
+    only rely on the methods defined here. The defaults run the blocking methods in a
+    worker thread.
+    """
+    model_name: str
+    parameters: Dict[str, Any]
+    json_mode: Optional[str] = None            # "object" / "schema" while constrained output is requested
+    cancellable: bool = False                  # cancelling agenerate_completion stops the request (see HedgedClient)
+    _unconstrained_parameters: Optional[Dict[str, Any]] = None
+
+    def json_mode_parameters(self, mode: str, schema: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """
+        Request parameters asking for JSON output ("object") or output matching
+        schema ("schema"), or None when the backend cannot constrain its output.
+        """
+        return None
+
+    def enable_json_mode(self, mode: str, schema: Dict[str, Any]) -> bool:
+        """Request constrained output from now on; returns False if the backend does not support it"""
+        parameters = self.json_mode_parameters(mode, schema)
+        if parameters is None:
+            return False
+        self._unconstrained_parameters = self.parameters
+        self.parameters = {**self.parameters, **parameters}
+        self.json_mode = mode
+        return True
+
+    def _retry_unconstrained(self, error: "APIError", sent_parameters: Dict[str, Any]) -> bool:
+        """
+        Whether a request sent in JSON mode failed because the server rejected the
+        response format. JSON mode is then dropped for the rest of the run and the
+        caller resends the request without it.
+        """
+        if self._unconstrained_parameters is None or sent_parameters is self._unconstrained_parameters:
+            return False
+        if error.status not in (400, 422):
+            return False
+        if self.json_mode is not None:
+            print(f"[Warning] {self.model_name} rejected JSON mode (status {error.status}); sending unconstrained requests")
+            self.parameters = self._unconstrained_parameters
+            self.json_mode = None
+        return True
+
     def create_message(self, system_prompt: str, user_prompt: str) -> List[Dict[str, str]]:
         """Create a properly formatted message for the API"""
         return [
             {"role": "system", "content": system_prompt},
             {"role": "user", "content": user_prompt},
         ]
-    
-    def generate_completion(self, system_prompt: str, user_prompt: str) -> bytes:
-        """Generate completion from the LLM API"""
-        messages = self.create_message(system_prompt, user_prompt)
-        
-        data = {
-            "input_data": {
-                "input_string": messages,
-                "parameters": {
-                    "temperature": 0.2,
-                    "top_p": 0.8,
-                    "min_p": 0.1,
-                    "max_new_tokens": 4000
-                }
-            }
-        }
-        
-        headers = {
-            'Content-Type': 'application/json',
-            'Authorization': f'Bearer {self.api_key}'
+
+    def request_fingerprint(self, system_prompt: str, user_prompt: str) -> Dict[str, Any]:
+        """Everything that determines the response, used as the response cache key"""
+        return {
+            "model": self.model_name,
+            "messages": self.create_message(system_prompt, user_prompt),
+            "parameters": self.parameters
         }
-        
-        req = urllib.request.Request(
-            self.endpoint,
-            data=json.dumps(data).encode('utf-8'),
+
+    def generate_completion(self, system_prompt: str, user_prompt: str, timing: Dict[str, Any] = None) -> tuple[Union[bytes, str], float]:
+        raise NotImplementedError
+
+    def stream_completion(self, system_prompt: str, user_prompt: str, timing: Dict[str, Any] = None) -> Iterator[str]:
+        raise NotImplementedError
+
+    async def agenerate_completion(self, system_prompt: str, user_prompt: str, timing: Dict[str, Any] = None) -> tuple[Union[bytes, str], float]:
+        """
+        Async variant of generate_completion; the blocking request runs in a worker
+        thread, which a cancellation waits for but cannot stop.
+        """
+        return await run_in_thread(self.generate_completion, system_prompt, user_prompt, timing)
+
+    async def astream_completion(self, system_prompt: str, user_prompt: str, timing: Dict[str, Any] = None) -> AsyncIterator[str]:
+        """Async variant of stream_completion, read in a worker thread"""
+        async for chunk in iterate_in_thread(self.stream_completion, system_prompt, user_prompt, timing):
+            yield chunk
+
+    async def aclose(self):
+        """Nothing to release by default"""
+        return None
+
+class PooledHTTPClient(ModelClient):
+    """
+    Base for backends spoken to over plain HTTP through the shared keep-alive
+    ConnectionPool. Subclasses build the request body and read the response body.
+    Cancelling agenerate_completion aborts the request by closing its connection.
+    """
+    cancellable = True
+
+    def __init__(self, endpoint: str, api_key: str, pool: ConnectionPool = None):
+        self.endpoint = endpoint
+        self.api_key = api_key
+        # Keep-alive connections are shared by every client in the process
+        self.pool = pool or get_shared_pool(verify_ssl=self._setup_ssl())
+
+    def _setup_ssl(self, allowed: bool = True) -> bool:
+        """Bypass SSL verification if needed (for testing only). Returns whether to verify."""
+        if allowed and not os.environ.get('PYTHONHTTPSVERIFY', '') and getattr(ssl, '_create_unverified_context', None):
+            return False
+        return True
+
+    def _headers(self, stream: bool = False) -> Dict[str, str]:
+        headers = {'Content-Type': 'application/json'}
+        if stream:
+            headers['Accept'] = 'text/event-stream'
+        if self.api_key:
+            headers['Authorization'] = f'Bearer {self.api_key}'
+        return headers
+
+    def _request_body(self, system_prompt: str, user_prompt: str, stream: bool = False) -> Dict[str, Any]:
+        """Request body built from self.parameters"""
+        raise NotImplementedError
+
+    def _body_text(self, body: bytes) -> str:
+        """Completion text of a whole (non-streamed) response body"""
+        raise NotImplementedError
+
+    @staticmethod
+    def _api_error(status: int, headers: Dict[str, str], body: bytes) -> APIError:
+        return APIError(
+            status,
+            f"API request failed with status {status}\n"
+            f"Headers: {headers}\n"
+            f"Response: {body.decode('utf8', 'ignore')}",
             headers=headers
         )
+
+    def _post(self, system_prompt: str, user_prompt: str, timing: Dict[str, Any] = None,
+              handle: RequestHandle = None) -> tuple[bytes, float]:
+        """
+        Send the request and return (raw response body, latency in sec).
+
+        Args:
+            timing: optional dict filled with the RequestTiming breakdown
+                    (connection setup vs server time) of this request
+            handle: lets another thread abort the request
+        """
+        parameters = self.parameters
+        status, response_headers, result, request_timing = self.pool.request(
+            "POST",
+            self.endpoint,
+            body=json.dumps(self._request_body(system_prompt, user_prompt)).encode('utf-8'),
+            headers=self._headers(),
+            handle=handle
+        )
+        if timing is not None:
+            timing.update(request_timing.to_dict())
+        if status >= 400:
+            error = self._api_error(status, response_headers, result)
+            if self._retry_unconstrained(error, parameters):
+                return self._post(system_prompt, user_prompt, timing, handle)
+            raise error
+        return result, request_timing.total_sec
+
+    async def agenerate_completion(self, system_prompt: str, user_prompt: str, timing: Dict[str, Any] = None) -> tuple[Union[bytes, str], float]:
+        """Async variant of generate_completion; cancelling it closes the request's connection"""
+        handle = RequestHandle()
+        return await run_in_thread(self.generate_completion, system_prompt, user_prompt, timing, handle, abort=handle.abort)
+
+    def stream_completion(self, system_prompt: str, user_prompt: str, timing: Dict[str, Any] = None) -> Iterator[str]:
+        """
+        Stream the completion text as it is generated (server-sent events).
+        Endpoints that ignore the stream flag return one JSON body, which is yielded whole.
+        """
+        parameters = self.parameters
+        body = self._request_body(system_prompt, user_prompt, stream=True)
+        request_timing = RequestTiming()
+        lines = self.pool.stream("POST", self.endpoint, body=json.dumps(body).encode('utf-8'),
+                                 headers=self._headers(stream=True), timing=request_timing)
         try:
-            start_time = time.time()
-            with urllib.request.urlopen(req) as response:
-                result = response.read()
-            latency = time.time() - start_time
-            return result, latency
-        except urllib.error.HTTPError as error:
-            error_content = error.read().decode("utf8", 'ignore')
-            raise Exception(
-                f"API request failed with status {error.code}\n"
-                f"Headers: {dict(error.info())}\n"
-                f"Response: {error_content}"
-            )
-        
-class Phi:
+            status, response_headers, _ = next(lines)
+            if status >= 400 or "text/event-stream" not in response_headers.get("Content-Type", ""):
+                body = b"".join(line for _, _, line in lines)
+                if status >= 400:
+                    error = self._api_error(status, response_headers, body)
+                    if self._retry_unconstrained(error, parameters):
+                        yield from self.stream_completion(system_prompt, user_prompt, timing)
+                        return
+                    raise error
+                yield self._body_text(body)
+                return
+
+            # Read through to the end of the body (past [DONE]) so the connection can be reused
+            done = False
+            for _, _, line in lines:
+                if done or not line.startswith(b"data:"):
+                    continue
+                payload = line[len(b"data:"):].strip()
+                if payload == b"[DONE]":
+                    done = True
+                    continue
+                text = sse_event_text(json.loads(payload))
+                if text:
+                    yield text
+        finally:
+            lines.close()
+            if timing is not None:
+                timing.update(request_timing.to_dict())
+
+    async def aclose(self):
+        """Nothing to release; pooled connections outlive the run so later runs can reuse them"""
+        return None
+
+class Llama(PooledHTTPClient):
+    """
+    Class for interacting with Llama 3.1 8b Instruct API
+    """
+    def __init__(self, endpoint: str, api_key: str, pool: ConnectionPool = None, model_name: str = "llama-3.1-8b-instruct",
+                 parameters: Dict[str, Any] = None):
+        super().__init__(endpoint, api_key, pool)
+        self.model_name = model_name
+        self.parameters = {
+            "temperature": 0.2,
+            "top_p": 0.8,
+            "min_p": 0.1,
+            "max_new_tokens": 4000,
+            **(parameters or {})
+        }
+
+    def json_mode_parameters(self, mode: str, schema: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """The managed endpoint's input_data contract has no response format option"""
+        return None
+
+    def _request_body(self, system_prompt: str, user_prompt: str, stream: bool = False) -> Dict[str, Any]:
+        parameters = {**self.parameters, "stream": True} if stream else self.parameters
+        return {
+            "input_data": {
+                "input_string": self.create_message(system_prompt, user_prompt),
+                "parameters": parameters
+            }
+        }
+
+    def _body_text(self, body: bytes) -> str:
+        try:
+            wrapper = json.loads(body)
+        except json.JSONDecodeError:
+            return body.decode("utf-8")
+        return wrapper.get("output", "") if isinstance(wrapper, dict) else body.decode("utf-8")
+
+    def generate_completion(self, system_prompt: str, user_prompt: str, timing: Dict[str, Any] = None,
+                            handle: RequestHandle = None) -> tuple[bytes, float]:
+        """Generate completion from the LLM API; returns the raw {"output": ...} body"""
+        return self._post(system_prompt, user_prompt, timing, handle)
+
+class OpenAIChat(PooledHTTPClient):
+    """
+    Any server speaking the OpenAI chat-completions API (vLLM, llama.cpp server,
+    Ollama, TGI, ...). endpoint is the server's base URL ("http://host:8000/v1") or
+    the full .../chat/completions URL; api_key may be empty for local servers.
+    """
+    def __init__(self, endpoint: str, api_key: str = None, pool: ConnectionPool = None, model_name: str = "default",
+                 parameters: Dict[str, Any] = None):
+        super().__init__(self._completions_url(endpoint), api_key, pool)
+        self.model_name = model_name
+        self.parameters = {
+            "temperature": 0.2,
+            "top_p": 0.8,
+            "max_tokens": 4000,
+            **(parameters or {})
+        }
+
+    @staticmethod
+    def _completions_url(endpoint: str) -> str:
+        url = endpoint.rstrip("/")
+        if url.endswith("/chat/completions"):
+            return url
+        if url.endswith("/v1"):
+            return url + "/chat/completions"
+        return url + "/v1/chat/completions"
+
+    def json_mode_parameters(self, mode: str, schema: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """response_format as understood by vLLM, llama.cpp server, Ollama and OpenAI"""
+        if mode == "object":
+            return {"response_format": {"type": "json_object"}}
+        return {"response_format": {"type": "json_schema", "json_schema": {"name": "entities", "schema": schema}}}
+
+    def _request_body(self, system_prompt: str, user_prompt: str, stream: bool = False) -> Dict[str, Any]:
+        body = {
+            "model": self.model_name,
+            "messages": self.create_message(system_prompt, user_prompt),
+            **self.parameters
+        }
+        if stream:
+            body["stream"] = True
+        return body
+
+    def _body_text(self, body: bytes) -> str:
+        response = json.loads(body)
+        return response["choices"][0]["message"]["content"] or ""
+
+    def generate_completion(self, system_prompt: str, user_prompt: str, timing: Dict[str, Any] = None,
+                            handle: RequestHandle = None) -> tuple[str, float]:
+        """Send the request and return (completion text, latency in sec)"""
+        body, latency = self._post(system_prompt, user_prompt, timing, handle)
+        return self._body_text(body), latency
+
+class Phi(ModelClient):
     """
     Class for interacting with Phi 4 Reasoning Model (Azure AI Studio).
     """
-    def __init__(self, endpoint: str, api_key: str, model_name: str = "phi-4-reasoning"):
+    cancellable = True  # the async path uses the SDK's aio client
+
+    def __init__(self, endpoint: str, api_key: str, model_name: str = "phi-4-reasoning", parameters: Dict[str, Any] = None):
         self.endpoint = endpoint
         self.api_key = api_key
         self.model_name = model_name
+        self.parameters = {
+            "max_tokens": 8000,
+            "temperature": 0.3,
+            "top_p": 1,
+            "response_format": "text",
+            **(parameters or {})
+        }
 
         self.client = ChatCompletionsClient(
             endpoint=self.endpoint,
             credential=AzureKeyCredential(self.api_key),
-            model=self.model_name
+            model=self.model_name,
+            retry_total=0  # retries and backoff are handled by ratelimit.RetryingClient
         )
+        # Async client is bound to the running event loop, so it is created lazily
+        self._async_client = None
 
     def format_phi_chatml(self, system_prompt: str, user_prompt: str) -> list:
         """Formats the prompts according to Phi-4's requirements.
@@ -106,37 +432,178 @@ class Phi:
             UserMessage(content=populated_user_prompt)
         ]
 
-    def generate_completion(self, system_prompt: str, user_prompt: str) -> tuple[str, float]:
+    @staticmethod
+    def _to_api_error(error: HttpResponseError) -> APIError:
+        """Map SDK errors to APIError so retries see the status and Retry-After headers"""
+        headers = dict(error.response.headers) if error.response is not None else {}
+        return APIError(error.status_code or 0, f"API request failed with status {error.status_code}\n{error.message}", headers=headers)
+
+    def json_mode_parameters(self, mode: str, schema: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Azure AI inference response formats (whether the deployed model honours them is checked at request time)"""
+        if mode == "object":
+            return {"response_format": "json_object"}
+        return {"response_format": {"type": "json_schema", "json_schema": {"name": "entities", "schema": schema}}}
+
+    @staticmethod
+    def _complete_kwargs(parameters: Dict[str, Any]) -> Dict[str, Any]:
+        """SDK keyword arguments for parameters (a schema response format is kept as a plain dict in parameters for the cache key)"""
+        response_format = parameters.get("response_format")
+        if isinstance(response_format, dict):
+            json_schema = response_format["json_schema"]
+            return {**parameters, "response_format": JsonSchemaFormat(name=json_schema["name"], schema=json_schema["schema"])}
+        return parameters
+
+    def request_fingerprint(self, system_prompt: str, user_prompt: str) -> Dict[str, Any]:
+        """Everything that determines the response, used as the response cache key"""
+        return {
+            "model": self.model_name,
+            "messages": [dict(m) for m in self.format_phi_chatml(system_prompt, user_prompt)],
+            "parameters": self.parameters
+        }
+
+    def generate_completion(self, system_prompt: str, user_prompt: str, timing: Dict[str, Any] = None) -> tuple[str, float]:
         """Send request to Phi model and return (clean text, latency in sec)"""
         messages = self.format_phi_chatml(system_prompt, user_prompt)
+        parameters = self.parameters
         
         start_time = time.time()
-        response = self.client.complete(
-            messages=messages,
-            max_tokens=8000,
-            temperature=0.3,
-            top_p=1,
-            response_format="text"
-        )
+        try:
+            response = self.client.complete(
+                messages=messages,
+                **self._complete_kwargs(parameters)
+            )
+        except HttpResponseError as error:
+            api_error = self._to_api_error(error)
+            if self._retry_unconstrained(api_error, parameters):
+                return self.generate_completion(system_prompt, user_prompt, timing)
+            raise api_error
         latency = time.time() - start_time
+        if timing is not None:
+            # The SDK does not expose connection timings
+            timing["total_sec"] = latency
 
         # Extract content safely from response
         raw_content = response.choices[0].message.content
+        return raw_content, latency
 
-        ## Remove <think> ... </think> blocks
-        # clean_content = re.sub(r"<think>.*?</think>", "", raw_content, flags=re.DOTALL).strip()
+    async def agenerate_completion(self, system_prompt: str, user_prompt: str, timing: Dict[str, Any] = None) -> tuple[str, float]:
+        """Async variant of generate_completion using the azure.ai.inference aio client"""
+        if self._async_client is None:
+            self._async_client = AsyncChatCompletionsClient(
+                endpoint=self.endpoint,
+                credential=AzureKeyCredential(self.api_key),
+                model=self.model_name,
+                retry_total=0
+            )
+        messages = self.format_phi_chatml(system_prompt, user_prompt)
+        parameters = self.parameters
 
-        return raw_content, latency
+        start_time = time.time()
+        try:
+            response = await self._async_client.complete(
+                messages=messages,
+                **self._complete_kwargs(parameters)
+            )
+        except HttpResponseError as error:
+            api_error = self._to_api_error(error)
+            if self._retry_unconstrained(api_error, parameters):
+                return await self.agenerate_completion(system_prompt, user_prompt, timing)
+            raise api_error
+        latency = time.time() - start_time
+        if timing is not None:
+            timing["total_sec"] = latency
+
+        return response.choices[0].message.content, latency
+
+    def stream_completion(self, system_prompt: str, user_prompt: str, timing: Dict[str, Any] = None) -> Iterator[str]:
+        """Stream the completion text as it is generated"""
+        messages = self.format_phi_chatml(system_prompt, user_prompt)
+        parameters = self.parameters
+        start_time = time.time()
+        try:
+            try:
+                response = self.client.complete(messages=messages, stream=True, **self._complete_kwargs(parameters))
+            except HttpResponseError as error:
+                api_error = self._to_api_error(error)
+                if self._retry_unconstrained(api_error, parameters):
+                    yield from self.stream_completion(system_prompt, user_prompt, timing)
+                    return
+                raise api_error
+            for update in response:
+                if update.choices and update.choices[0].delta.content:
+                    yield update.choices[0].delta.content
+        except HttpResponseError as error:
+            raise self._to_api_error(error)
+        finally:
+            if timing is not None:
+                timing["total_sec"] = time.time() - start_time
+
+    async def astream_completion(self, system_prompt: str, user_prompt: str, timing: Dict[str, Any] = None) -> AsyncIterator[str]:
+        """Async variant of stream_completion using the aio client"""
+        if self._async_client is None:
+            self._async_client = AsyncChatCompletionsClient(
+                endpoint=self.endpoint,
+                credential=AzureKeyCredential(self.api_key),
+                model=self.model_name,
+                retry_total=0
+            )
+        messages = self.format_phi_chatml(system_prompt, user_prompt)
+        parameters = self.parameters
+        start_time = time.time()
+        try:
+            try:
+                response = await self._async_client.complete(messages=messages, stream=True, **self._complete_kwargs(parameters))
+            except HttpResponseError as error:
+                api_error = self._to_api_error(error)
+                if self._retry_unconstrained(api_error, parameters):
+                    async for chunk in self.astream_completion(system_prompt, user_prompt, timing):
+                        yield chunk
+                    return
+                raise api_error
+            async for update in response:
+                if update.choices and update.choices[0].delta.content:
+                    yield update.choices[0].delta.content
+        except HttpResponseError as error:
+            raise self._to_api_error(error)
+        finally:
+            if timing is not None:
+                timing["total_sec"] = time.time() - start_time
+
+    async def aclose(self):
+        """Close the async client (must run on the loop that created it)"""
+        if self._async_client is not None:
+            await self._async_client.close()
+            self._async_client = None
     
 class Extractor:
     """
     Class for processing LLM outputs and extracting structured data.
-    Assumes each extracted item includes an "input" field for matching.
+
+    With the default "echo" protocol each extracted item includes an "input" field
+    for matching. With the "compact" protocol (see protocol.py) items are keyed by
+    the input's line number instead, using the category codes of template.
     """
+    def __init__(self, protocol: str = "echo", template: str = None):
+        self.protocol = protocol
+        if protocol == "compact":
+            self.codes = category_codes(template)
+            self.fields = entity_fields(template)
+
+    def entity_map(self, extracted: Union[List[Dict[str, Any]], Dict[str, Any]]) -> Dict[Union[str, int], List[Any]]:
+        """
+        Entities per input of a parsed response: keyed by the echoed input text
+        ("echo") or by 1-based line number ("compact")
+        """
+        if self.protocol == "compact":
+            return parse_compact(extracted, self.codes, self.fields)
+        return self.parse_entities_from_extracted(extracted)
 
     @staticmethod
     def parse_response(response: Union[bytes, str]) -> Any:
-        """Parse API response (bytes or str) and extract JSON list or single object"""
+        """
+        Parse API response (bytes or str) and extract JSON list or single object.
+        A response cut off mid-output gives the records completed before the cut.
+        """
         if isinstance(response, bytes):
             response_str = response.decode("utf-8")
         else:
@@ -144,37 +611,37 @@ class Extractor:
 
         try:
             wrapper = json.loads(response_str)
-            content = wrapper.get('output', '')
+            content = wrapper['output'] if isinstance(wrapper, dict) and 'output' in wrapper else response_str
         except json.JSONDecodeError:
             content = response_str
 
-        patterns = [
-            r'```json\n(.*?)\n```',      # match *any* JSON inside fences
-            r'```\n(.*?)\n```',
-            r'({.*?})',                  # raw JSON object
-            r'(\[.*?\])'                 # raw JSON array
-        ]
+        # JSON-mode output is nothing but the JSON itself
+        try:
+            parsed = json.loads(content)
+            if isinstance(parsed, (dict, list)):
+                return parsed
+        except json.JSONDecodeError:
+            pass
 
-        for pattern in patterns:
-            match = re.search(pattern, content, re.DOTALL)
-            if match:
-                try:
-                    return json.loads(match.group(1))
-                except json.JSONDecodeError:
-                    continue
+        try:
+            return locate_json(content)
+        except ValueError:
+            pass
 
         raise ValueError(f"No valid JSON found in response:\n{content[:500]}...")
 
     @staticmethod
     def parse_entities_from_extracted(extracted: Union[List[Dict[str, Any]], Dict[str, Any]]) -> Dict[str, List[Any]]:
         """
-        Convert batched extracted list into a mapping: input_text → list of entity dicts
+        Convert batched extracted list into a mapping: input_text → list of Entity records
         Each extracted item should have:
         {
             "input": "original input string",
             "<entity_type>": [...]
         }
         """
+        if isinstance(extracted, dict) and isinstance(extracted.get(RESULTS_KEY), list):
+            extracted = extracted[RESULTS_KEY]  # JSON-mode output wraps the array in an object
         if isinstance(extracted, dict):
             extracted = [extracted]  # treat single object as one-item list
 
@@ -205,11 +672,7 @@ class Extractor:
 
                         if clean_text and clean_text.lower() != "null":
                             extra_fields = {k: v[k] for k in v if k not in {label, "name", "email", "number"}}
-                            all_entities.append({
-                                "label": label,
-                                "clean_text": clean_text,
-                                "extra_fields": extra_fields
-                            })
+                            all_entities.append(Entity(label, clean_text, extra_fields))
 
             entity_map[input_text] = all_entities
 
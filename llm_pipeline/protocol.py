@@ -0,0 +1,92 @@
+from typing import Any, Dict, List
+
+from dataclass import Entity
+from schema import entity_fields
+
+# One-letter keys for the compact protocol; categories not listed here keep their name
+SHORT_CODES = {
+    "name": "n",
+    "organisation": "o",
+    "email": "e",
+    "phone_number": "p",
+    "relationship": "r",
+    "date": "d",
+    "country": "c",
+    "airport_code": "a",
+    "salutation": "s",
+    "plate": "v",
+    "id": "i",
+}
+
+PROTOCOLS = ("echo", "compact")
+
+
+def category_codes(template: str) -> Dict[str, str]:
+    """Short code → category for the categories a template extracts"""
+    return {SHORT_CODES.get(category, category): category for category in entity_fields(template)}
+
+
+def compact_instruction(template: str) -> str:
+    """
+    Output instructions for the compact protocol, appended to the template (whose own
+    output format they replace): one object keyed by the input's line number, short
+    category codes, entity strings only and no echo of the input.
+    """
+    fields = entity_fields(template)
+    codes = ", ".join(f"{SHORT_CODES.get(category, category)} = {category}" for category in fields)
+    multi_field = [f"{category} as [{', '.join(names)}]" for category, names in fields.items() if len(names) > 1]
+    instruction = (
+        "\n\nOUTPUT FORMAT (this replaces the output format described above):\n"
+        'Return a single JSON object keyed by the line number of each input ("1", "2", ...). '
+        "Do NOT repeat the input text. Each value is an object mapping category codes to lists of the "
+        "extracted strings, copied exactly from the input; omit categories with no entities and use {} "
+        "for an input with none.\n"
+        f"Category codes: {codes}.\n"
+    )
+    if multi_field:
+        instruction += f"An entity with extra fields may be written as a list: {'; '.join(multi_field)}.\n"
+    instruction += 'Example: {"1": {"n": ["TanAhKow"], "d": ["20Nov2005"]}, "2": {}}\n'
+    if "{user_input}" in template:
+        # The template is filled with str.format(), so literal braces must be doubled
+        instruction = instruction.replace("{", "{{").replace("}", "}}")
+    return instruction
+
+
+def compact_schema(template: str) -> Dict[str, Any]:
+    """JSON schema of compact output, for schema-constrained decoding"""
+    entity = {"anyOf": [{"type": "string"}, {"type": "array", "items": {"type": "string"}}]}
+    return {
+        "type": "object",
+        "additionalProperties": {
+            "type": "object",
+            "properties": {code: {"type": "array", "items": entity} for code in category_codes(template)},
+            "additionalProperties": False,
+        },
+    }
+
+
+def parse_compact(extracted: Any, codes: Dict[str, str], fields: Dict[str, List[str]]) -> Dict[int, List[Entity]]:
+    """
+    Convert compact output into line number (1-based) → Entity records, in the same
+    shape as Extractor.parse_entities_from_extracted produces.
+    """
+    if not isinstance(extracted, dict):
+        raise ValueError(f"Compact output must be a JSON object keyed by line number, got {type(extracted).__name__}")
+
+    entity_map = {}
+    for index, record in extracted.items():
+        if not str(index).strip().isdigit() or not isinstance(record, dict):
+            continue
+        entities = []
+        for code, values in record.items():
+            label = codes.get(code, code)
+            for value in values if isinstance(values, list) else [values]:
+                parts = value if isinstance(value, list) else [value]
+                clean_text = str(parts[0]).strip() if parts and parts[0] is not None else ""
+                if not clean_text or clean_text.lower() == "null":
+                    continue
+                names = fields.get(label, [label])
+                extra_fields = {name: part for name, part in zip(names[1:], parts[1:]) if part is not None}
+                entities.append(Entity(label, clean_text, extra_fields))
+        entity_map[int(str(index).strip())] = entities
+    return entity_map
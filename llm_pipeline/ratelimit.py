@@ -0,0 +1,219 @@
+import asyncio
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Dict, Any, Optional
+
+from models import APIError
+from tokens import estimate_tokens
+
+# Statuses worth retrying: throttling, timeouts and transient server errors
+RETRYABLE_STATUSES = {408, 429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    """Thread-safe token bucket refilled continuously at rate_per_sec, holding at most capacity"""
+    def __init__(self, rate_per_sec: float, capacity: float):
+        self.rate_per_sec = rate_per_sec
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount: float) -> float:
+        """
+        Take amount tokens (the balance may go negative) and return how long the
+        caller must wait before it is allowed to proceed.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate_per_sec)
+            self._updated = now
+            self._tokens -= min(amount, self.capacity)
+            return max(0.0, -self._tokens / self.rate_per_sec)
+
+
+class RateLimiter:
+    """
+    Client-side limit on requests/min and tokens/min, shared by every caller
+    (threads and coroutines) that holds the same instance.
+    """
+    def __init__(self, requests_per_min: float = None, tokens_per_min: float = None):
+        self.requests = TokenBucket(requests_per_min / 60.0, requests_per_min) if requests_per_min else None
+        self.tokens = TokenBucket(tokens_per_min / 60.0, tokens_per_min) if tokens_per_min else None
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _reserve(self, tokens: int) -> float:
+        wait = 0.0
+        if self.requests:
+            wait = max(wait, self.requests.reserve(1))
+        if self.tokens:
+            wait = max(wait, self.tokens.reserve(tokens))
+        with self._lock:
+            wait = max(wait, self._paused_until - time.monotonic())
+        return wait
+
+    def acquire(self, tokens: int = 0):
+        """Block until one request of `tokens` tokens may be sent"""
+        wait = self._reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+
+    async def aacquire(self, tokens: int = 0):
+        wait = self._reserve(tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def pause(self, seconds: float):
+        """Hold back all callers, e.g. after the server asked us to back off"""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def paused_for(self) -> float:
+        """Seconds left of the current pause (0.0 when not paused)"""
+        with self._lock:
+            return max(0.0, self._paused_until - time.monotonic())
+
+
+_shared_limiters: Dict[str, RateLimiter] = {}
+_shared_lock = threading.Lock()
+
+
+def get_rate_limiter(name: str, requests_per_min: float = None, tokens_per_min: float = None) -> RateLimiter:
+    """Process-wide limiter per endpoint URL or model name; limits apply on first creation"""
+    with _shared_lock:
+        if name not in _shared_limiters:
+            _shared_limiters[name] = RateLimiter(requests_per_min, tokens_per_min)
+        return _shared_limiters[name]
+
+
+def parse_retry_after(headers: Dict[str, str]) -> Optional[float]:
+    """Seconds to wait according to retry-after-ms / Retry-After (delta seconds or HTTP date)"""
+    headers = {k.lower(): v for k, v in (headers or {}).items()}
+    if "retry-after-ms" in headers:
+        try:
+            return float(headers["retry-after-ms"]) / 1000.0
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def request_tokens(client, system_prompt: str, user_prompt: str) -> int:
+    """Rate-limit cost of a request: prompt tokens plus the client's completion budget"""
+    params = getattr(client, "parameters", None) or {}
+    max_output = params.get("max_new_tokens") or params.get("max_tokens") or 0
+    return estimate_tokens(system_prompt) + estimate_tokens(user_prompt) + max_output
+
+
+class RetryPolicy:
+    """Exponential backoff with full jitter, capped at max_delay; Retry-After takes precedence"""
+    def __init__(self, max_retries: int = 5, base_delay: float = 1.0, max_delay: float = 60.0):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def is_retryable(self, error: Exception) -> bool:
+        if isinstance(error, APIError):
+            return error.status in RETRYABLE_STATUSES
+        return isinstance(error, (OSError, TimeoutError))
+
+    def delay(self, attempt: int, error: Exception) -> float:
+        retry_after = parse_retry_after(error.headers) if isinstance(error, APIError) else None
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+class RetryingClient:
+    """
+    Wraps a model client with a shared RateLimiter and RetryPolicy.
+
+    Each attempt first waits for rate-limit budget (prompt tokens plus the requested
+    completion budget). A 429 pauses a limiter for the server's Retry-After, so
+    concurrent callers back off together instead of hammering the endpoint: the
+    throttled endpoint's own limiter when the error carries one (BalancedClient, whose
+    other replicas keep serving and take the retry), otherwise this client's limiter.
+    """
+    def __init__(self, client, limiter: RateLimiter = None, policy: RetryPolicy = None):
+        self.client = client
+        self.limiter = limiter or RateLimiter()
+        self.policy = policy or RetryPolicy()
+        self.retries = 0
+        self.throttled = 0
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def _request_tokens(self, system_prompt: str, user_prompt: str) -> int:
+        return request_tokens(self.client, system_prompt, user_prompt)
+
+    def _on_failure(self, attempt: int, error: Exception) -> float:
+        """Return the backoff delay, or re-raise when the error is final"""
+        if attempt >= self.policy.max_retries or not self.policy.is_retryable(error):
+            raise error
+        delay = self.policy.delay(attempt, error)
+        if isinstance(error, APIError) and error.status == 429:
+            self.throttled += 1
+            if error.limiter is None:
+                self.limiter.pause(delay)
+            else:
+                error.limiter.pause(delay)
+                # Only that endpoint backs off: the retry goes to another one right away,
+                # or waits out the pause when every endpoint is throttled
+                delay = 0.0
+        self.retries += 1
+        print(f"[Warning] Request failed ({error.__class__.__name__}: {str(error).splitlines()[0]}), "
+              f"retry {attempt + 1}/{self.policy.max_retries} in {delay:.1f}s")
+        return delay
+
+    def generate_completion(self, system_prompt: str, user_prompt: str, timing: Dict[str, Any] = None):
+        tokens = self._request_tokens(system_prompt, user_prompt)
+        for attempt in range(self.policy.max_retries + 1):
+            self.limiter.acquire(tokens)
+            try:
+                return self.client.generate_completion(system_prompt, user_prompt, timing=timing)
+            except Exception as e:
+                time.sleep(self._on_failure(attempt, e))
+
+    async def agenerate_completion(self, system_prompt: str, user_prompt: str, timing: Dict[str, Any] = None):
+        tokens = self._request_tokens(system_prompt, user_prompt)
+        for attempt in range(self.policy.max_retries + 1):
+            await self.limiter.aacquire(tokens)
+            try:
+                return await self.client.agenerate_completion(system_prompt, user_prompt, timing=timing)
+            except Exception as e:
+                await asyncio.sleep(self._on_failure(attempt, e))
+
+    async def astream_completion(self, system_prompt: str, user_prompt: str, timing: Dict[str, Any] = None):
+        """Retries only apply until the first chunk arrives; later failures propagate"""
+        tokens = self._request_tokens(system_prompt, user_prompt)
+        for attempt in range(self.policy.max_retries + 1):
+            await self.limiter.aacquire(tokens)
+            started = False
+            try:
+                async for chunk in self.client.astream_completion(system_prompt, user_prompt, timing=timing):
+                    started = True
+                    yield chunk
+                return
+            except Exception as e:
+                if started:
+                    raise
+                await asyncio.sleep(self._on_failure(attempt, e))
+
+    async def aclose(self):
+        await self.client.aclose()
+
+    def stats(self) -> Dict[str, int]:
+        return {"retries": self.retries, "throttled": self.throttled}
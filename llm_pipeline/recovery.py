@@ -0,0 +1,113 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, List, Tuple
+
+
+def _normalise(text: str) -> str:
+    """Echoed inputs often differ from the original in whitespace or case only"""
+    return "".join(text.split()).casefold()
+
+
+def align_outputs(batch: List[Any], entity_map: Dict[Any, list]) -> Tuple[Dict[int, list], List[Any]]:
+    """
+    Assign a response's per-input outputs to the batch's instances.
+
+    Outputs keyed by line number (the compact protocol) are matched by index.
+    Echo-protocol outputs are matched by position when the response has one output
+    per input (the original behaviour, robust to the model mangling its echo of the
+    input), and otherwise to the instance whose text they echo. Instances without
+    an output are reported as missing.
+
+    Returns:
+        (text_id → entities, instances with no output)
+    """
+    if entity_map and all(isinstance(key, int) for key in entity_map):
+        predictions = {inst.text_id: entity_map[j + 1] for j, inst in enumerate(batch) if j + 1 in entity_map}
+        return predictions, [inst for j, inst in enumerate(batch) if j + 1 not in entity_map]
+
+    if len(entity_map) == len(batch):
+        return {inst.text_id: entities for inst, entities in zip(batch, entity_map.values())}, []
+
+    outputs = {_normalise(text): entities for text, entities in entity_map.items()}
+    predictions = {}
+    missing = []
+    for inst in batch:
+        entities = outputs.get(_normalise(inst.text))
+        if entities is None:
+            missing.append(inst)
+        else:
+            predictions[inst.text_id] = entities
+    return predictions, missing
+
+
+def is_request_error(error: Exception) -> bool:
+    """A failed request (unlike an unparseable response, a ValueError) is worth sending again"""
+    return error is not None and not isinstance(error, ValueError)
+
+
+class RecoveryBudget:
+    """Extra requests a run may spend re-submitting failed inputs (shared by all batches)"""
+    def __init__(self, max_requests: int):
+        self.max_requests = max_requests
+        self.used = 0
+
+    def take(self) -> bool:
+        if self.used >= self.max_requests:
+            return False
+        self.used += 1
+        return True
+
+
+class BatchRecovery:
+    """
+    Re-submits the inputs of a batch that got no usable output.
+
+    query(instances) sends the instances as one batch and returns the parsed
+    Extractor.entity_map, raising if the request fails or the response cannot
+    be parsed. Missing inputs are re-sent as a smaller batch; a batch whose whole
+    response is invalid is split in half and each half retried. A single input is
+    sent again after a failed request, and lost once its response is unparseable or
+    the budget is spent.
+    """
+    def __init__(self, query: Callable[[List[Any]], Awaitable[Dict[str, list]]], budget: RecoveryBudget):
+        self.query = query
+        self.budget = budget
+        self.recovered = 0
+        self.lost: List[int] = []
+
+    async def recover(self, instances: List[Any], response_failed: bool, error: Exception = None) -> Dict[int, list]:
+        """
+        Recover predictions for instances left without output by an earlier attempt.
+        response_failed says whether that attempt produced nothing usable at all, and
+        error is what it raised, if anything.
+        """
+        if response_failed:
+            if len(instances) == 1:
+                if is_request_error(error):
+                    return await self._resubmit(instances)
+                # Sending the same input alone again would get the same answer
+                self.lost.append(instances[0].text_id)
+                return {}
+            middle = len(instances) // 2
+            halves = await asyncio.gather(
+                self._resubmit(instances[:middle]),
+                self._resubmit(instances[middle:])
+            )
+            return {**halves[0], **halves[1]}
+        return await self._resubmit(instances)
+
+    async def _resubmit(self, instances: List[Any]) -> Dict[int, list]:
+        if not self.budget.take():
+            self.lost.extend(inst.text_id for inst in instances)
+            return {}
+        try:
+            entity_map = await self.query(instances)
+        except Exception as e:
+            print(f"[Warning] Recovery of {len(instances)} input(s) failed: {e}")
+            return await self.recover(instances, response_failed=True, error=e)
+
+        predictions, missing = align_outputs(instances, entity_map)
+        self.recovered += len(predictions)
+        if missing:
+            # No progress at all counts as an invalid response, so the next attempt differs
+            predictions.update(await self.recover(missing, response_failed=not predictions))
+        return predictions
@@ -0,0 +1,217 @@
+import argparse
+import hashlib
+import json
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional
+
+import pandas as pd
+
+from dataclass import to_json
+from dataset_load import Dataset
+from dedup import dedupe_instances
+from evaluation import Evaluator, EVAL_LABELS
+from models import Extractor
+from prompt_template import prompt_map
+from recovery import align_outputs
+from results_store import ResultsStore
+
+# Sources whose behaviour determines the replayed outputs; a change to any of them invalidates every run
+CODE_FILES = (
+    "replay.py", "models.py", "json_stream.py", "protocol.py", "schema.py", "recovery.py",
+    "evaluation.py", "assignment.py", "similarity.py", "dataset_load.py", "dataclass.py", "dedup.py", "prompt_template.py",
+)
+
+FINGERPRINT_FILE = "replay.json"
+
+_RESPONSE_FILE = re.compile(r"response_batch_(\d+)(?:_retry(\d+))?\.json$")
+
+# Per worker process: dataset path → (content hash, loaded Dataset)
+_datasets: Dict[str, Any] = {}
+
+
+def _sha256(path: Path) -> str:
+    return hashlib.sha256(path.read_bytes()).hexdigest()
+
+
+def code_version(source_dir: Path = Path(__file__).parent) -> str:
+    """Hash of the parsing and scoring code"""
+    digest = hashlib.sha256()
+    for name in CODE_FILES:
+        digest.update(name.encode())
+        digest.update((source_dir / name).read_bytes())
+    return digest.hexdigest()
+
+
+def find_runs(base_dir: Path) -> List[Path]:
+    """Run directories under base_dir ([set]/[batch]/[prompt]/run[n]) that have stored responses"""
+    return sorted(path.parent for path in base_dir.glob("*/*/*/run*/api_responses"))
+
+
+def response_files(run_dir: Path) -> List[Path]:
+    """A run's stored responses, each batch's first request before its recovery requests"""
+    files = []
+    for path in (run_dir / "api_responses").glob("response_batch_*.json"):
+        match = _RESPONSE_FILE.search(path.name)
+        if match:
+            files.append(((int(match.group(1)), int(match.group(2) or 0)), path))
+    return [path for _, path in sorted(files)]
+
+
+def _load_dataset(path: Path):
+    key = str(path)
+    if key not in _datasets:
+        # Mapped rather than parsed: the worker processes share the file through the page cache
+        dataset = Dataset(jsonl_path=path, lazy=True)
+        dataset.load()
+        _datasets[key] = (_sha256(path), dataset)
+    return _datasets[key]
+
+
+def replay_predictions(files: List[Path], extractor: Extractor, instances: List[Any]) -> Dict[str, list]:
+    """
+    Re-parse a run's stored responses into text_id → entities, as Main.run would have
+    merged them: an input keeps the first output it got, and inputs sent only once as
+    representatives of duplicate texts pass their output on to the duplicates.
+    """
+    predictions: Dict[int, list] = {}
+    for path in files:
+        with open(path, "r", encoding="utf-8") as f:
+            stored = json.load(f)
+        batch = [SimpleNamespace(text_id=text_id, text=text) for text_id, text in zip(stored["text_ids"], stored["texts"])]
+        try:
+            entity_map = extractor.entity_map(extractor.parse_response(stored["response"]))
+        except Exception as e:
+            print(f"[Warning] {path}: {e}".splitlines()[0])
+            continue
+        for text_id, entities in align_outputs(batch, entity_map)[0].items():
+            predictions.setdefault(text_id, entities)
+
+    _, duplicates = dedupe_instances(instances)
+    for representative_id, duplicate_ids in duplicates.items():
+        for text_id in duplicate_ids:
+            if text_id not in predictions and representative_id in predictions:
+                predictions[text_id] = predictions[representative_id]
+    return {str(inst.text_id): predictions.get(inst.text_id, []) for inst in instances}
+
+
+def replay_run(run_dir: Path, dataset_base: Path, code_hash: str, force: bool = False) -> Dict[str, Any]:
+    """
+    Re-parse and re-score one run from its stored responses, unless its responses,
+    dataset and the parsing/scoring code are unchanged since the last replay.
+
+    Returns:
+        {"run_dir", "status": "rescored" | "unchanged" | "skipped", "micro_f1"}
+    """
+    set_name, batch_name, prompt_tag = run_dir.parts[-4:-1]
+    dataset_path = dataset_base / f"{set_name}_entity_dataset" / f"test_input_{batch_name}.jsonl"
+    if not dataset_path.exists():
+        print(f"[Warning] {run_dir}: dataset {dataset_path} not found, skipping")
+        return {"run_dir": str(run_dir), "status": "skipped", "micro_f1": None}
+
+    metrics_path = run_dir / "metrics.json"
+    metrics = {}
+    if metrics_path.exists():
+        with open(metrics_path, "r", encoding="utf-8") as f:
+            metrics = json.load(f)
+    protocol = metrics.get("output_protocol", "echo")
+
+    dataset_hash, dataset = _load_dataset(dataset_path)
+    files = response_files(run_dir)
+    digest = hashlib.sha256(f"{code_hash}\n{dataset_hash}\n{prompt_tag}\n{protocol}\n".encode())
+    for path in files:
+        digest.update(f"{path.name}\n".encode())
+        digest.update(path.read_bytes())
+    fingerprint = digest.hexdigest()
+
+    fingerprint_path = run_dir / FINGERPRINT_FILE
+    if not force and fingerprint_path.exists():
+        with open(fingerprint_path, "r", encoding="utf-8") as f:
+            if json.load(f).get("fingerprint") == fingerprint:
+                return {"run_dir": str(run_dir), "status": "unchanged", "micro_f1": metrics.get("micro_f1")}
+
+    template = prompt_map.get(prompt_tag.lower(), prompt_map["default"])
+    extractor = Extractor(protocol, template)
+    predictions = replay_predictions(files, extractor, dataset.instances)
+
+    evaluator = Evaluator(dataset, labels_to_consider=EVAL_LABELS)
+    results = evaluator.evaluate(predictions)
+    df_instance, df_label = evaluator.results_to_dataframe(results)
+
+    # Latency estimates are not replayable; keep the ones the run recorded
+    per_instance_path = run_dir / "per_instance.csv"
+    if per_instance_path.exists():
+        previous = pd.read_csv(per_instance_path)
+        if "est_latency_sec" in previous.columns:
+            df_instance["est_latency_sec"] = df_instance["text_id"].map(previous.set_index("text_id")["est_latency_sec"])
+
+    with open(run_dir / "raw_predictions.json", "w") as f:
+        json.dump(predictions, f, indent=2, default=to_json)
+    df_instance.to_csv(per_instance_path, index=False)
+    df_label.to_csv(run_dir / "per_label.csv", index=False)
+
+    metrics.update({
+        "micro_precision": results["micro_precision"],
+        "micro_recall": results["micro_recall"],
+        "micro_f1": results["micro_f1"],
+        "per_instance_precision_buckets": results["per_instance_precision_buckets"],
+        "per_instance_recall_buckets": results["per_instance_recall_buckets"],
+    })
+    # Runs written before the buckets were renamed
+    if "precision_buckets" in metrics:
+        metrics["precision_buckets"] = results["per_instance_precision_buckets"]
+        metrics["recall_buckets"] = results["per_instance_recall_buckets"]
+    with open(metrics_path, "w", encoding="utf-8") as f:
+        json.dump(metrics, f, indent=2)
+
+    with open(fingerprint_path, "w", encoding="utf-8") as f:
+        json.dump({"fingerprint": fingerprint, "code_version": code_hash, "replayed_at": time.time()}, f, indent=2)
+    return {"run_dir": str(run_dir), "status": "rescored", "micro_f1": results["micro_f1"]}
+
+
+def replay_tree(base_dir: Path, dataset_base: Path, workers: Optional[int] = None, force: bool = False,
+                results_db: Optional[Path] = None) -> List[Dict[str, Any]]:
+    """Replay every run under base_dir over a process pool, re-recording rescored runs in results_db"""
+    runs = find_runs(base_dir)
+    code_hash = code_version()
+    outcomes = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(replay_run, run_dir, dataset_base, code_hash, force): run_dir for run_dir in runs}
+        for future in as_completed(futures):
+            try:
+                outcomes.append(future.result())
+            except Exception as e:
+                print(f"[Error] Replay of {futures[future]} failed: {e}")
+                outcomes.append({"run_dir": str(futures[future]), "status": "failed", "micro_f1": None})
+
+    if results_db is not None:
+        store = ResultsStore(results_db)
+        try:
+            for outcome in outcomes:
+                if outcome["status"] == "rescored":
+                    store.import_run(Path(outcome["run_dir"]))
+        finally:
+            store.close()
+    return sorted(outcomes, key=lambda outcome: outcome["run_dir"])
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Re-parse stored responses and re-score every run, without calling the model")
+    parser.add_argument("--base_dir", type=str, default="./experiment_outputs", help="Tree of [set]/[batch]/[prompt]/run[n] directories")
+    parser.add_argument("--dataset_base", type=str, default="./datasets", help="Directory holding the [set]_entity_dataset folders")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes (default: one per CPU)")
+    parser.add_argument("--results_db", type=str, default=None, help="SQLite results store to re-record rescored runs in")
+    parser.add_argument("--force", action="store_true", help="Rescore runs whose inputs are unchanged too")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    start = time.time()
+    outcomes = replay_tree(Path(args.base_dir), Path(args.dataset_base), args.workers, args.force,
+                           Path(args.results_db) if args.results_db else None)
+    counts = {status: sum(outcome["status"] == status for outcome in outcomes) for status in ("rescored", "unchanged", "skipped", "failed")}
+    print(f"Replayed {len(outcomes)} runs in {time.time() - start:.1f}s: " + ", ".join(f"{n} {status}" for status, n in counts.items()))
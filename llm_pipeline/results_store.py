@@ -0,0 +1,248 @@
+import hashlib
+import json
+import sqlite3
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
+
+import pandas as pd
+
+from latency import summarise
+
+# A run is identified by these columns (and stored once per run directory)
+RUN_KEY = ["entity_type", "batch", "prompt", "run", "model"]
+
+BUCKETS = {"100": "100", "70-99": "70_99", "30-69": "30_69", "0-29": "0_29"}
+LATENCY_STATS = ("p50", "p90", "p95", "p99", "max")
+LATENCY_METRICS = ("batch_latency_sec", "ttfb_sec", "instance_latency_sec")
+
+BUCKET_COLUMNS = [f"{kind}_{suffix}" for kind in ("precision", "recall") for suffix in BUCKETS.values()]
+METRIC_COLUMNS = (
+    ["micro_f1", "micro_precision", "micro_recall", "avg_latency_sec"]
+    + BUCKET_COLUMNS
+    + ["wall_time_sec"]
+    + [f"{name}_{stat}" for name in LATENCY_METRICS for stat in LATENCY_STATS]
+)
+SCORE_COLUMNS = [f"{prefix}_{metric}" for prefix in ("partial", "edit", "normalised_exact") for metric in ("precision", "recall", "f1")]
+LABEL_COLUMNS = ["label", "precision", "recall", "f1", *SCORE_COLUMNS, "tp", "fp", "fn"]
+INSTANCE_COLUMNS = ["text_id", "precision", "recall", "f1", *SCORE_COLUMNS, "est_latency_sec"]
+BATCH_COLUMNS = ["latency_sec", "ttfb_sec", "wall_sec", "server_sec", "client_sec", "cache_hit"]
+
+# Columns averaged over the runs of a (entity_type, batch, prompt) group
+AVERAGED_COLUMNS = ["micro_f1", "micro_precision", "micro_recall", "avg_latency_sec"] + BUCKET_COLUMNS
+
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY,
+    {", ".join(f"{column} TEXT" for column in RUN_KEY)},
+    run_dir TEXT UNIQUE NOT NULL,
+    recorded_at REAL,
+    metrics_sha256 TEXT,
+    {", ".join(f"{column} {'INTEGER' if column in BUCKET_COLUMNS else 'REAL'}" for column in METRIC_COLUMNS)},
+    metrics TEXT
+);
+CREATE INDEX IF NOT EXISTS runs_by_key ON runs ({", ".join(RUN_KEY)});
+CREATE TABLE IF NOT EXISTS label_results (run_id INTEGER NOT NULL, {", ".join(LABEL_COLUMNS)});
+CREATE INDEX IF NOT EXISTS label_results_by_run ON label_results (run_id);
+CREATE INDEX IF NOT EXISTS label_results_by_label ON label_results (label);
+CREATE TABLE IF NOT EXISTS instance_results (run_id INTEGER NOT NULL, {", ".join(INSTANCE_COLUMNS)});
+CREATE INDEX IF NOT EXISTS instance_results_by_run ON instance_results (run_id, text_id);
+CREATE TABLE IF NOT EXISTS batch_latency (run_id INTEGER NOT NULL, {", ".join(BATCH_COLUMNS)});
+CREATE INDEX IF NOT EXISTS batch_latency_by_run ON batch_latency (run_id);
+"""
+
+CHILD_TABLES = {"label_results": LABEL_COLUMNS, "instance_results": INSTANCE_COLUMNS, "batch_latency": BATCH_COLUMNS}
+# Columns added to existing stores when opened
+MIGRATED_COLUMNS = {**CHILD_TABLES, "runs": ["metrics_sha256"]}
+
+
+def run_key(dataset_path: Path, prompt_tag: str, run_tag: str, model: Optional[str]) -> Dict[str, Optional[str]]:
+    """Key of a run of datasets/[set]_entity_dataset/test_input_[batch].jsonl"""
+    dataset_path = Path(dataset_path)
+    return {
+        "entity_type": dataset_path.parent.name.replace("_entity_dataset", ""),
+        "batch": dataset_path.stem.replace("test_input_", ""),
+        "prompt": prompt_tag,
+        "run": run_tag,
+        "model": model,
+    }
+
+
+def metric_columns(metrics: Dict[str, Any]) -> Dict[str, Any]:
+    """The per-run columns of a metrics.json (older runs name the buckets precision_/recall_buckets)"""
+    columns = {name: metrics.get(name) for name in ("micro_f1", "micro_precision", "micro_recall", "avg_latency_sec", "wall_time_sec")}
+    for kind in ("precision", "recall"):
+        buckets = metrics.get(f"per_instance_{kind}_buckets") or metrics.get(f"{kind}_buckets") or {}
+        for bucket, suffix in BUCKETS.items():
+            columns[f"{kind}_{suffix}"] = buckets.get(bucket, 0)
+    # Runs written before latency distributions were recorded have no "latency" block
+    latency = metrics.get("latency", {})
+    for name in LATENCY_METRICS:
+        for stat in LATENCY_STATS:
+            columns[f"{name}_{stat}"] = latency.get(name, {}).get(stat)
+    return columns
+
+
+def metrics_sha256(run_dir: Path) -> Optional[str]:
+    """Content hash of a run's metrics.json, None when it has none"""
+    try:
+        return hashlib.sha256((Path(run_dir) / "metrics.json").read_bytes()).hexdigest()
+    except FileNotFoundError:
+        return None
+
+
+def load_batch_latency(run_dir: Path) -> pd.DataFrame:
+    """Per-batch latency rows of a run; older runs only have the latency stored with each raw response"""
+    if (run_dir / "batch_latency.csv").exists():
+        return pd.read_csv(run_dir / "batch_latency.csv")
+    rows = []
+    for response_file in (run_dir / "api_responses").glob("response_batch_*.json"):
+        with open(response_file, "r") as f:
+            rows.append({"latency_sec": json.load(f).get("latency")})
+    return pd.DataFrame(rows, columns=["latency_sec", "ttfb_sec", "wall_sec"])
+
+
+class ResultsStore:
+    """
+    SQLite store of run results: one row per run (key, headline metrics, metrics.json)
+    plus its per-label, per-instance and per-batch latency rows, indexed by run key.
+    Runs record themselves as they finish, so summaries never re-read run directories.
+    """
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # Several runs (processes) may record at once; SQLite serialises the writers
+        self.conn = sqlite3.connect(self.path, timeout=60)
+        self.conn.executescript(SCHEMA)
+        # Stores created before a column was added get it (empty for the runs already stored)
+        for table, columns in MIGRATED_COLUMNS.items():
+            existing = {row[1] for row in self.conn.execute(f"PRAGMA table_info({table})")}
+            for column in columns:
+                if column not in existing:
+                    self.conn.execute(f"ALTER TABLE {table} ADD COLUMN {column}")
+
+    def close(self):
+        self.conn.close()
+
+    def record_run(self, key: Dict[str, Optional[str]], run_dir: Path, metrics: Dict[str, Any],
+                   per_instance: Union[pd.DataFrame, Iterable[pd.DataFrame]], per_label: pd.DataFrame,
+                   batch_latency: Optional[pd.DataFrame] = None):
+        """
+        Store a run's results, replacing what was stored for the same run directory.
+        Rows may come as one DataFrame or as chunks (e.g. read_csv(..., chunksize=...)).
+        The hash of the run's metrics.json is kept so import_tree can tell when it changes.
+        """
+        run_dir = str(Path(run_dir).resolve())
+        row = {**{column: key.get(column) for column in RUN_KEY}, "run_dir": run_dir, "recorded_at": time.time(),
+               "metrics_sha256": metrics_sha256(run_dir), **metric_columns(metrics), "metrics": json.dumps(metrics)}
+        with self.conn:
+            previous = self.conn.execute("SELECT run_id FROM runs WHERE run_dir = ?", (run_dir,)).fetchone()
+            if previous is not None:
+                for table in ("runs", *CHILD_TABLES):
+                    self.conn.execute(f"DELETE FROM {table} WHERE run_id = ?", previous)
+            cursor = self.conn.execute(
+                f"INSERT INTO runs ({', '.join(row)}) VALUES ({', '.join('?' for _ in row)})", list(row.values())
+            )
+            run_id = cursor.lastrowid
+            frames = {"label_results": per_label, "instance_results": per_instance, "batch_latency": batch_latency}
+            for table, columns in CHILD_TABLES.items():
+                chunks = frames[table]
+                if chunks is None:
+                    continue
+                for frame in ([chunks] if isinstance(chunks, pd.DataFrame) else chunks):
+                    if frame.empty:
+                        continue
+                    rows = frame.reindex(columns=columns)
+                    rows = rows.astype(object).where(rows.notna(), None)
+                    self.conn.executemany(
+                        f"INSERT INTO {table} (run_id, {', '.join(columns)}) VALUES (?, {', '.join('?' for _ in columns)})",
+                        ((run_id, *record) for record in rows.itertuples(index=False, name=None))
+                    )
+
+    def import_run(self, run_dir: Path, model: Optional[str] = None):
+        """Store a run from its output files ([set]/[batch]/[prompt]/run[n] directory)"""
+        run_dir = Path(run_dir)
+        with open(run_dir / "metrics.json", "r", encoding="utf-8") as f:
+            metrics = json.load(f)
+        entity_type, batch, prompt, run = run_dir.parts[-4:]
+        key = {"entity_type": entity_type, "batch": batch, "prompt": prompt, "run": run, "model": metrics.get("model", model)}
+        per_instance = pd.read_csv(run_dir / "per_instance.csv", chunksize=10000) if (run_dir / "per_instance.csv").exists() else None
+        per_label = pd.read_csv(run_dir / "per_label.csv") if (run_dir / "per_label.csv").exists() else None
+        self.record_run(key, run_dir, metrics, per_instance, per_label, load_batch_latency(run_dir))
+
+    def recorded_run_dirs(self) -> Dict[str, Optional[str]]:
+        """Stored run directories with the hash of the metrics.json they were stored from"""
+        return dict(self.conn.execute("SELECT run_dir, metrics_sha256 FROM runs"))
+
+    def import_tree(self, base_dir: Path) -> int:
+        """
+        Store the runs under base_dir that are not stored yet (e.g. written before the
+        store existed) or whose metrics.json changed since they were stored
+        """
+        recorded = self.recorded_run_dirs()
+        imported = 0
+        for metrics_file in sorted(Path(base_dir).glob("*/*/*/run*/metrics.json")):
+            run_dir = str(metrics_file.parent.resolve())
+            if run_dir in recorded and recorded[run_dir] == metrics_sha256(run_dir):
+                continue
+            try:
+                self.import_run(metrics_file.parent)
+                imported += 1
+            except (OSError, ValueError, KeyError) as e:
+                print(f"[Warning] Could not import {metrics_file.parent}: {e}")
+        return imported
+
+    def _where(self, filters: Dict[str, Any], prefix: str = "") -> Tuple[str, List[Any]]:
+        clauses = [f"{prefix}{column} = ?" for column in filters if column in RUN_KEY]
+        params = [value for column, value in filters.items() if column in RUN_KEY]
+        return (" WHERE " + " AND ".join(clauses) if clauses else ""), params
+
+    def summary(self, **filters) -> pd.DataFrame:
+        """One row per run, optionally restricted to key values, e.g. summary(batch="b3")"""
+        where, params = self._where(filters)
+        return pd.read_sql_query(
+            f"SELECT {', '.join(RUN_KEY + METRIC_COLUMNS)}, run_dir FROM runs{where} ORDER BY {', '.join(RUN_KEY)}",
+            self.conn, params=params
+        )
+
+    def per_label(self, **filters) -> pd.DataFrame:
+        """Per-label rows of every matching run, with the run key"""
+        where, params = self._where(filters, "r.")
+        return pd.read_sql_query(
+            f"SELECT {', '.join('r.' + column for column in RUN_KEY)}, {', '.join('l.' + column for column in LABEL_COLUMNS)} "
+            f"FROM label_results l JOIN runs r ON r.run_id = l.run_id{where}",
+            self.conn, params=params
+        )
+
+    def averages(self, **filters) -> pd.DataFrame:
+        """
+        Metrics averaged over the runs of each (entity_type, batch, prompt), with batch
+        latency percentiles pooled over the batches of every run (averaging per-run
+        percentiles would understate the tail). Batches answered from the cache are left
+        out: their latency was measured by the run that first sent them.
+        """
+        group = ["entity_type", "batch", "prompt"]
+        where, params = self._where(filters)
+        averages = pd.read_sql_query(
+            f"SELECT {', '.join(group)}, {', '.join(f'AVG({column}) AS {column}' for column in AVERAGED_COLUMNS)} "
+            f"FROM runs{where} GROUP BY {', '.join(group)} ORDER BY {', '.join(group)}",
+            self.conn, params=params
+        )
+        where, params = self._where(filters, "r.")
+        where += (" AND " if where else " WHERE ") + "NOT COALESCE(b.cache_hit, 0)"
+        batches = pd.read_sql_query(
+            f"SELECT {', '.join('r.' + column for column in group)}, b.latency_sec, b.ttfb_sec, b.wall_sec "
+            f"FROM batch_latency b JOIN runs r ON r.run_id = b.run_id{where}",
+            self.conn, params=params
+        )
+        pooled = []
+        for values, rows in batches.groupby(group):
+            row = dict(zip(group, values))
+            for column in ("latency_sec", "ttfb_sec", "wall_sec"):
+                summary = summarise(rows[column].dropna().tolist())
+                for stat in LATENCY_STATS:
+                    row[f"batch_{column}_{stat}"] = summary[stat]
+            pooled.append(row)
+        if pooled:
+            averages = averages.merge(pd.DataFrame(pooled), on=group, how="left")
+        return averages
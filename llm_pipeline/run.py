@@ -1,7 +1,6 @@
 from main import Main
+from results_store import ResultsStore
 from pathlib import Path
-import json
-import pandas as pd
 
 # CONFIG
 dataset_base = Path("./datasets")
@@ -10,7 +9,7 @@ dataset_base = Path("./datasets")
 dataset_configs = [
     ("multi", "b1c"), 
     ("multi", "b2"), 
-    ("multi", "b3")
+    ("multi", "b3"),
     ("single", "b1c"),
     ("single", "b2"),
     ("single", "b3")
@@ -28,6 +27,9 @@ model_name = "llama-3.5-8b-instruct"
 output_base = Path("./experiment_outputs_salutation")
 output_base.mkdir(parents=True, exist_ok=True)
 
+# every run records its results here; summaries are queried from it
+results_db = output_base / "results.sqlite"
+
 # launch
 for set_name, batch_name in dataset_configs:
     dataset_path = dataset_base / f"{set_name}_entity_dataset" / f"test_input_{batch_name}.jsonl"
@@ -40,8 +42,12 @@ for set_name, batch_name in dataset_configs:
             "--dataset_path", str(dataset_path),
             "--output_dir", str(output_dir),
             "--prompt_tag", prompt_tag,
-            "--run_tag", f"run{repeat}"
+            "--run_tag", f"run{repeat}",
+            "--results_db", str(results_db)
         ]
+        # Repeats are meant to sample the model again, so only the first run may be served from cache
+        if repeat > 1:
+            args.append("--no_cache")
 
         print(f"\n=== Running: {set_name}-{batch_name} | prompt {prompt_tag} | run {repeat} ===\n")
 
@@ -51,65 +57,23 @@ for set_name, batch_name in dataset_configs:
 # generate summary.csv and averages.csv
 def generate_summary_and_averages(base_dir="./experiment_outputs"):
     base_path = Path(base_dir)
-    all_results = []
-
-    for metrics_file in base_path.rglob("*/run*/metrics.json"):
-        parts = metrics_file.parts
-        try:
-            entity_type = parts[-5]
-            batch = parts[-4]
-            prompt = parts[-3]
-            run = parts[-2]
-        except IndexError:
-            print(f"[Warning] Could not parse path: {metrics_file}")
-            continue
-
-        with open(metrics_file, "r") as f:
-            metrics = json.load(f)
-
-        all_results.append({
-            "entity_type": entity_type,
-            "batch": batch,
-            "prompt": prompt,
-            "run": run,
-            "micro_f1": metrics.get("micro_f1", 0.0),
-            "micro_precison": metrics.get("micro_precision", 0.0),
-            "micro_recall": metrics.get("micro_recall", 0.0),
-            "avg_latency_sec": metrics.get("avg_latency_sec", 0.0),
-            "precision_100": metrics["precision_buckets"].get("100", 0),
-            "precision_70_99": metrics["precision_buckets"].get("70-99", 0),
-            "precision_30_69": metrics["precision_buckets"].get("30-69", 0),
-            "precision_0_29": metrics["precision_buckets"].get("0-29", 0),
-            "recall_100": metrics["recall_buckets"].get("100", 0),
-            "recall_70_99": metrics["recall_buckets"].get("70-99", 0),
-            "recall_30_69": metrics["recall_buckets"].get("30-69", 0),
-            "recall_0_29": metrics["recall_buckets"].get("0-29", 0)
-        })
-
-    if not all_results:
-        print("No metrics found for summary.")
-        return
-
-    summary_df = pd.DataFrame(all_results)
-    summary_df.to_csv(base_path / "summary.csv", index=False)
-
-    avg_df = summary_df.groupby(["entity_type", "batch", "prompt"]).agg({
-        "micro_f1": "mean",
-        "micro_precision": "mean",
-        "micro_recall": "mean",
-        "avg_latency_sec": "mean",
-        "precision_100": "mean",
-        "precision_70_99": "mean",
-        "precision_30_69": "mean",
-        "precision_0_29": "mean",
-        "recall_100": "mean",
-        "recall_70_99": "mean",
-        "recall_30_69": "mean",
-        "recall_0_29": "mean"
-    }).reset_index()
-    avg_df.to_csv(base_path / "averages.csv", index=False)
+    store = ResultsStore(base_path / "results.sqlite")
+    try:
+        # Runs written without --results_db (or before the store existed) are imported once
+        imported = store.import_tree(base_path)
+        if imported:
+            print(f"Imported {imported} run(s) into {store.path}")
+
+        summary_df = store.summary()
+        if summary_df.empty:
+            print("No metrics found for summary.")
+            return
+        summary_df.to_csv(base_path / "summary.csv", index=False)
+        store.averages().to_csv(base_path / "averages.csv", index=False)
+    finally:
+        store.close()
 
     print(f"\nSummary and averages written to {base_path}/")
 
 # Call after all runs complete
-generate_summary_and_averages()
+generate_summary_and_averages(output_base)
@@ -0,0 +1,50 @@
+import re
+from typing import Any, Dict, List
+
+# Key under which constrained output wraps the per-input array (JSON modes require a top-level object)
+RESULTS_KEY = "results"
+
+# Appended to the system prompt when JSON mode is on (no braces: the Phi template is .format()ted)
+JSON_MODE_INSTRUCTION = f'\nReturn only JSON: an object whose "{RESULTS_KEY}" key holds the array of per-input objects.\n'
+
+# "<category>": [{"<field>": ..., "<field>": ...}  (Phi's template doubles the braces for .format())
+_CATEGORY_LIST = re.compile(r'"([a-z_]+)":\s*\[\s*\{\{?([^\]]*?)\}')
+_FIELD = re.compile(r'"([a-z_]+)"\s*:')
+
+
+def entity_fields(template: str) -> Dict[str, List[str]]:
+    """
+    Entity categories used in a prompt template's schema and examples, each with the
+    fields of its entity objects (first field = the entity text), e.g.
+    {"name": ["name", "alias"], "phone_number": ["number"], ...}.
+    """
+    categories: Dict[str, List[str]] = {}
+    for category, body in _CATEGORY_LIST.findall(template):
+        fields = categories.setdefault(category, [])
+        for field in _FIELD.findall(body):
+            if field not in fields:
+                fields.append(field)
+    return categories
+
+
+def extraction_schema(template: str) -> Dict[str, Any]:
+    """JSON schema of the output a template asks for, wrapped as {"results": [...]}"""
+    properties = {}
+    for category, fields in entity_fields(template).items():
+        properties[category] = {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {field: {"type": "string"} for field in fields},
+                "required": fields[:1],
+            },
+        }
+    record = {"type": "object", "properties": properties}
+    if '"input"' in template:
+        record["properties"] = {"input": {"type": "string"}, **properties}
+        record["required"] = ["input"]
+    return {
+        "type": "object",
+        "properties": {RESULTS_KEY: {"type": "array", "items": record}},
+        "required": [RESULTS_KEY],
+    }
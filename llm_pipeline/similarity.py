@@ -0,0 +1,77 @@
+import math
+from collections import Counter
+from typing import Any, Optional
+
+
+def normalise_text(text: Any) -> str:
+    """Entity text compared without case or whitespace ("Tan Ah Kow" == "tanahkow")"""
+    return "".join(str(text).split()).casefold() if text else ""
+
+
+def levenshtein(a: str, b: str, max_distance: Optional[int] = None) -> int:
+    """
+    Edit distance between a and b, computed bit-parallel (Myers/Hyyrö): each character
+    of b updates a whole column of the DP matrix as one integer operation.
+
+    With max_distance, returns max_distance + 1 as soon as the distance is known to
+    exceed it: from the length difference, the difference in character counts, or
+    once the remaining characters of b can no longer bring it back down.
+    """
+    if a == b:
+        return 0
+    if len(a) > len(b):
+        a, b = b, a  # the shorter string is the bit vector
+    m, n = len(a), len(b)
+    limit = n if max_distance is None else max_distance
+    if n - m > limit:
+        return limit + 1
+    if m == 0:
+        return n
+    if max_distance is not None:
+        # An edit changes the character counts by at most two
+        counts = Counter(a)
+        counts.subtract(b)
+        if (sum(map(abs, counts.values())) + 1) // 2 > limit:
+            return limit + 1
+
+    peq = {}
+    for i, ch in enumerate(a):
+        peq[ch] = peq.get(ch, 0) | (1 << i)
+    mask = (1 << m) - 1
+    high = 1 << (m - 1)
+    pv, mv, score = mask, 0, m
+    for j, ch in enumerate(b):
+        eq = peq.get(ch, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | ~(xh | pv)
+        mh = pv & xh
+        if ph & high:
+            score += 1
+        elif mh & high:
+            score -= 1
+        # Each remaining character can lower the distance by at most one
+        if score - (n - j - 1) > limit:
+            return limit + 1
+        ph = (ph << 1) | 1
+        mh <<= 1
+        pv = (mh | ~(xv | ph)) & mask
+        mv = ph & xv & mask
+    return score
+
+
+def edit_similarity(gold: Any, pred: Any, threshold: float = 0.0) -> float:
+    """
+    1 - edit distance / length of the longer text, or 0.0 below threshold (which bounds
+    the distance that has to be computed).
+    """
+    gold = str(gold) if gold else ""
+    pred = str(pred) if pred else ""
+    length = max(len(gold), len(pred))
+    if length == 0:
+        return 0.0
+    max_distance = math.floor((1.0 - threshold) * length + 1e-9)
+    distance = levenshtein(gold, pred, max_distance)
+    if distance > max_distance:
+        return 0.0
+    return 1.0 - distance / length
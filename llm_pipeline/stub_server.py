@@ -0,0 +1,351 @@
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from pathlib import Path
+from typing import Dict, List, Tuple, Optional
+
+from models import Extractor
+from prompt_template import prompt_map
+from schema import RESULTS_KEY, entity_fields
+from protocol import SHORT_CODES
+
+_NUMBERED_LINE = re.compile(r"^\s*\d+\.\s?(.*)$")
+
+
+def extract_batch_texts(content: str) -> Tuple[str, ...]:
+    """Recover the batch's input strings from a user prompt ("1. ...\\n2. ...")"""
+    # Phi prompts embed the numbered lines in the template as <<<...>>>
+    if "<<<" in content:
+        content = content[content.rindex("<<<") + 3:]
+        content = content[:content.index(">>>")] if ">>>" in content else content
+    texts = []
+    for line in content.split("\n"):
+        match = _NUMBERED_LINE.match(line)
+        if match:
+            texts.append(match.group(1))
+    return tuple(texts)
+
+
+def detect_prompt_tag(messages: List[dict]) -> Optional[str]:
+    """Prompt tag whose template starts the system message (instructions may be appended), if any"""
+    system = next((m["content"] for m in messages if m.get("role") == "system"), None) or ""
+    for tag, template in prompt_map.items():
+        if tag != "default" and system.startswith(template):
+            return tag
+    return None
+
+
+def compact_content(content: str, texts: Tuple[str, ...], template: str) -> str:
+    """What the model would have sent under the compact protocol: the recorded records keyed by line number"""
+    try:
+        parsed = Extractor.parse_response(content)
+    except ValueError:
+        return "{}"
+    records = [r for r in (parsed if isinstance(parsed, list) else [parsed]) if isinstance(r, dict)]
+    by_input = {r.get("input", "").strip(): r for r in records}
+    fields = entity_fields(template)
+    compact = {}
+    for j, text in enumerate(texts):
+        record = records[j] if len(records) == len(texts) else by_input.get(text.strip())
+        if record is None:
+            continue
+        entry = {}
+        for category, values in record.items():
+            if category == "input" or not isinstance(values, list):
+                continue
+            names = fields.get(category) or [category]
+            entry[SHORT_CODES.get(category, category)] = [
+                v.get(names[0]) if len(names) == 1 else [v.get(name) for name in names]
+                for v in values if isinstance(v, dict)
+            ]
+        compact[str(j + 1)] = entry
+    return json.dumps(compact, ensure_ascii=False)
+
+
+class ReplayIndex:
+    """
+    Recorded responses from experiment_outputs/**/api_responses/response_batch_*.json,
+    indexed by the exact batch texts and, for batches never sent as such, by single
+    input text (the recorded per-input object). Recordings are tagged with the prompt
+    directory (p1-p5) they came from, so requests using that prompt replay its responses.
+    """
+    def __init__(self, outputs_dir: Path):
+        self.batches: Dict[Tuple[str, ...], List[Tuple[str, str, float]]] = {}
+        self.records: Dict[str, dict] = {}
+        self.latencies: List[float] = []
+
+        for path in sorted(Path(outputs_dir).rglob("api_responses/response_batch_*.json")):
+            with open(path, "r", encoding="utf-8") as f:
+                recorded = json.load(f)
+            content = self._content(recorded["response"])
+            latency = recorded.get("latency") or 0.0
+            prompt_tag = path.parts[-4]  # <set>/<batch>/<prompt>/<run>/api_responses/<file>
+            self.batches.setdefault(tuple(recorded["texts"]), []).append((prompt_tag, content, latency))
+            self.latencies.append(latency)
+
+            try:
+                parsed = Extractor.parse_response(content)
+            except ValueError:
+                continue
+            for record in parsed if isinstance(parsed, list) else [parsed]:
+                if isinstance(record, dict) and isinstance(record.get("input"), str):
+                    self.records.setdefault(record["input"].strip(), record)
+
+    @staticmethod
+    def _content(response: str) -> str:
+        """Model text of a recorded response (Llama bodies are wrapped in {"output": ...})"""
+        try:
+            wrapper = json.loads(response)
+        except json.JSONDecodeError:
+            return response
+        if isinstance(wrapper, dict) and "output" in wrapper:
+            return wrapper["output"]
+        return response
+
+    def lookup(self, texts: Tuple[str, ...], rng: random.Random, prompt_tag: str = None) -> Tuple[str, Optional[float]]:
+        """Return (completion text, recorded latency or None when synthesised)"""
+        if texts in self.batches:
+            candidates = [c for c in self.batches[texts] if c[0] == prompt_tag] or self.batches[texts]
+            _, content, latency = rng.choice(candidates)
+            return content, latency
+        records = [self.records.get(t.strip(), {"input": t}) for t in texts]
+        return "```json\n" + json.dumps(records, indent=2, ensure_ascii=False) + "\n```", None
+
+
+def json_mode_content(content: str) -> str:
+    """What a JSON-constrained model would have sent: the recorded records, wrapped as {"results": [...]}"""
+    try:
+        parsed = Extractor.parse_response(content)
+    except ValueError:
+        parsed = []
+    if isinstance(parsed, dict) and isinstance(parsed.get(RESULTS_KEY), list):
+        parsed = parsed[RESULTS_KEY]
+    return json.dumps({RESULTS_KEY: parsed if isinstance(parsed, list) else [parsed]}, ensure_ascii=False)
+
+
+class StubConfig:
+    """
+    Behaviour knobs for the stand-in server.
+
+    latency: "recorded" (replay the recorded latency), "fixed:S", "uniform:A,B" or
+    "lognormal:MEDIAN,SIGMA" (seconds), multiplied by latency_scale.
+    json_mode: answer chat-completions requests carrying a JSON response_format with
+    {"results": [...]} only; when False such requests are rejected with 400.
+    """
+    def __init__(self, latency: str = "recorded", latency_scale: float = 1.0, error_rate: float = 0.0,
+                 throttle_rate: float = 0.0, retry_after: float = 1.0, stream_chunk_chars: int = 16, seed: int = None,
+                 json_mode: bool = True):
+        self.latency = latency
+        self.latency_scale = latency_scale
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.stream_chunk_chars = stream_chunk_chars
+        self.json_mode = json_mode
+        self.rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def sample_latency(self, recorded: Optional[float], index: ReplayIndex) -> float:
+        kind, _, args = self.latency.partition(":")
+        values = [float(v) for v in args.split(",")] if args else []
+        with self._lock:
+            if kind == "fixed":
+                delay = values[0]
+            elif kind == "uniform":
+                delay = self.rng.uniform(values[0], values[1])
+            elif kind == "lognormal":
+                delay = self.rng.lognormvariate(0.0, values[1]) * values[0]
+            elif recorded is not None:
+                delay = recorded
+            else:
+                delay = self.rng.choice(index.latencies) if index.latencies else 0.0
+        return delay * self.latency_scale
+
+    def sample_failure(self) -> Optional[int]:
+        with self._lock:
+            roll = self.rng.random()
+        if roll < self.throttle_rate:
+            return 429
+        if roll < self.throttle_rate + self.error_rate:
+            return 500
+        return None
+
+
+def make_handler(index: ReplayIndex, config: StubConfig, counters: Dict[str, int]):
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send_json(self, status: int, body: dict, headers: Dict[str, str] = None):
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _send_events(self, events: List[dict]):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for event in events + ["[DONE]"]:
+                payload = event if isinstance(event, str) else json.dumps(event)
+                data = f"data: {payload}\n\n".encode("utf-8")
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+                self.wfile.flush()
+            self.wfile.write(b"0\r\n\r\n")
+
+        def do_POST(self):
+            try:
+                self._respond()
+            except ConnectionError:
+                # The client hung up first (a cancelled hedge or an aborted request)
+                with config._lock:
+                    counters["client_aborts"] += 1
+                self.close_connection = True
+
+        def _respond(self):
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length) or b"{}")
+            with config._lock:
+                counters["requests"] += 1
+
+            failure = config.sample_failure()
+            if failure == 429:
+                with config._lock:
+                    counters["throttled"] += 1
+                self._send_json(429, {"error": {"code": "429", "message": "Rate limit is exceeded."}},
+                                headers={"Retry-After": str(config.retry_after)})
+                return
+            if failure == 500:
+                with config._lock:
+                    counters["errors"] += 1
+                self._send_json(500, {"error": {"code": "InternalServerError", "message": "Injected failure"}})
+                return
+
+            if "input_data" in request:
+                # Llama managed-endpoint format
+                messages = request["input_data"]["input_string"]
+                stream = request["input_data"].get("parameters", {}).get("stream", False)
+            else:
+                # Azure AI inference / OpenAI chat-completions format
+                messages = request.get("messages", [])
+                stream = request.get("stream", False)
+            user_content = next((m["content"] for m in reversed(messages) if m.get("role") == "user"), "")
+            response_format = request.get("response_format")
+            json_requested = response_format in ("json_object",) or (
+                isinstance(response_format, dict) and response_format.get("type") in ("json_object", "json_schema")
+            )
+            if json_requested and not config.json_mode:
+                self._send_json(400, {"error": {"code": "BadRequest", "message": "response_format is not supported"}})
+                return
+
+            texts = extract_batch_texts(user_content)
+            prompt_tag = detect_prompt_tag(messages)
+            with config._lock:
+                content, recorded_latency = index.lookup(texts, config.rng, prompt_tag)
+            time.sleep(config.sample_latency(recorded_latency, index))
+            # Phi sends the template (with the output instructions) as the user message
+            if any("OUTPUT FORMAT (this replaces" in m.get("content", "") for m in messages):
+                content = compact_content(content, texts, prompt_map[prompt_tag or "default"])
+            elif json_requested:
+                content = json_mode_content(content)
+
+            chunks = [content[i:i + config.stream_chunk_chars] for i in range(0, len(content), config.stream_chunk_chars)]
+            if "input_data" in request:
+                if stream:
+                    self._send_events([{"choices": [{"index": 0, "delta": {"content": c}}]} for c in chunks])
+                else:
+                    self._send_json(200, {"output": content})
+                return
+
+            response_id = f"chatcmpl-{uuid.uuid4().hex}"
+            model = request.get("model", "stub")
+            if stream:
+                events = [{
+                    "id": response_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+                    "choices": [{"index": 0, "delta": {"role": "assistant", "content": c}, "finish_reason": None}]
+                } for c in chunks]
+                events.append({
+                    "id": response_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+                    "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]
+                })
+                self._send_events(events)
+                return
+            self._send_json(200, {
+                "id": response_id,
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+            })
+
+    return StubHandler
+
+
+class StubServer:
+    """
+    Local stand-in for the Llama and Phi endpoints, serving recorded responses.
+    Usable from scripts (start()/stop()) or the command line.
+    """
+    def __init__(self, outputs_dir: Path, config: StubConfig = None, host: str = "127.0.0.1", port: int = 0):
+        self.index = ReplayIndex(outputs_dir)
+        self.config = config or StubConfig()
+        self.counters = {"requests": 0, "throttled": 0, "errors": 0, "client_aborts": 0}
+        self.httpd = ThreadingHTTPServer((host, port), make_handler(self.index, self.config, self.counters))
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "StubServer":
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Record/replay stand-in for the Llama and Phi endpoints")
+    parser.add_argument("--outputs_dir", type=str, default="../experiment_outputs", help="Tree of recorded api_responses")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=str, default="recorded", help='"recorded", "fixed:S", "uniform:A,B" or "lognormal:MEDIAN,SIGMA"')
+    parser.add_argument("--latency_scale", type=float, default=1.0)
+    parser.add_argument("--error_rate", type=float, default=0.0, help="Fraction of requests answered with 500")
+    parser.add_argument("--throttle_rate", type=float, default=0.0, help="Fraction of requests answered with 429")
+    parser.add_argument("--retry_after", type=float, default=1.0, help="Retry-After seconds sent with 429s")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--reject_json_mode", action="store_true", help="Answer requests asking for a JSON response_format with 400")
+    args = parser.parse_args()
+
+    server = StubServer(
+        Path(args.outputs_dir),
+        StubConfig(latency=args.latency, latency_scale=args.latency_scale, error_rate=args.error_rate,
+                   throttle_rate=args.throttle_rate, retry_after=args.retry_after, seed=args.seed,
+                   json_mode=not args.reject_json_mode),
+        host=args.host,
+        port=args.port
+    )
+    print(f"Replaying {len(server.index.batches)} recorded batches on {server.url} (Ctrl+C to stop)")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
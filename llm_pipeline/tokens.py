@@ -0,0 +1,9 @@
+def estimate_tokens(text: str) -> int:
+    """
+    Rough token count for budgeting (rate limits, batch packing).
+    Uses ~4 characters per token; the noisy inputs tokenise worse than prose, so this
+    errs on the low side for b3 strings but is stable and needs no tokenizer download.
+    """
+    if not text:
+        return 0
+    return len(text) // 4 + 1
@@ -0,0 +1,329 @@
+import http.client
+import socket
+import ssl
+import threading
+import time
+from collections import defaultdict
+from dataclasses import dataclass, asdict
+from typing import Dict, Iterator, Tuple
+from urllib.parse import urlsplit
+
+
+@dataclass
+class RequestTiming:
+    """Breakdown of one request's latency (seconds)"""
+    connect_sec: float = 0.0      # TCP + TLS handshake, 0 when a pooled connection was reused
+    server_sec: float = 0.0       # request sent → response headers received
+    read_sec: float = 0.0         # response body transfer
+    total_sec: float = 0.0
+    reused: bool = False          # kept-alive connection taken from the pool
+    tls_resumed: bool = False     # new connection, but the TLS session was resumed
+
+    def to_dict(self) -> Dict:
+        return asdict(self)
+
+
+class RequestAborted(Exception):
+    """The request was stopped through its RequestHandle"""
+
+
+class RequestHandle:
+    """
+    Lets another thread abort a pooled request: abort() shuts its connection down, so
+    the thread blocked sending or reading fails at once instead of reading the
+    response to the end.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._conn = None
+        self.aborted = False
+
+    def abort(self):
+        with self._lock:
+            self.aborted = True
+            conn = self._conn
+        if conn is not None and conn.sock is not None:
+            try:
+                conn.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def _attach(self, conn: http.client.HTTPConnection):
+        with self._lock:
+            if self.aborted:
+                raise RequestAborted("request aborted before it was sent")
+            self._conn = conn
+
+    def _detach(self) -> bool:
+        """Stop tracking the connection; returns whether the request was aborted meanwhile"""
+        with self._lock:
+            self._conn = None
+            return self.aborted
+
+
+class _HostSlots:
+    """Connection slots of one host, bounded by the pool's current max_connections"""
+    def __init__(self, pool: "ConnectionPool"):
+        self._pool = pool
+        self._ready = threading.Condition()
+        self._in_use = 0
+
+    def acquire(self, timeout: float = None) -> bool:
+        with self._ready:
+            if not self._ready.wait_for(lambda: self._in_use < self._pool.max_connections, timeout):
+                return False
+            self._in_use += 1
+            return True
+
+    def release(self):
+        with self._ready:
+            self._in_use -= 1
+            self._ready.notify()
+
+    def wake(self):
+        """Let waiters re-check the limit after it was raised"""
+        with self._ready:
+            self._ready.notify_all()
+
+
+class ConnectionPool:
+    """
+    Thread-safe keep-alive HTTP(S) connection pool.
+
+    Connections are kept per (scheme, host, port) and reused across requests, and
+    TLS sessions are cached so new connections can skip the full handshake.
+    At most max_connections connections (idle + in use) exist per host; callers
+    beyond that block until one is returned. The cap can be raised with grow().
+    """
+    # Errors that mean a kept-alive connection was closed by the server while idle
+    _STALE_ERRORS = (http.client.RemoteDisconnected, http.client.BadStatusLine,
+                     BrokenPipeError, ConnectionResetError, ConnectionAbortedError)
+
+    def __init__(self, max_connections: int = 8, timeout: float = 300.0, ssl_context: ssl.SSLContext = None):
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.ssl_context = ssl_context or ssl.create_default_context()
+
+        self._lock = threading.Lock()
+        self._idle = defaultdict(list)
+        self._slots = defaultdict(lambda: _HostSlots(self))
+        self._tls_sessions = {}
+        self._stats = defaultdict(float)
+
+    def _open(self, scheme: str, host: str, port: int) -> Tuple[http.client.HTTPConnection, bool]:
+        """Open a new connection, resuming a cached TLS session when possible"""
+        sock = socket.create_connection((host, port), timeout=self.timeout)
+        # http.client writes headers and body separately; avoid Nagle delays on reused sockets
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if scheme != "https":
+            conn = http.client.HTTPConnection(host, port, timeout=self.timeout)
+            conn.sock = sock
+            return conn, False
+
+        ssock = self.ssl_context.wrap_socket(sock, server_hostname=host, session=self._tls_sessions.get((host, port)))
+        conn = http.client.HTTPSConnection(host, port, timeout=self.timeout, context=self.ssl_context)
+        conn.sock = ssock
+        return conn, ssock.session_reused
+
+    @staticmethod
+    def _target(url: str) -> Tuple[Tuple[str, str, int], str]:
+        """Split a URL into the pool key (scheme, host, port) and the request path"""
+        parts = urlsplit(url)
+        scheme = parts.scheme or "https"
+        port = parts.port or (443 if scheme == "https" else 80)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        return (scheme, parts.hostname, port), path
+
+    def request(self, method: str, url: str, body: bytes = None, headers: Dict[str, str] = None,
+                handle: RequestHandle = None) -> Tuple[int, Dict[str, str], bytes, RequestTiming]:
+        """
+        Send a request over a pooled connection. With a handle, the request can be
+        aborted from another thread (raising RequestAborted here).
+
+        Returns:
+            (status, response headers, response body, RequestTiming)
+        """
+        pool_key, path = self._target(url)
+        scheme, host, port = pool_key
+
+        with self._lock:
+            slot = self._slots[pool_key]
+        if handle is None:
+            slot.acquire()
+        else:
+            while not slot.acquire(timeout=0.1):
+                if handle.aborted:
+                    raise RequestAborted("request aborted while waiting for a connection")
+        try:
+            # One retry covers an idle connection that the server already closed
+            for attempt in range(2):
+                timing = RequestTiming()
+                start = time.perf_counter()
+
+                conn = None
+                with self._lock:
+                    if self._idle[pool_key] and attempt == 0:
+                        conn = self._idle[pool_key].pop()
+                if conn is not None:
+                    timing.reused = True
+                else:
+                    conn, timing.tls_resumed = self._open(scheme, host, port)
+                timing.connect_sec = time.perf_counter() - start
+
+                try:
+                    if handle is not None:
+                        handle._attach(conn)
+                    sent = time.perf_counter()
+                    conn.request(method, path, body=body, headers=headers or {})
+                    response = conn.getresponse()
+                    headers_at = time.perf_counter()
+                    data = response.read()
+                except Exception as e:
+                    conn.close()
+                    if handle is not None and handle._detach():
+                        raise RequestAborted(f"{method} {url} aborted") from e
+                    if isinstance(e, self._STALE_ERRORS) and timing.reused and attempt == 0:
+                        continue
+                    raise
+
+                done = time.perf_counter()
+                timing.server_sec = headers_at - sent
+                timing.read_sec = done - headers_at
+                timing.total_sec = done - start
+                # A connection shut down by an abort that came too late to matter is not reusable
+                aborted = handle is not None and handle._detach()
+
+                with self._lock:
+                    # TLS 1.3 tickets arrive after the handshake, so capture the session now
+                    if isinstance(conn.sock, ssl.SSLSocket) and conn.sock.session is not None:
+                        self._tls_sessions[(host, port)] = conn.sock.session
+                    if response.will_close or aborted:
+                        conn.close()
+                    else:
+                        self._idle[pool_key].append(conn)
+
+                self._record(timing)
+                return response.status, dict(response.getheaders()), data, timing
+        finally:
+            slot.release()
+
+    def stream(self, method: str, url: str, body: bytes = None, headers: Dict[str, str] = None, timing: RequestTiming = None) -> Iterator[Tuple[int, Dict[str, str], bytes]]:
+        """
+        Send a request and yield (status, response headers, line) for each line of the body
+        as it arrives (the first item carries an empty line). The connection goes back to
+        the pool once the body has been read to the end; abandoning the generator closes it.
+        """
+        pool_key, path = self._target(url)
+        scheme, host, port = pool_key
+        timing = timing if timing is not None else RequestTiming()
+
+        with self._lock:
+            slot = self._slots[pool_key]
+        slot.acquire()
+        conn = None
+        finished = False
+        try:
+            start = time.perf_counter()
+            with self._lock:
+                if self._idle[pool_key]:
+                    conn = self._idle[pool_key].pop()
+            if conn is not None:
+                timing.reused = True
+                try:
+                    sent = time.perf_counter()
+                    conn.request(method, path, body=body, headers=headers or {})
+                    response = conn.getresponse()
+                except self._STALE_ERRORS:
+                    conn.close()
+                    conn = None
+            if conn is None:
+                timing.reused = False
+                conn, timing.tls_resumed = self._open(scheme, host, port)
+                timing.connect_sec = time.perf_counter() - start
+                sent = time.perf_counter()
+                conn.request(method, path, body=body, headers=headers or {})
+                response = conn.getresponse()
+            else:
+                timing.connect_sec = sent - start
+
+            headers_at = time.perf_counter()
+            timing.server_sec = headers_at - sent
+            response_headers = dict(response.getheaders())
+            yield response.status, response_headers, b""
+            for line in response:
+                yield response.status, response_headers, line
+            # Line iteration stops at Content-Length without marking the response complete,
+            # which would leave the connection unusable for the next request
+            response.read()
+
+            done = time.perf_counter()
+            timing.read_sec = done - headers_at
+            timing.total_sec = done - start
+            finished = True
+            with self._lock:
+                if isinstance(conn.sock, ssl.SSLSocket) and conn.sock.session is not None:
+                    self._tls_sessions[(host, port)] = conn.sock.session
+                if response.will_close:
+                    conn.close()
+                else:
+                    self._idle[pool_key].append(conn)
+            self._record(timing)
+        finally:
+            if conn is not None and not finished:
+                conn.close()
+                timing.total_sec = time.perf_counter() - start
+            slot.release()
+
+    def _record(self, timing: RequestTiming):
+        with self._lock:
+            self._stats["requests"] += 1
+            self._stats["connections_opened"] += 0 if timing.reused else 1
+            self._stats["connections_reused"] += 1 if timing.reused else 0
+            self._stats["tls_sessions_resumed"] += 1 if timing.tls_resumed else 0
+            self._stats["connect_sec"] += timing.connect_sec
+            self._stats["server_sec"] += timing.server_sec
+            self._stats["read_sec"] += timing.read_sec
+
+    def stats(self) -> Dict[str, float]:
+        """Cumulative counters for every request sent through this pool"""
+        with self._lock:
+            return dict(self._stats)
+
+    def grow(self, max_connections: int):
+        """Raise the per-host connection cap to max_connections (it is never lowered)"""
+        with self._lock:
+            if max_connections <= self.max_connections:
+                return
+            self.max_connections = max_connections
+            slots = list(self._slots.values())
+        for slot in slots:
+            slot.wake()
+
+    def close(self):
+        """Close all idle connections"""
+        with self._lock:
+            for conns in self._idle.values():
+                for conn in conns:
+                    conn.close()
+            self._idle.clear()
+
+
+_shared_pools: Dict[bool, ConnectionPool] = {}
+_shared_lock = threading.Lock()
+
+
+def get_shared_pool(verify_ssl: bool = True, max_connections: int = 8) -> ConnectionPool:
+    """
+    Return the process-wide pool, so connections are reused across clients and runs.
+    Its per-host cap is the largest max_connections any caller asked for (8 unless
+    raised, e.g. by Main from --concurrency).
+    """
+    with _shared_lock:
+        if verify_ssl not in _shared_pools:
+            context = ssl.create_default_context() if verify_ssl else ssl._create_unverified_context()
+            _shared_pools[verify_ssl] = ConnectionPool(max_connections=max_connections, ssl_context=context)
+        pool = _shared_pools[verify_ssl]
+    pool.grow(max_connections)
+    return pool